@@ -25,5 +25,5 @@ if !errorlevel! == 0 (
 )
 
 start http://localhost:5000
-%PYTHON_CMD% app.py
+%PYTHON_CMD% wsgi.py
 pause
\ No newline at end of file
@@ -74,7 +74,7 @@ echo ═════════════════════════
 echo.
 
 :: Ждем немного и открываем браузер
-start /B %PYTHON_CMD% app.py
+start /B %PYTHON_CMD% wsgi.py
 timeout /t 3 /nobreak >nul
 start http://localhost:5000
 
@@ -1,13 +1,16 @@
 #coding=utf-8
 # Стандартные библиотеки
+import importlib.util
 import io
+import json
 import locale
 import logging
 import os
 import re
-import shutil
 import subprocess
 import sys
+import threading
+import time
 from datetime import date, datetime, timedelta
 
 # Установка UTF-8 кодировки для консоли Windows
@@ -23,7 +26,9 @@ if sys.platform == 'win32':
 
 def check_and_install_dependencies():
     """
-    Проверяет наличие необходимых зависимостей и устанавливает их при необходимости
+    Проверяет наличие необходимых зависимостей и устанавливает их при необходимости.
+    Модули ищутся через find_spec без импорта: тяжёлые библиотеки (ML, PDF,
+    DOCX) загружаются только при первом использовании.
     """
     # Список обязательных модулей для проверки
     required_modules = {
@@ -45,9 +50,7 @@ def check_and_install_dependencies():
     
     # Проверяем каждый модуль
     for module_name, package_name in required_modules.items():
-        try:
-            __import__(module_name)
-        except ImportError:
+        if importlib.util.find_spec(module_name) is None:
             missing_modules.append(package_name)
     
     # Если есть отсутствующие модули, устанавливаем их
@@ -90,10 +93,9 @@ def check_and_install_dependencies():
             
             # Проверяем еще раз, что ли модули установлены
             still_missing = []
+            importlib.invalidate_caches()
             for module_name, package_name in required_modules.items():
-                try:
-                    __import__(module_name)
-                except ImportError:
+                if importlib.util.find_spec(module_name) is None:
                     still_missing.append(package_name)
             
             # Если что-то все еще отсутствует, устанавливаем отдельно
@@ -131,179 +133,290 @@ check_and_install_dependencies()
 
 # Сторонние зависимости 
 import click
-import joblib
-import numpy as np
-import pdfkit
 from apscheduler.schedulers.background import BackgroundScheduler
 from dateutil.relativedelta import relativedelta
-from docxtpl import DocxTemplate
-from flask import (Flask, flash, jsonify, make_response, redirect,
-                   render_template, request, url_for, abort)
+from flask import (Flask, Response, flash, jsonify, make_response, redirect,
+                   render_template, request, stream_with_context, url_for,
+                   abort)
 from flask_wtf.csrf import CSRFProtect
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import selectinload
 
 # Локальные импорты
+import db_backup
+import docx_templates
+import ml_backend
+import pdf_backend
+import phone_export
+import report_jobs
+import scheduler_lock
 from forms import TreatmentCalculatorForm, TreatmentForm
 from models import (Appointment, AppointmentTreatment, Note, Owner, Pet,
-                    Treatment, Vaccination, db)
+                    StatisticsSnapshot, Treatment, Vaccination, db)
+from card_numbers import (count_free_numbers, ensure_card_number_index,
+                          free_numbers, max_used_number, min_used_number,
+                          suggest_card_number)
+from keyset_pagination import KeysetPagination, estimate_rows
+from owner_phones import phone_search_condition, rebuild_owner_phone_index
+from phone_normalizer import normalize_many
+from response_cache import ResponseCache
+from search_index import (any_of, ensure_search_index, match_expression,
+                          matching_ids, phone_expression, ranked,
+                          rebuild_search_index)
+from sqlite_tuning import init_sqlite_tuning, optimize_database
+from statistics_snapshot import refresh_statistics_snapshot
 
 logging.basicConfig()
 logging.getLogger('apscheduler').setLevel(logging.DEBUG)
 logging.getLogger('sqlalchemy.engine').setLevel(logging.INFO)
 
-# Конфигурация для PDF генерации (опционально)
-config = None
-try:
-    wkhtmltopdf_path = r'C:\Program Files\wkhtmltopdf\bin\wkhtmltopdf.exe'
-    if os.path.exists(wkhtmltopdf_path):
-        config = pdfkit.configuration(wkhtmltopdf=wkhtmltopdf_path)
-        print("[OK] wkhtmltopdf найден - генерация PDF отчётов доступна")
-    else:
-        print("[ВНИМАНИЕ] wkhtmltopdf не найден - генерация PDF отчетов недоступна")
-        print("           Скачайте с: https://wkhtmltopdf.org/downloads.html")
-except Exception as e:
-    error_msg = "[ВНИМАНИЕ] Ошибка инициализации wkhtmltopdf: {}".format(e)
-    print(error_msg)
-    print("           Генерация PDF отчетов будет недоступна")
+DEFAULT_SECRET_KEY = 'your_secret_key'
 
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///vet_clinic.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['JSON_AS_ASCII'] = False
-app.secret_key = 'your_secret_key'  # Замените на надёжное значение
+app.secret_key = DEFAULT_SECRET_KEY  # Замените на надёжное значение (AIBOLIT_SECRET_KEY)
+# Отображение больших numpy-массивов модели в память вместо чтения ('r' или None)
+app.config['ML_MMAP_MODE'] = None
+# wkhtmltopdf ищется при первом PDF-отчёте (по этому пути, затем в PATH)
+app.config['WKHTMLTOPDF_PATH'] = pdf_backend.DEFAULT_WKHTMLTOPDF_PATH
+app.config['BACKUP_DIR'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'database_backups')
+app.config['BACKUP_INTERVAL_MINUTES'] = 5  # Копия пропускается, если база не менялась
+app.config['BACKUP_PAGES_PER_STEP'] = 256  # Страниц за шаг backup API
+app.config['BACKUP_STEP_SLEEP'] = 0.05  # Пауза между шагами, с
+app.config['BACKUP_MAX_RESTARTS'] = 3  # Перезапусков постраничной копии до копии за один шаг
+app.config['BACKUP_COMPRESSION'] = None  # None, 'gzip' или 'zstd'
+app.config['BACKUP_KEEP'] = 10
+app.config['STATISTICS_REFRESH_MINUTES'] = 5
+app.config['SQLITE_OPTIMIZE_HOURS'] = 6
+app.config['SCHEDULER_ENABLED'] = True  # Фоновые задачи запускает только один процесс (см. start_scheduler)
+app.config['CARD_TEMPLATE'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'card.docx')
+app.config['CARD_RENDER_WORKERS'] = 1  # Потоков для пакетной печати карточек (1 - в потоке запроса)
+app.config['CARD_BULK_LIMIT'] = 500  # Максимум карточек за один запрос
+app.config['REPORT_DIR'] = None  # Готовые PDF отчёты; по умолчанию instance/reports
+app.config['REPORT_WORKERS'] = 2  # Одновременных процессов wkhtmltopdf
+app.config['REPORT_CACHE_KEEP'] = 50  # Сколько готовых PDF хранить
+app.config['PAGINATION_NUMBERED_PAGES'] = 10  # Дальше - переход по курсорам (keyset)
+app.config['PAGINATION_EXACT_COUNT'] = False  # Без фильтров - оценка количества вместо COUNT(*)
+app.config['SERVER_HOST'] = '0.0.0.0'
+app.config['SERVER_PORT'] = 5000
+app.config['SERVER_THREADS'] = 8  # Потоков waitress в wsgi.py
+# Переопределение из окружения: AIBOLIT_<КЛЮЧ>, например AIBOLIT_SECRET_KEY,
+# AIBOLIT_SQLALCHEMY_DATABASE_URI, AIBOLIT_BACKUP_KEEP=20, AIBOLIT_SCHEDULER_ENABLED=false
+# (значения разбираются как JSON, иначе остаются строкой)
+app.config.from_prefixed_env('AIBOLIT')
+pdf_backend.set_wkhtmltopdf_path(app.config['WKHTMLTOPDF_PATH'])
+# WAL, synchronous=NORMAL, кэш, mmap, busy_timeout для каждого соединения (SQLITE_* в app.config)
+init_sqlite_tuning(app)
 db.init_app(app)  # Инициализируем db с Flask
 csrf = CSRFProtect(app)
 
 # Глобальная переменная для ML модели
 ml_model = None
+ml_pipeline = None  # Подготовленный конвейер для ml_model
 ml_enabled = False  # По умолчанию ML выключена
 
+# Состояние фоновой загрузки модели: idle -> loading -> ready | failed
+ml_state = {
+    'status': 'idle',
+    'error': None,
+    'model_path': None,
+    'load_seconds': None,
+    'warmup_seconds': None,
+}
+ml_state_lock = threading.Lock()
+ml_load_generation = 0  # Увеличивается при выключении ML, чтобы отбросить устаревшую загрузку
+
+# Модели в порядке предпочтения: (путь, описание)
+ML_MODEL_FILES = [
+    ('ml/models/weighted_animal_disease_model.pkl', 'взвешенную'),
+    ('ml/models/improved_animal_disease_model.pkl', 'улучшенную'),
+    ('ml/models/animal_disease_model.pkl', 'стандартную'),
+]
+
 def load_ml_model():
-    """Загрузка ML модели для диагностики заболеваний"""
-    global ml_model
+    """Загрузка ML модели для диагностики заболеваний.
+
+    Глобальные переменные не меняет: возвращает (model_data, pipeline, model_path),
+    а публикует результат фоновый поток. Если модели нет или она не читается - исключение.
+    """
     try:
-        # Пробуем загрузить взвешенную модель
-        if os.path.exists('ml/models/weighted_animal_disease_model.pkl'):
-            print("DEBUG: Загружаем взвешенную ML модель...")
-            model_data = joblib.load('ml/models/weighted_animal_disease_model.pkl')
-            ml_model = model_data
-            print("DEBUG: Взвешенная модель загружена")
-            print("[OK] ML модель успешно загружена")
-            return True
-        elif os.path.exists('ml/models/improved_animal_disease_model.pkl'):
-            print("DEBUG: Загружаем улучшенную ML модель...")
-            model_data = joblib.load('ml/models/improved_animal_disease_model.pkl')
-            ml_model = model_data
-            print("DEBUG: Улучшенная модель загружена")
-            print("[OK] ML модель успешно загружена")
-            return True
-        elif os.path.exists('ml/models/animal_disease_model.pkl'):
-            print("DEBUG: Загружаем стандартную ML модель...")
-            model_data = joblib.load('ml/models/animal_disease_model.pkl')
+        for model_path, description in ML_MODEL_FILES:
+            if not os.path.exists(model_path):
+                continue
+            print("DEBUG: Загружаем {} ML модель...".format(description))
+            model_data = ml_backend.load_model(model_path, mmap_mode=app.config.get('ML_MMAP_MODE'))
             
             # Проверяем структуру загруженных данных
             if isinstance(model_data, dict):
-                ml_model = model_data
                 print("DEBUG: Модель загружена как словарь")
             else:
                 # Если это старая версия модели
-                ml_model = model_data
                 print("DEBUG: Модель загружена как объект")
             
+            pipeline = ml_backend.build_pipeline(model_data)
             print("[OK] ML модель успешно загружена")
-            return True
-        else:
-            print("[ВНИМАНИЕ] ML модель не найдена. Создайте модель с помощью ml/train_model.py")
-            return False
+            return model_data, pipeline, model_path
     except Exception as e:
         error_msg = "[ВНИМАНИЕ] Ошибка при загрузке ML модели: {}".format(e)
         print(error_msg)
         import traceback
         traceback.print_exc()
-        return False
+        raise
+    
+    print("[ВНИМАНИЕ] ML модель не найдена. Создайте модель с помощью ml/train_model.py")
+    raise FileNotFoundError('ML модель не найдена. Создайте модель с помощью ml/train_model.py')
+
+def warm_up_ml_model(pipeline):
+    """Пробное предсказание: прогревает scaler, selector и модель после загрузки"""
+    animal_types = list(getattr(pipeline, 'animal_type_codes', {})) or ['собака']
+    pipeline.predict(animal_types[0], [], {})
+
+def _load_ml_model_worker(generation):
+    """Фоновая загрузка модели; публикует модель и меняет ml_state по завершении.
+
+    Результат применяется под ml_state_lock и только если за время загрузки ML
+    не выключали (поколение не изменилось), иначе он просто отбрасывается.
+    """
+    global ml_model, ml_pipeline
+    started = time.perf_counter()
+    loaded = None
+    error = None
+    warmup_seconds = None
+    try:
+        loaded = load_ml_model()
+    except Exception as e:
+        error = str(e) or e.__class__.__name__
+    load_seconds = time.perf_counter() - started
+    
+    if loaded is not None:
+        try:
+            started = time.perf_counter()
+            warm_up_ml_model(loaded[1])
+            warmup_seconds = time.perf_counter() - started
+        except Exception as e:
+            error = 'Ошибка пробного предсказания: {}'.format(e)
+    
+    with ml_state_lock:
+        if generation != ml_load_generation:
+            # ML выключили (и, возможно, снова включили), пока модель загружалась
+            return
+        if error is None:
+            ml_model, ml_pipeline, model_path = loaded
+            ml_state.update(status='ready', error=None, model_path=model_path,
+                            load_seconds=round(load_seconds, 3),
+                            warmup_seconds=round(warmup_seconds, 3))
+            app.logger.info("ML model loaded in {:.2f}s".format(load_seconds))
+        else:
+            ml_model = None
+            ml_pipeline = None
+            ml_state.update(status='failed', error=error, load_seconds=round(load_seconds, 3))
+
+def start_ml_model_loading(retry_failed=False):
+    """Запускает загрузку модели в фоновом потоке, если она ещё не идёт. Возвращает статус."""
+    with ml_state_lock:
+        status = ml_state['status']
+        if status in ('loading', 'ready') or (status == 'failed' and not retry_failed):
+            return status
+        ml_state.update(status='loading', error=None, load_seconds=None, warmup_seconds=None)
+        thread = threading.Thread(target=_load_ml_model_worker, args=(ml_load_generation,),
+                                  name='ml-model-loader', daemon=True)
+        thread.start()
+        return 'loading'
+
+def ml_not_ready_response():
+    """Ответ API диагностики, пока модель не готова"""
+    status = start_ml_model_loading()
+    if status == 'failed':
+        return jsonify({
+            'success': False,
+            'status': status,
+            'error': 'ML модель не найдена или не может быть загружена: {}'.format(ml_state['error'])
+        }), 500
+    return jsonify({
+        'success': False,
+        'status': status,
+        'error': 'ML модель загружается, повторите запрос через несколько секунд'
+    }), 503
 
 def init_scheduler():
     scheduler = BackgroundScheduler()
-    backup_interval = app.config.get('BACKUP_INTERVAL_MINUTES', 15)
+    backup_interval = app.config.get('BACKUP_INTERVAL_MINUTES', 5)
     scheduler.add_job(create_backup, 'interval', minutes= backup_interval)
+    statistics_interval = app.config.get('STATISTICS_REFRESH_MINUTES', 5)
+    scheduler.add_job(refresh_statistics_job, 'interval', minutes=statistics_interval)
+    # Полная перестройка раз в сутки подхватывает изменения из других процессов (импорт CSV)
+    scheduler.add_job(refresh_statistics_job, 'cron', hour=3, kwargs={'full': True})
+    optimize_interval = app.config.get('SQLITE_OPTIMIZE_HOURS', 6)
+    scheduler.add_job(optimize_database_job, 'interval', hours=optimize_interval)
     scheduler.start()
     return scheduler
 
-app.config['BACKUP_INTERVAL_MINUTES'] = 15
+scheduler = None
+
+def start_scheduler():
+    """Запускает планировщик, если он включён и не работает в другом процессе"""
+    global scheduler
+    if scheduler is not None or not app.config['SCHEDULER_ENABLED']:
+        return scheduler
+    lock_path = os.path.join(app.instance_path, 'scheduler.lock')
+    if not scheduler_lock.acquire(lock_path):
+        app.logger.warning("Scheduler is already running in another server process (this pid {}); "
+                           "serve with a single process (waitress or gunicorn -w 1): ML state, "
+                           "caches and statistics change tracking are per process".format(os.getpid()))
+        return None
+    scheduler = init_scheduler()
+    return scheduler
+
+def create_app():
+    """Фабрика для WSGI-серверов (wsgi.py): приложение с запущенным планировщиком"""
+    if app.config['SECRET_KEY'] == DEFAULT_SECRET_KEY:
+        app.logger.warning("SECRET_KEY is the default value, set AIBOLIT_SECRET_KEY")
+    start_scheduler()
+    return app
+
+def database_file():
+    """Путь к файлу SQLite, с которым работает приложение"""
+    with app.app_context():
+        return db.engine.url.database
+
+def refresh_statistics_job(full=False):
+    """Обновление снимка статистики из фонового потока планировщика"""
+    with app.app_context():
+        try:
+            refresh_statistics_snapshot(full=full)
+        except Exception as e:
+            app.logger.error("Statistics refresh failed: {}".format(str(e)))
+
+def optimize_database_job():
+    """Периодический PRAGMA optimize из фонового потока планировщика"""
+    with app.app_context():
+        try:
+            with db.engine.connect() as connection:
+                optimize_database(connection)
+        except Exception as e:
+            app.logger.error("PRAGMA optimize failed: {}".format(str(e)))
 
-def create_backup():
+def create_backup(force=False):
+    """Онлайн-копия базы через backup API SQLite (см. db_backup.py)"""
     try:
-        backup_dir = os.path.join(os.path.dirname(__file__), 'database_backups')
-        os.makedirs(backup_dir, exist_ok=True)
-        
-        db_file = 'instance/vet_clinic.db'
-        
-        if not os.path.exists(db_file):
-            return {'status': 'error', 'message': 'Database file not found'}
-        
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        backup_file = os.path.join(backup_dir, 'vet_clinic_backup_{}.db'.format(timestamp))
-        
-        shutil.copy2(db_file, backup_file)
-        
-        # Удаляем старые бэкапы
-        backups = sorted(os.listdir(backup_dir), reverse=True)
-        for old_backup in backups[10:]:
-            os.remove(os.path.join(backup_dir, old_backup))
-            
-        app.logger.info("Backup created: {}".format(backup_file))
-        return {'status': 'success', 'message': 'Backup created: {}'.format(backup_file)}
+        result = db_backup.create_backup(
+            database_file(), app.config['BACKUP_DIR'],
+            pages_per_step=app.config['BACKUP_PAGES_PER_STEP'],
+            step_sleep=app.config['BACKUP_STEP_SLEEP'],
+            max_restarts=app.config['BACKUP_MAX_RESTARTS'],
+            compression=app.config['BACKUP_COMPRESSION'],
+            keep=app.config['BACKUP_KEEP'],
+            force=force
+        )
+        if result['status'] == 'success':
+            app.logger.info("{} ({} bytes, {:.2f}s)".format(result['message'], result['bytes'], result['seconds']))
+        return result
     except Exception as e:
         app.logger.error("Backup failed: {}".format(str(e)))
         return {'status': 'error', 'message': str(e)}
 
-def normalize_phone(phone_str):
-    valid_numbers = []
-    invalid_numbers = []
-    
-    raw_numbers = re.split(r'[\s,;|]+', phone_str.strip())
-    
-    for num in raw_numbers:
-        if not num:
-            continue
-        
-        clean_num = re.sub(r'\D', '', num)
-        
-        if not clean_num:
-            invalid_numbers.append(num)
-            continue
-        
-        converted = None
-        
-        if len(clean_num) == 12 and clean_num.startswith('375'):
-            converted = clean_num
-        
-        elif len(clean_num) == 11 and clean_num.startswith('80'):
-            converted = '375' + clean_num[2:]
-        
-        elif len(clean_num) == 9:
-            converted = '375' + clean_num
-        
-        elif len(clean_num) == 7:
-            converted = '37529' + clean_num
-        
-        elif len(clean_num) == 6:
-            converted = '37517' + clean_num
-        
-        if converted and len(converted) == 12 and converted.startswith('375'):
-            valid_numbers.append(converted)
-        else:
-            invalid_numbers.append(num)
-    
-    valid_numbers = list(set(valid_numbers))
-    invalid_numbers = list(set(invalid_numbers))
-    
-    return {
-        'valid': valid_numbers,
-        'invalid': invalid_numbers
-    }
-
 @app.route('/', methods=['GET', 'POST'])    
 def index():
     notes = Note.query.order_by(Note.timestamp.desc()).all()  # Всегда загружаем заметки
@@ -319,12 +432,18 @@ def index():
     
     return render_template('index.html', notes=notes)  # Убедитесь, что передаёте notes
 
+def delete_appointment_treatments(appointment_id):
+    """Удаляет назначения приёма по одному через сессию (а не query.delete()):
+    события снимка статистики и кэша страниц видят затронутый день"""
+    for appointment_treatment in AppointmentTreatment.query.filter_by(appointment_id=appointment_id):
+        db.session.delete(appointment_treatment)
+
 @app.route('/appointment/<int:appointment_id>/treatments', methods=['POST'])
 def update_appointment_treatments(appointment_id):
     data = request.json
     try:
-        # Удаляем старые назначения
-        AppointmentTreatment.query.filter_by(appointment_id=appointment_id).delete()
+        # Удаляем старые назначения через сессию, чтобы сработали события статистики и кэша
+        delete_appointment_treatments(appointment_id)
         
         # Добавляем новые
         for treatment in data['treatments']:
@@ -355,18 +474,18 @@ def admin_panel():
     #     return redirect(url_for('login'))
     
     # Получаем время последнего бэкапа
-    backup_dir = os.path.join(os.path.dirname(__file__), 'database_backups')
+    backup_dir = app.config['BACKUP_DIR']
     last_backup = None
-    if os.path.exists(backup_dir):
-        backups = sorted(os.listdir(backup_dir), reverse=True)
-        if backups:
-            last_backup = datetime.fromtimestamp(os.path.getmtime(os.path.join(backup_dir, backups[0])))
+    backups = db_backup.list_backups(backup_dir)
+    if backups:
+        last_backup = datetime.fromtimestamp(os.path.getmtime(os.path.join(backup_dir, backups[0])))
     
     return render_template('admin.html', last_backup=last_backup)
 
 @app.route('/admin/backup', methods=['POST'])
 def manual_backup():
-    result = create_backup()
+    # Ручная копия создаётся, даже если база не менялась
+    result = create_backup(force=True)
     return jsonify(result)
 
 @app.route('/delete_treatment/<int:treatment_id>/<int:appointment_id>')
@@ -383,11 +502,10 @@ def available_card_numbers():
     range_min = request.args.get('min', default=None, type=int)
     range_max = request.args.get('max', default=None, type=int)
     
-    # Получаем все существующие номера карточек
-    used_numbers = [int(p.card_number) for p in Pet.query.with_entities(Pet.card_number).all() 
-                   if p.card_number and p.card_number.isdigit()]
+    ensure_card_number_index()
+    min_used = min_used_number()
     
-    if not used_numbers:
+    if min_used is None:
         # Если нет ни одной карточки, возвращаем сообщение
         return render_template('available_cards.html', 
                             first_25=list(range(1, 26)),
@@ -399,33 +517,21 @@ def available_card_numbers():
                             range_min=range_min,
                             range_max=range_max)
     
-    max_used = max(used_numbers)
-    min_used = min(used_numbers)
+    max_used = max_used_number()
     
     # Определяем границы диапазона
     min_range = range_min if range_min is not None else 1
     max_range = range_max if range_max is not None else max_used + 100
     
-    # Создаем множество всех возможных номеров в диапазоне
-    all_numbers = set(range(min_range, max_range + 1))
-    used_numbers_set = set(used_numbers)
-    
-    # Находим свободные номера в диапазоне
-    available_numbers = sorted(all_numbers - used_numbers_set)
-    
-    # Добавляем следующий номер после максимального, если он в диапазоне
-    next_number = max_used + 1
-    if next_number <= max_range:
-        available_numbers.append(next_number)
-    
-    total_available = len(available_numbers)
+    # Свободные номера берём из индекса интервалов, не перебирая весь диапазон
+    total_available = count_free_numbers(min_range, max_range)
     has_more = total_available > 50
     
     if has_more:
-        first_25 = available_numbers[:25]
-        last_25 = available_numbers[-25:]
+        first_25 = free_numbers(min_range, max_range, 25)
+        last_25 = free_numbers(min_range, max_range, 25, descending=True)
     else:
-        first_25 = available_numbers
+        first_25 = free_numbers(min_range, max_range, 50)
         last_25 = []
 
     return render_template(
@@ -440,6 +546,22 @@ def available_card_numbers():
         range_max=range_max
     )
 
+@app.route('/api/free_card_numbers')
+def free_card_numbers():
+    """Постраничный список свободных номеров: ?after=<последний номер>&limit=<количество>"""
+    after = request.args.get('after', default=0, type=int)
+    limit = min(request.args.get('limit', default=50, type=int), 500)
+    
+    ensure_card_number_index()
+    max_range = max(after + limit, max_used_number() + limit)
+    numbers = free_numbers(after + 1, max_range, limit)
+    
+    return jsonify({
+        'numbers': numbers,
+        'next_after': numbers[-1] if numbers else None,
+        'suggested': numbers[0] if numbers else suggest_card_number(after)
+    })
+
 @app.route('/edit_treatment/<int:treatment_id>', methods=['GET', 'POST'])
 def edit_treatment(treatment_id):
     treatment = Treatment.query.get_or_404(treatment_id)
@@ -526,7 +648,7 @@ def treatment_calculator():
                 # Создаем или обновляем прием
                 if appointment_id and appointment_id != 'new':
                     appointment = Appointment.query.get(appointment_id)
-                    AppointmentTreatment.query.filter_by(appointment_id=appointment_id).delete()
+                    delete_appointment_treatments(appointment_id)
                 else:
                     if not pet_id:
                         flash('Не выбран питомец', 'error')
@@ -633,9 +755,12 @@ def create_vaccinations_for_appointment(appointment):
 @app.route('/treatment_search')
 def treatment_search():
     term = request.args.get('term', '')
-    treatments = Treatment.query.filter(
-        Treatment.name.ilike('%{}%'.format(term))
-    ).limit(10).all()
+    ensure_search_index()
+    query = Treatment.query
+    expression = match_expression(term)
+    if expression:
+        query = ranked(query, Treatment, expression)
+    treatments = query.limit(10).all()
     return jsonify([{
         'id': t.id,
         'name': t.name,
@@ -647,10 +772,12 @@ def treatment_search():
 @app.route('/pet_search')
 def pet_search():
     term = request.args.get('term', '')
-    pets = Pet.query.join(Owner).filter(
-        Pet.name.ilike('%{}%'.format(term)) | 
-        Pet.card_number.ilike('%{}%'.format(term))
-    ).limit(10).all()
+    ensure_search_index()
+    query = Pet.query.join(Owner).options(db.contains_eager(Pet.owner))
+    expression = match_expression(term, ['name', 'card_number'])
+    if expression:
+        query = ranked(query, Pet, expression)
+    pets = query.limit(10).all()
     return jsonify([{
         'id': p.id,
         'name': p.name,
@@ -823,6 +950,103 @@ def list_treatments():
         active_category=category
     )
 
+def build_rabies_report_data(start_date, end_date):
+    """Строки отчёта по бешенству за период.
+
+    Дата предыдущей вакцинации вычисляется оконной функцией LAG по всем
+    прививкам от бешенства животного, поэтому весь отчёт строится одним
+    запросом независимо от количества строк.
+    """
+    previous_day = start_date - timedelta(days=1)
+
+    # Уникальные даты прививок каждого животного и предыдущая дата для каждой
+    rabies_dates = db.session.query(
+        Vaccination.pet_id.label('pet_id'),
+        Vaccination.date_administered.label('date_administered'),
+        db.func.lag(Vaccination.date_administered).over(
+            partition_by=Vaccination.pet_id,
+            order_by=Vaccination.date_administered
+        ).label('prev_date')
+    ).filter(
+        Vaccination.vaccination_type == 'Бешенство',
+        Vaccination.date_administered <= end_date
+    ).group_by(Vaccination.pet_id, Vaccination.date_administered).subquery()
+
+    # Получаем вакцинации от бешенства за период
+    vaccinations = db.session.query(Vaccination, Owner, Pet, rabies_dates.c.prev_date)\
+        .join(Owner, Vaccination.owner_id == Owner.id)\
+        .join(Pet, Vaccination.pet_id == Pet.id)\
+        .join(rabies_dates, db.and_(
+            rabies_dates.c.pet_id == Vaccination.pet_id,
+            rabies_dates.c.date_administered == Vaccination.date_administered
+        ))\
+        .filter(
+            Vaccination.vaccination_type == 'Бешенство',
+            Vaccination.date_administered >= previous_day,
+            Vaccination.date_administered <= end_date
+        )\
+        .order_by(Vaccination.date_administered)\
+        .all()
+
+    report_data = []
+    for idx, (vacc, owner, pet, prev_date) in enumerate(vaccinations, 1):
+        if isinstance(prev_date, str):
+            prev_date = datetime.strptime(prev_date, '%Y-%m-%d').date()
+
+        # Получаем возраст на дату вакцинации
+        age_str = pet.vaccination_age(vacc.date_administered)
+
+        report_data.append({
+            'num': idx,
+            'date': vacc.date_administered.strftime('%d.%m.%Y'),
+            'owner': owner.name,
+            'address': owner.address,
+            'animal': pet.species,
+            'breed': pet.breed,
+            'age': age_str,  # Формат "X г Y м Z д" без нулевых значений
+            'prev_vaccination': prev_date.strftime('%d.%m.%Y') if prev_date else '',
+            'dose': "{}".format(vacc.dose_ml or 1.0)
+        })
+    return report_data
+
+# Параметры PDF отчёта по бешенству (альбомная ориентация)
+RABIES_PDF_OPTIONS = {
+    'page-size': 'A4',
+    'orientation': 'Landscape',
+    'margin-top': '0.5in',
+    'margin-right': '0.5in',
+    'margin-bottom': '0.5in',
+    'margin-left': '0.5in',
+    'encoding': 'UTF-8',
+}
+
+def report_dir():
+    return app.config['REPORT_DIR'] or os.path.join(app.instance_path, 'reports')
+
+def rabies_report_job(start_date, end_date):
+    """HTML отчёта по бешенству и ключ его PDF (параметры + хэш HTML)"""
+    report_data = build_rabies_report_data(start_date, end_date)
+    # Формируем HTML отчета с альбомной ориентацией
+    report_html = render_template(
+        'rabies_report.html',
+        report_data=report_data,
+        start_date=start_date.strftime('%d.%m.%Y'),
+        end_date=end_date.strftime('%d.%m.%Y')
+    )
+    key = report_jobs.job_key('rabies_report', [start_date.date(), end_date.date()], report_html)
+    return key, report_html
+
+def submit_report_job(key, report_html):
+    return report_jobs.submit(report_dir(), key, report_html, options=RABIES_PDF_OPTIONS,
+                              workers=app.config['REPORT_WORKERS'], keep=app.config['REPORT_CACHE_KEEP'])
+
+def report_job_response(job):
+    """JSON состояния задания со ссылками на проверку и скачивание"""
+    job = dict(job, status_url=url_for('report_job_status', job_id=job['job_id']))
+    if job['status'] == 'done':
+        job['download_url'] = url_for('report_job_download', job_id=job['job_id'])
+    return job
+
 @app.route('/generate_report', methods=['POST'])
 def generate_report():
     report_type = request.form.get('report_type')
@@ -838,145 +1062,122 @@ def generate_report():
         
         start_date = datetime.strptime(start_date_str, '%Y-%m-%d') 
         end_date = datetime.strptime(end_date_str, '%Y-%m-%d')
-        previous_day = start_date - timedelta(days=1)
-        # Получаем вакцинации от бешенства за период
-        vaccinations = db.session.query(Vaccination, Owner, Pet)\
-            .join(Owner, Vaccination.owner_id == Owner.id)\
-            .join(Pet, Vaccination.pet_id == Pet.id)\
-            .filter(
-                Vaccination.vaccination_type == 'Бешенство',
-                Vaccination.date_administered >= previous_day,
-                Vaccination.date_administered <= end_date
-            )\
-            .order_by(Vaccination.date_administered)\
-            .all()
+        key, report_html = rabies_report_job(start_date, end_date)
         
-        report_data = []
-        for idx, (vacc, owner, pet) in enumerate(vaccinations, 1):
-            prev_vacc = Vaccination.query.filter(
-                Vaccination.pet_id == pet.id,
-                Vaccination.vaccination_type == 'Бешенство',
-                Vaccination.date_administered < vacc.date_administered
-            ).order_by(Vaccination.date_administered.desc()).first()
-            
-            # Получаем возраст на дату вакцинации
-            age_str = pet.vaccination_age(vacc.date_administered)
-            
-            report_data.append({
-                'num': idx,
-                'date': vacc.date_administered.strftime('%d.%m.%Y'),
-                'owner': owner.name,
-                'address': owner.address,
-                'animal': pet.species,
-                'breed': pet.breed,
-                'age': age_str,  # Формат "X г Y м Z д" без нулевых значений
-                'prev_vaccination': prev_vacc.date_administered.strftime('%d.%m.%Y') if prev_vacc else '',
-                'dose': "{}".format(vacc.dose_ml or 1.0)
-            })
-        # Формируем HTML отчета с альбомной ориентацией
-        report_html = render_template(
-            'rabies_report.html',
-            report_data=report_data,
-            start_date=start_date.strftime('%d.%m.%Y'),
-            end_date=end_date.strftime('%d.%m.%Y')
-        )
+        # Готовый PDF для тех же дат и тех же данных отдаётся сразу
+        if report_jobs.status(report_dir(), key)['status'] == 'done':
+            return report_job_download(key)
         
         # Проверяем, доступна ли генерация PDF
-        if config is None:
+        if not pdf_backend.is_available():
             flash('Генерация PDF недоступна. Установите wkhtmltopdf с https://wkhtmltopdf.org/downloads.html', 'error')
             return redirect(url_for('vaccinations'))
         
-        # Параметры для PDF (альбомная ориентация)
-        options = {
-            'page-size': 'A4',
-            'orientation': 'Landscape',
-            'margin-top': '0.5in',
-            'margin-right': '0.5in',
-            'margin-bottom': '0.5in',
-            'margin-left': '0.5in',
-            'encoding': 'UTF-8',
-        }
-        
-        # Генерируем PDF
-        pdf = pdfkit.from_string(report_html, False, configuration=config, options=options)
-        
-        response = make_response(pdf)
-        response.headers['Content-Type'] = 'application/pdf'
-        response.headers['Content-Disposition'] = 'inline; filename=rabies_report_{}_{}.pdf'.format(start_date.date(), end_date.date())
-        return response
+        # PDF создаётся в фоне; страница ожидания сама скачает его по готовности
+        job = submit_report_job(key, report_html)
+        return render_template('report_job.html', job=report_job_response(job))
     
     elif report_type == 'all':
-        from dateutil.relativedelta import relativedelta
-        import io
-        import zipfile
-        from flask import send_file
-
-        # Рассчитываем период 11 месяцев назад
-        current_date = datetime.now()
-        target_date = current_date - relativedelta(months=11)
-        target_month = target_date.month
-        target_year = target_date.year
-
-        # Выбираем вакцинации за целевой месяц
-        vaccinations = Vaccination.query.filter(
-            db.extract('month', Vaccination.date_administered) == target_month,
-            db.extract('year', Vaccination.date_administered) == target_year
-        ).all()
-
-        # Собираем уникальных владельцев
-        owner_ids = {v.owner_id for v in vaccinations}
-        owners = Owner.query.filter(Owner.id.in_(owner_ids)).all()
-
-        # Обрабатываем телефоны
-        correct_phones = []
-        incorrect_phones = []
-        
-        for owner in owners:
-            result = normalize_phone(owner.phone)
-            correct_phones.extend(result['valid'])
-            incorrect_phones.extend(result['invalid'])
-
-        # Сортировка и форматирование
-        correct_phones = sorted(list(set(correct_phones)))
-        incorrect_phones = sorted(list(set(incorrect_phones)))
-
-        # Создаем ZIP архив
-        buffer = io.BytesIO()
-        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            # Файл с корректными номерами
-            if correct_phones:
-                zip_file.writestr(
-                    'correct_phones.txt', 
-                    '\n'.join(correct_phones).encode('utf-8')
-                )
-            
-            # Файл с некорректными номерами
-            if incorrect_phones:
-                zip_file.writestr(
-                    'incorrect_phones.txt', 
-                    '\n'.join(incorrect_phones).encode('utf-8')
-                )
-
-        buffer.seek(0)
-        return send_file(
-            buffer,
-            mimetype='application/zip',
-            as_attachment=True,
-            download_name='vaccination_phones_{}.zip'.format(target_date.strftime('%m_%Y'))
-        )
+        # Период: даты из формы или месяц 11 месяцев назад
+        start_date_str = request.form.get('start_date')
+        end_date_str = request.form.get('end_date')
+        if start_date_str and end_date_str:
+            try:
+                start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date()
+                end_date = datetime.strptime(end_date_str, '%Y-%m-%d').date()
+            except ValueError:
+                flash('Неверный формат даты', 'error')
+                return redirect(url_for('vaccinations'))
+            if start_date > end_date:
+                flash('Дата начала позже даты окончания', 'error')
+                return redirect(url_for('vaccinations'))
+        else:
+            start_date, end_date = phone_export.default_period()
+
+        # Уникальные телефоны владельцев (отсортированные) за период
+        correct_phones, incorrect_phones = phone_export.period_phones(start_date, end_date)
+
+        # ZIP архив отдаётся потоком по мере сжатия
+        archive = phone_export.stream_zip([
+            ('correct_phones.txt', correct_phones),
+            ('incorrect_phones.txt', incorrect_phones),
+        ])
+        return Response(archive, mimetype='application/zip', headers={
+            'Content-Disposition': 'attachment; filename={}'.format(
+                phone_export.export_file_name(start_date, end_date))
+        })
     else:
         flash('Неизвестный тип отчета', 'error')
         return redirect(url_for('vaccinations'))
 
+@app.route('/api/report_jobs', methods=['POST'])
+def create_report_job():
+    """Ставит PDF отчёт по бешенству в очередь: {"start_date": "YYYY-MM-DD", "end_date": "YYYY-MM-DD"}.
+
+    Как и формы приложения, требует CSRF-токен (поле csrf_token или заголовок X-CSRFToken).
+    """
+    data = request.get_json(silent=True) or request.form
+    try:
+        start_date = datetime.strptime(data.get('start_date', ''), '%Y-%m-%d')
+        end_date = datetime.strptime(data.get('end_date', ''), '%Y-%m-%d')
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Даты должны быть в формате YYYY-MM-DD'}), 400
+    if data.get('report_type', 'rabies') != 'rabies':
+        return jsonify({'error': 'Неизвестный тип отчёта'}), 400
+    
+    key, report_html = rabies_report_job(start_date, end_date)
+    job = submit_report_job(key, report_html)
+    if job['status'] == 'failed':
+        return jsonify(report_job_response(job)), 503
+    return jsonify(report_job_response(job)), 200 if job['status'] == 'done' else 202
+
+@app.route('/api/report_jobs/<job_id>')
+def report_job_status(job_id):
+    if not report_jobs.is_valid_key(job_id):
+        abort(404)
+    job = report_jobs.status(report_dir(), job_id)
+    if job['status'] == 'unknown':
+        return jsonify(report_job_response(job)), 404
+    return jsonify(report_job_response(job))
+
+@app.route('/report_jobs/<job_id>/download')
+def report_job_download(job_id):
+    from flask import send_file
+    
+    if not report_jobs.is_valid_key(job_id):
+        abort(404)
+    path = report_jobs.result_path(report_dir(), job_id)
+    if not os.path.exists(path):
+        abort(404)
+    return send_file(path, mimetype='application/pdf', as_attachment=False,
+                     download_name=report_jobs.download_name(job_id))
+
 @app.route('/vaccinations')
 def vaccinations():
     """Страница отчётов"""
     return render_template('vaccinations.html')
 
+def keyset_page(query, order, scope, per_page, filtered=True):
+    """Страница списка по курсору (?cursor=) или номеру (?page=), см. keyset_pagination.py.
+
+    Для списков без фильтров вместо точного COUNT(*) показывается оценка,
+    если не включён PAGINATION_EXACT_COUNT.
+    """
+    total = 'exact'
+    if not filtered and not app.config['PAGINATION_EXACT_COUNT']:
+        total = estimate_rows(db.session, order[-1][0].class_)
+    return KeysetPagination(
+        query, order, app.secret_key, scope,
+        page=request.args.get('page', 1, type=int),
+        cursor=request.args.get('cursor'),
+        per_page=per_page,
+        total=total,
+        numbered_pages=app.config['PAGINATION_NUMBERED_PAGES']
+    )
+
 @app.route('/vaccinations/list')
 def vaccinations_list():
     """Просмотр всех вакцинаций"""
-    page = request.args.get('page', 1, type=int)
     search = request.args.get('search', '')
     
     query = Vaccination.query
@@ -987,7 +1188,10 @@ def vaccinations_list():
             Vaccination.owner_name.ilike('%{}%'.format(search))
         )
     
-    vaccinations = query.order_by(Vaccination.date_administered.desc()).paginate(page=page, per_page=20)
+    vaccinations = keyset_page(
+        query, [(Vaccination.date_administered, True), (Vaccination.id, True)],
+        'vaccinations', per_page=20, filtered=bool(search)
+    )
     
     return render_template('vaccinations_list.html', vaccinations=vaccinations)
 
@@ -1007,8 +1211,7 @@ def new_vaccination():
                 return redirect(request.url)
             
             # Рассчитываем возраст животного
-            today = date.today()
-            pet_age = today.year - pet.birth_date.year - ((today.month, today.day) < (pet.birth_date.month, pet.birth_date.day))
+            pet_age = pet.pet_age()
             
             vaccination = Vaccination(
                 vaccine_name=request.form['vaccine_name'],
@@ -1111,29 +1314,65 @@ def delete_note(note_id):
 
 @app.route('/api/appointments')
 def get_appointments():
-    appointments = Appointment.query.all()
-    events = []
-    
-    for a in appointments:
-        pet = Pet.query.get(a.pet_id)
-        owner = Owner.query.get(a.owner_id)
+    """Лента событий для FullCalendar.
 
-        description = a.description
-        
-        events.append({
-            'id': a.id,
-            'title': "",
-            'start': "{}T{}".format(a.appointment_date, a.time),
-            'end': calculate_end_time(a.appointment_date, a.time, a.duration),
-            'extendedProps': {
-                'card_number': pet.card_number if pet else "N/A",
-                'description': description,
-                'owner_name': owner.name if owner else "Неизвестный владелец",
-                'pet_name': pet.name if pet else "Без имени"
+    FullCalendar передаёт границы видимого диапазона в параметрах start/end
+    (ISO-строки). Приёмы выбираются одним запросом вместе с животным и
+    владельцем, а JSON отдаётся потоком, не собирая весь список в памяти.
+    """
+    start = parse_calendar_bound(request.args.get('start'))
+    end = parse_calendar_bound(request.args.get('end'))
+
+    query = db.session.query(
+        Appointment.id,
+        Appointment.appointment_date,
+        Appointment.time,
+        Appointment.duration,
+        Appointment.description,
+        Pet.card_number,
+        Pet.name.label('pet_name'),
+        Owner.name.label('owner_name')
+    ).outerjoin(Pet, Appointment.pet_id == Pet.id)\
+     .outerjoin(Owner, Appointment.owner_id == Owner.id)
+
+    # appointment_date хранится строкой 'YYYY-MM-DD', поэтому сравниваем строки
+    if start:
+        query = query.filter(Appointment.appointment_date >= start)
+    if end:
+        query = query.filter(Appointment.appointment_date < end)
+
+    query = query.order_by(Appointment.appointment_date, Appointment.time)
+
+    def generate():
+        yield '['
+        first = True
+        for row in query.yield_per(500):
+            event = {
+                'id': row.id,
+                'title': "",
+                'start': "{}T{}".format(row.appointment_date, row.time),
+                'end': calculate_end_time(row.appointment_date, row.time, row.duration),
+                'extendedProps': {
+                    'card_number': row.card_number if row.card_number else "N/A",
+                    'description': row.description,
+                    'owner_name': row.owner_name if row.owner_name else "Неизвестный владелец",
+                    'pet_name': row.pet_name if row.pet_name else "Без имени"
+                }
             }
-        })
-    
-    return jsonify(events)
+            yield ('' if first else ',') + json.dumps(event, ensure_ascii=False)
+            first = False
+        yield ']'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+def parse_calendar_bound(value):
+    """Приводит границу диапазона FullCalendar к виду 'YYYY-MM-DD'."""
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value[:10], '%Y-%m-%d').strftime('%Y-%m-%d')
+    except ValueError:
+        return None
 
 def calculate_end_time(appointment_date, start_time, duration):
     """Функция для вычисления времени окончания приёма."""
@@ -1166,7 +1405,7 @@ def appointment_delete(appointment_id):
     
     try:
         # Удаляем все связанные назначения
-        AppointmentTreatment.query.filter_by(appointment_id=appointment_id).delete()
+        delete_appointment_treatments(appointment_id)
         
         # Удаляем сам приём
         db.session.delete(appointment)
@@ -1287,9 +1526,38 @@ def update_appointment(appointment_id):
     db.session.commit()
     return jsonify({'success': True})
 
+# Кэш данных страницы статистики: результат зависит только от параметров запроса и текущей даты.
+# Хранятся только данные графиков, сама страница (с flash-сообщениями) рисуется на каждый запрос
+statistics_cache = ResponseCache(
+    maxsize=app.config.get('STATISTICS_CACHE_SIZE', 32),
+    ttl=app.config.get('STATISTICS_CACHE_TTL', 300)
+)
+statistics_cache.invalidate_on(Vaccination, Appointment, AppointmentTreatment,
+                               Pet, Owner, Treatment)
+
 @app.route('/statistics')
 def statistics():
     """Страница статистики с графиками по вакцинациям, возрасту и виду животных"""
+    cache_key = (
+        request.args.get('period', 'year'),
+        request.args.get('compare', 'false').lower(),
+        request.args.get('vaccine_month', type=int),
+        request.args.get('vaccine_year', type=int),
+        datetime.now().date()
+    )
+    context = statistics_cache.get(cache_key)
+    if context is None:
+        context = statistics_context()
+        statistics_cache.set(cache_key, context)
+    return render_template('statistics.html', **context)
+
+@app.route('/api/statistics_cache')
+def statistics_cache_stats():
+    """Счётчики попаданий кэша страницы статистики"""
+    return jsonify(statistics_cache.stats())
+
+def statistics_context():
+    """Расчёт данных страницы статистики без кэша"""
     from sqlalchemy import func, extract, case, and_, or_
     
     # Получаем параметры фильтрации
@@ -1323,62 +1591,76 @@ def statistics():
         prev_start_date = None
         prev_end_date = None
     
+    # Применяем изменения, накопленные с последнего обновления снимка
+    refresh_statistics_snapshot()
+
+    S = StatisticsSnapshot
+
+    def monthly(metric, value, date_from=None, date_to=None):
+        """Сумма value по месяцам для метрики за период [date_from, date_to)"""
+        query = db.session.query(S.month, S.year, func.sum(value).label('value'))\
+            .filter(S.metric == metric)
+        if date_from:
+            query = query.filter(S.day >= date_from)
+        if date_to:
+            query = query.filter(S.day < date_to)
+        return query.group_by(S.year, S.month).order_by(S.year, S.month).all()
+
+    def total(metric, value, date_from=None):
+        query = db.session.query(func.sum(value)).filter(S.metric == metric)
+        if date_from:
+            query = query.filter(S.day >= date_from)
+        return query.scalar() or 0
+
+    def yearly(metric, *values):
+        rows = db.session.query(S.year, *[func.sum(v) for v in values])\
+            .filter(S.metric == metric, S.year.in_(years_list))\
+            .group_by(S.year).all()
+        return {int(row[0]): row[1:] for row in rows}
+
+    current_year = current_date.year
+    years_list = list(range(current_year - 4, current_year + 1))  # Последние 5 лет
+    treatment_id = db.cast(S.dimension, db.Integer)
+
     # === ОСНОВНАЯ СТАТИСТИКА ===
     
     # Статистика по вакцинациям по месяцам
-    vaccination_stats = db.session.query(
-        extract('month', Vaccination.date_administered).label('month'),
-        extract('year', Vaccination.date_administered).label('year'),
-        func.count(Vaccination.id).label('count')
-    ).filter(
-        Vaccination.date_administered >= start_date
-    ).group_by(
-        extract('month', Vaccination.date_administered),
-        extract('year', Vaccination.date_administered)
-    ).order_by(
-        extract('year', Vaccination.date_administered),
-        extract('month', Vaccination.date_administered)
-    ).all()
     vaccination_stats = [
         {
             'month': int(row.month),
             'year': int(row.year),
-            'count': int(row.count)
-        } for row in vaccination_stats
+            'count': int(row.value)
+        } for row in monthly('vaccination', S.count, start_date)
     ]
     
     # Статистика по типам вакцинаций (за всё время)
     vaccination_types = db.session.query(
-        Vaccination.vaccination_type,
-        func.count(Vaccination.id).label('count')
-    ).group_by(Vaccination.vaccination_type).all()
+        S.dimension,
+        func.sum(S.count).label('count')
+    ).filter(S.metric == 'vaccination').group_by(S.dimension).all()
     vaccination_types = [
         {
-            'vaccination_type': row.vaccination_type or 'Не указано',
+            'vaccination_type': row.dimension or 'Не указано',
             'count': int(row.count)
         } for row in vaccination_types
     ]
     
     # Статистика по типам вакцинаций по месяцам (за всё время)
     vaccination_types_monthly = db.session.query(
-        extract('month', Vaccination.date_administered).label('month'),
-        extract('year', Vaccination.date_administered).label('year'),
-        Vaccination.vaccination_type,
-        func.count(Vaccination.id).label('count')
-    ).group_by(
-        extract('month', Vaccination.date_administered),
-        extract('year', Vaccination.date_administered),
-        Vaccination.vaccination_type
+        S.month,
+        S.year,
+        S.dimension,
+        func.sum(S.count).label('count')
+    ).filter(S.metric == 'vaccination').group_by(
+        S.year, S.month, S.dimension
     ).order_by(
-        extract('year', Vaccination.date_administered),
-        extract('month', Vaccination.date_administered),
-        Vaccination.vaccination_type
+        S.year, S.month, S.dimension
     ).all()
     vaccination_types_monthly = [
         {
             'month': int(row.month),
             'year': int(row.year),
-            'vaccination_type': row.vaccination_type or 'Не указано',
+            'vaccination_type': row.dimension or 'Не указано',
             'count': int(row.count)
         } for row in vaccination_types_monthly
     ]
@@ -1430,47 +1712,21 @@ def statistics():
     # === СТАТИСТИКА ПО ПРИЁМАМ ===
     
     # Статистика по приёмам по месяцам
-    appointment_stats = db.session.query(
-        extract('month', Appointment.appointment_date).label('month'),
-        extract('year', Appointment.appointment_date).label('year'),
-        func.count(Appointment.id).label('count')
-    ).filter(
-        Appointment.appointment_date >= start_date.strftime('%Y-%m-%d')
-    ).group_by(
-        extract('month', Appointment.appointment_date),
-        extract('year', Appointment.appointment_date)
-    ).order_by(
-        extract('year', Appointment.appointment_date),
-        extract('month', Appointment.appointment_date)
-    ).all()
     appointment_stats = [
         {
             'month': int(row.month),
             'year': int(row.year),
-            'count': int(row.count)
-        } for row in appointment_stats
+            'count': int(row.value)
+        } for row in monthly('appointment', S.count, start_date)
     ]
     
     # Статистика по стоимости приёмов
-    appointment_costs = db.session.query(
-        extract('month', Appointment.appointment_date).label('month'),
-        extract('year', Appointment.appointment_date).label('year'),
-        func.sum(AppointmentTreatment.total_price).label('total_cost')
-    ).join(AppointmentTreatment).filter(
-        Appointment.appointment_date >= start_date.strftime('%Y-%m-%d')
-    ).group_by(
-        extract('month', Appointment.appointment_date),
-        extract('year', Appointment.appointment_date)
-    ).order_by(
-        extract('year', Appointment.appointment_date),
-        extract('month', Appointment.appointment_date)
-    ).all()
     appointment_costs = [
         {
             'month': int(row.month),
             'year': int(row.year),
-            'total_cost': float(row.total_cost or 0)
-        } for row in appointment_costs
+            'total_cost': float(row.value or 0)
+        } for row in monthly('treatment', S.total, start_date)
     ]
     
     
@@ -1478,12 +1734,13 @@ def statistics():
     popular_treatments = db.session.query(
         Treatment.name,
         Treatment.category,
-        func.count(AppointmentTreatment.id).label('count'),
-        func.sum(AppointmentTreatment.total_price).label('total_revenue')
-    ).join(AppointmentTreatment).join(Appointment).filter(
-        Appointment.appointment_date >= start_date.strftime('%Y-%m-%d')
+        func.sum(S.count).label('count'),
+        func.sum(S.total).label('total_revenue')
+    ).join(Treatment, Treatment.id == treatment_id).filter(
+        S.metric == 'treatment',
+        S.day >= start_date
     ).group_by(Treatment.id, Treatment.name, Treatment.category).order_by(
-        func.count(AppointmentTreatment.id).desc()
+        func.sum(S.count).desc()
     ).limit(15).all()
     popular_treatments = [
         {
@@ -1497,10 +1754,11 @@ def statistics():
     # Статистика по категориям услуг
     treatment_categories = db.session.query(
         Treatment.category,
-        func.count(AppointmentTreatment.id).label('count'),
-        func.sum(AppointmentTreatment.total_price).label('total_revenue')
-    ).join(AppointmentTreatment).join(Appointment).filter(
-        Appointment.appointment_date >= start_date.strftime('%Y-%m-%d')
+        func.sum(S.count).label('count'),
+        func.sum(S.total).label('total_revenue')
+    ).join(Treatment, Treatment.id == treatment_id).filter(
+        S.metric == 'treatment',
+        S.day >= start_date
     ).group_by(Treatment.category).all()
     
     # Функция для перевода категорий на русский
@@ -1538,93 +1796,46 @@ def statistics():
     
     if compare_with_previous and prev_start_date and prev_end_date:
         # Предыдущий период - вакцинации
-        prev_vaccination_stats = db.session.query(
-            extract('month', Vaccination.date_administered).label('month'),
-            extract('year', Vaccination.date_administered).label('year'),
-            func.count(Vaccination.id).label('count')
-        ).filter(
-            Vaccination.date_administered >= prev_start_date,
-            Vaccination.date_administered < prev_end_date
-        ).group_by(
-            extract('month', Vaccination.date_administered),
-            extract('year', Vaccination.date_administered)
-        ).order_by(
-            extract('year', Vaccination.date_administered),
-            extract('month', Vaccination.date_administered)
-        ).all()
         prev_vaccination_stats = [
             {
                 'month': int(row.month),
                 'year': int(row.year),
-                'count': int(row.count)
-            } for row in prev_vaccination_stats
+                'count': int(row.value)
+            } for row in monthly('vaccination', S.count, prev_start_date, prev_end_date)
         ]
         
         # Предыдущий период - приёмы
-        prev_appointment_stats = db.session.query(
-            extract('month', Appointment.appointment_date).label('month'),
-            extract('year', Appointment.appointment_date).label('year'),
-            func.count(Appointment.id).label('count')
-        ).filter(
-            Appointment.appointment_date >= prev_start_date.strftime('%Y-%m-%d'),
-            Appointment.appointment_date < prev_end_date.strftime('%Y-%m-%d')
-        ).group_by(
-            extract('month', Appointment.appointment_date),
-            extract('year', Appointment.appointment_date)
-        ).order_by(
-            extract('year', Appointment.appointment_date),
-            extract('month', Appointment.appointment_date)
-        ).all()
         prev_appointment_stats = [
             {
                 'month': int(row.month),
                 'year': int(row.year),
-                'count': int(row.count)
-            } for row in prev_appointment_stats
+                'count': int(row.value)
+            } for row in monthly('appointment', S.count, prev_start_date, prev_end_date)
         ]
         
         # Предыдущий период - доходы
-        prev_appointment_costs = db.session.query(
-            extract('month', Appointment.appointment_date).label('month'),
-            extract('year', Appointment.appointment_date).label('year'),
-            func.sum(AppointmentTreatment.total_price).label('total_cost')
-        ).join(AppointmentTreatment).filter(
-            Appointment.appointment_date >= prev_start_date.strftime('%Y-%m-%d'),
-            Appointment.appointment_date < prev_end_date.strftime('%Y-%m-%d')
-        ).group_by(
-            extract('month', Appointment.appointment_date),
-            extract('year', Appointment.appointment_date)
-        ).order_by(
-            extract('year', Appointment.appointment_date),
-            extract('month', Appointment.appointment_date)
-        ).all()
         prev_appointment_costs = [
             {
                 'month': int(row.month),
                 'year': int(row.year),
-                'total_cost': float(row.total_cost or 0)
-            } for row in prev_appointment_costs
+                'total_cost': float(row.value or 0)
+            } for row in monthly('treatment', S.total, prev_start_date, prev_end_date)
         ]
     
     # === ОБЩАЯ СТАТИСТИКА ===
     total_pets = Pet.query.count()
     total_owners = Owner.query.count()
-    total_vaccinations = Vaccination.query.count()
-    total_appointments = Appointment.query.count()
+    total_vaccinations = int(total('vaccination', S.count))
+    total_appointments = int(total('appointment', S.count))
     
     # Статистика за период
-    period_vaccinations = Vaccination.query.filter(Vaccination.date_administered >= start_date).count()
-    period_appointments = Appointment.query.filter(Appointment.appointment_date >= start_date.strftime('%Y-%m-%d')).count()
-    
-    # Средний чек
-    avg_check = db.session.query(func.avg(AppointmentTreatment.total_price)).join(Appointment).filter(
-        Appointment.appointment_date >= start_date.strftime('%Y-%m-%d')
-    ).scalar() or 0
+    period_vaccinations = int(total('vaccination', S.count, start_date))
+    period_appointments = int(total('appointment', S.count, start_date))
     
-    # Общий доход за период
-    total_revenue = db.session.query(func.sum(AppointmentTreatment.total_price)).join(Appointment).filter(
-        Appointment.appointment_date >= start_date.strftime('%Y-%m-%d')
-    ).scalar() or 0
+    # Средний чек и общий доход за период
+    period_treatments = total('treatment', S.count, start_date)
+    total_revenue = total('treatment', S.total, start_date)
+    avg_check = total_revenue / period_treatments if period_treatments else 0
     
     # === СТАТИСТИКА ПО ВАКЦИНАМ ЗА ВЫБРАННЫЙ МЕСЯЦ ===
     
@@ -1641,53 +1852,51 @@ def statistics():
     last_month_name = "{} {}".format(month_names_ru[selected_vaccine_month], selected_vaccine_year)
     
     # Получаем список доступных годов из базы данных
-    vaccine_years_query = db.session.query(
-        func.distinct(extract('year', Vaccination.date_administered)).label('year')
-    ).order_by(extract('year', Vaccination.date_administered).desc()).all()
+    vaccine_years_query = db.session.query(S.year).filter(
+        S.metric == 'vaccination'
+    ).distinct().order_by(S.year.desc()).all()
     vaccine_years = [int(row.year) for row in vaccine_years_query if row.year]
     
     # Если нет данных, добавляем текущий год
     if not vaccine_years:
         vaccine_years = [current_date.year]
     
-    # Определяем границы выбранного месяца
-    from calendar import monthrange
-    _, last_day = monthrange(selected_vaccine_year, selected_vaccine_month)
     month_start = date(selected_vaccine_year, selected_vaccine_month, 1)
-    month_end = date(selected_vaccine_year, selected_vaccine_month, last_day)
     
     # Подсчёт вакцинаций по типам за выбранный месяц
     last_month_vaccinations = db.session.query(
-        Vaccination.vaccination_type,
-        func.count(Vaccination.id).label('count')
+        S.dimension,
+        func.sum(S.count).label('count')
     ).filter(
-        Vaccination.date_administered >= month_start,
-        Vaccination.date_administered <= month_end
-    ).group_by(Vaccination.vaccination_type).all()
+        S.metric == 'vaccination',
+        S.year == selected_vaccine_year,
+        S.month == selected_vaccine_month
+    ).group_by(S.dimension).all()
     
     last_month_vaccinations = [
         {
-            'vaccination_type': row.vaccination_type or 'Не указано',
+            'vaccination_type': row.dimension or 'Не указано',
             'count': int(row.count)
         } for row in last_month_vaccinations
     ]
     
     # Подсчёт по названиям вакцин за выбранный месяц
     last_month_vaccines_detail = db.session.query(
-        Vaccination.vaccine_name,
-        Vaccination.vaccination_type,
-        func.count(Vaccination.id).label('count')
+        S.detail,
+        S.dimension,
+        func.sum(S.count).label('count')
     ).filter(
-        Vaccination.date_administered >= month_start,
-        Vaccination.date_administered <= month_end
-    ).group_by(Vaccination.vaccine_name, Vaccination.vaccination_type).order_by(
-        func.count(Vaccination.id).desc()
+        S.metric == 'vaccination',
+        S.year == selected_vaccine_year,
+        S.month == selected_vaccine_month
+    ).group_by(S.detail, S.dimension).order_by(
+        func.sum(S.count).desc()
     ).all()
     
     last_month_vaccines_detail = [
         {
-            'vaccine_name': row.vaccine_name or 'Не указано',
-            'vaccination_type': row.vaccination_type or 'Не указано',
+            'vaccine_name': row.detail or 'Не указано',
+            'vaccination_type': row.dimension or 'Не указано',
             'count': int(row.count)
         } for row in last_month_vaccines_detail
     ]
@@ -1695,100 +1904,33 @@ def statistics():
     last_month_date = month_start
     
     # === СТАТИСТИКА ПО ГОДАМ ЗА ПОСЛЕДНИЕ 5 ЛЕТ ===
-    current_year = current_date.year
-    years_list = list(range(current_year - 4, current_year + 1))  # Последние 5 лет
     
     # Статистика по животным по годам (по дате первого приёма или первой вакцинации)
-    # Для каждого животного находим минимальную дату приёма
-    first_appointment_dates = db.session.query(
-        Appointment.pet_id,
-        func.min(Appointment.appointment_date).label('first_date')
-    ).group_by(Appointment.pet_id).subquery()
-    
-    yearly_pets = db.session.query(
-        extract('year', first_appointment_dates.c.first_date).label('year'),
-        func.count(first_appointment_dates.c.pet_id).label('count')
-    ).filter(
-        extract('year', first_appointment_dates.c.first_date).in_(years_list)
-    ).group_by(extract('year', first_appointment_dates.c.first_date)).all()
-    
-    yearly_pets_dict = {int(row.year): int(row.count) for row in yearly_pets}
-    
-    # Добавляем животных, у которых есть только вакцинации (без приёмов)
-    pets_with_appointments = db.session.query(Appointment.pet_id).distinct()
-    
-    first_vacc_dates = db.session.query(
-        Vaccination.pet_id,
-        func.min(Vaccination.date_administered).label('first_date')
-    ).filter(
-        ~Vaccination.pet_id.in_(pets_with_appointments)
-    ).group_by(Vaccination.pet_id).subquery()
-    
-    pets_with_only_vacc = db.session.query(
-        extract('year', first_vacc_dates.c.first_date).label('year'),
-        func.count(first_vacc_dates.c.pet_id).label('count')
-    ).filter(
-        extract('year', first_vacc_dates.c.first_date).in_(years_list)
-    ).group_by(extract('year', first_vacc_dates.c.first_date)).all()
-    
-    for row in pets_with_only_vacc:
-        year = int(row.year)
-        yearly_pets_dict[year] = yearly_pets_dict.get(year, 0) + int(row.count)
-    
+    yearly_pets_dict = yearly('new_pet', S.count)
     yearly_pets_stats = [
-        {'year': year, 'count': yearly_pets_dict.get(year, 0)} 
+        {'year': year, 'count': int(yearly_pets_dict.get(year, (0,))[0])} 
         for year in years_list
     ]
     
     # Статистика по приёмам по годам
-    yearly_appointments = db.session.query(
-        extract('year', Appointment.appointment_date).label('year'),
-        func.count(Appointment.id).label('count')
-    ).filter(
-        extract('year', Appointment.appointment_date).in_(years_list)
-    ).group_by(extract('year', Appointment.appointment_date)).all()
-    
-    yearly_appointments_dict = {int(row.year): int(row.count) for row in yearly_appointments}
+    yearly_appointments_dict = yearly('appointment', S.count)
     yearly_appointments_stats = [
-        {'year': year, 'count': yearly_appointments_dict.get(year, 0)} 
+        {'year': year, 'count': int(yearly_appointments_dict.get(year, (0,))[0])} 
         for year in years_list
     ]
     
     # Статистика по вакцинациям по годам
-    yearly_vaccinations = db.session.query(
-        extract('year', Vaccination.date_administered).label('year'),
-        func.count(Vaccination.id).label('count')
-    ).filter(
-        extract('year', Vaccination.date_administered).in_(years_list)
-    ).group_by(extract('year', Vaccination.date_administered)).all()
-    
-    yearly_vaccinations_dict = {int(row.year): int(row.count) for row in yearly_vaccinations}
+    yearly_vaccinations_dict = yearly('vaccination', S.count)
     yearly_vaccinations_stats = [
-        {'year': year, 'count': yearly_vaccinations_dict.get(year, 0)} 
+        {'year': year, 'count': int(yearly_vaccinations_dict.get(year, (0,))[0])} 
         for year in years_list
     ]
     
     # Статистика по вакцинациям по месяцам за последние 5 лет
-    five_years_ago = date(current_year - 4, 1, 1)
-    monthly_vaccinations = db.session.query(
-        extract('year', Vaccination.date_administered).label('year'),
-        extract('month', Vaccination.date_administered).label('month'),
-        func.count(Vaccination.id).label('count')
-    ).filter(
-        Vaccination.date_administered >= five_years_ago
-    ).group_by(
-        extract('year', Vaccination.date_administered),
-        extract('month', Vaccination.date_administered)
-    ).order_by(
-        extract('year', Vaccination.date_administered),
-        extract('month', Vaccination.date_administered)
-    ).all()
-    
-    # Создаем словарь для быстрого доступа
-    monthly_vaccinations_dict = {}
-    for row in monthly_vaccinations:
-        key = "{}-{:02d}".format(int(row.year), int(row.month))
-        monthly_vaccinations_dict[key] = int(row.count)
+    monthly_vaccinations_dict = {
+        "{}-{:02d}".format(int(row.year), int(row.month)): int(row.value)
+        for row in monthly('vaccination', S.count, date(current_year - 4, 1, 1))
+    }
     
     # Создаем полный список всех месяцев за последние 5 лет
     monthly_vaccinations_full = []
@@ -1804,111 +1946,85 @@ def statistics():
                     'label': "{:02d}.{}".format(month, year)
                 })
     
-    # Статистика по доходам по годам
-    yearly_revenue = db.session.query(
-        extract('year', Appointment.appointment_date).label('year'),
-        func.sum(AppointmentTreatment.total_price).label('total_revenue')
-    ).join(AppointmentTreatment).filter(
-        extract('year', Appointment.appointment_date).in_(years_list)
-    ).group_by(extract('year', Appointment.appointment_date)).all()
-    
-    yearly_revenue_dict = {int(row.year): float(row.total_revenue or 0) for row in yearly_revenue}
-    yearly_revenue_stats = [
-        {'year': year, 'total_revenue': yearly_revenue_dict.get(year, 0)} 
-        for year in years_list
-    ]
-    
-    # Средний чек по годам
+    # Статистика по доходам и средний чек по годам
+    yearly_treatments_dict = yearly('treatment', S.count, S.total)
+    yearly_revenue_stats = []
     yearly_avg_check = []
     for year in years_list:
-        year_avg = db.session.query(
-            func.avg(AppointmentTreatment.total_price)
-        ).join(Appointment).filter(
-            extract('year', Appointment.appointment_date) == year
-        ).scalar() or 0
+        count, revenue = yearly_treatments_dict.get(year, (0, 0))
+        yearly_revenue_stats.append({'year': year, 'total_revenue': float(revenue or 0)})
         yearly_avg_check.append({
             'year': year,
-            'avg_check': float(year_avg)
+            'avg_check': float(revenue / count) if count else 0.0
         })
     
     # Общее количество животных на конец каждого года (накопленное)
     # Используем дату первого приёма или первой вакцинации как дату регистрации
+    first_seen_by_year = db.session.query(S.year, func.sum(S.count)).filter(
+        S.metric == 'first_seen_pet',
+        S.year <= years_list[-1]
+    ).group_by(S.year).all()
+    first_seen_by_year = {int(year): int(count) for year, count in first_seen_by_year}
+    registered_before = sum(count for year, count in first_seen_by_year.items() if year < years_list[0])
     yearly_total_pets = []
     for year in years_list:
-        year_end = date(year, 12, 31)
-        year_end_str = year_end.strftime('%Y-%m-%d')
-        
-        # Находим уникальных животных, у которых был хотя бы один приём до конца года
-        pets_with_appts = db.session.query(Appointment.pet_id).distinct().filter(
-            Appointment.appointment_date <= year_end_str
-        ).subquery()
-        
-        # Находим животных без приёмов, у которых была хотя бы одна вакцинация до конца года
-        pets_with_vacc_only = db.session.query(Vaccination.pet_id).distinct().filter(
-            Vaccination.date_administered <= year_end_str,
-            ~Vaccination.pet_id.in_(db.session.query(pets_with_appts.c.pet_id))
-        ).subquery()
-        
-        # Считаем общее количество уникальных животных
-        total_appts = db.session.query(func.count(func.distinct(pets_with_appts.c.pet_id))).scalar() or 0
-        total_vacc_only = db.session.query(func.count(func.distinct(pets_with_vacc_only.c.pet_id))).scalar() or 0
-        total = total_appts + total_vacc_only
-        
+        registered_before += first_seen_by_year.get(year, 0)
         yearly_total_pets.append({
             'year': year,
-            'total': int(total)
+            'total': registered_before
         })
     
-    return render_template('statistics.html',
-                         # Основные данные
-                         vaccination_stats=vaccination_stats,
-                         vaccination_types=vaccination_types,
-                         vaccination_types_monthly=vaccination_types_monthly,
-                         species_stats=species_stats,
-                         age_stats=age_stats,
-                         appointment_stats=appointment_stats,
-                         appointment_costs=appointment_costs,
-                         popular_treatments=popular_treatments,
-                         treatment_categories=treatment_categories,
-                         
-                         # Сравнение с предыдущим периодом
-                         prev_vaccination_stats=prev_vaccination_stats,
-                         prev_appointment_stats=prev_appointment_stats,
-                         prev_appointment_costs=prev_appointment_costs,
-                         
-                         # Общая статистика
-                         total_pets=total_pets,
-                         total_owners=total_owners,
-                         total_vaccinations=total_vaccinations,
-                         total_appointments=total_appointments,
-                         period_vaccinations=period_vaccinations,
-                         period_appointments=period_appointments,
-                         avg_check=float(avg_check),
-                         total_revenue=float(total_revenue),
-                         
-                         # Статистика по вакцинам за последний месяц
-                         last_month_vaccinations=last_month_vaccinations,
-                         last_month_vaccines_detail=last_month_vaccines_detail,
-                         last_month_date=last_month_date,
-                         last_month_name=last_month_name,
-                         vaccine_years=vaccine_years,
-                         selected_vaccine_month=selected_vaccine_month,
-                         selected_vaccine_year=selected_vaccine_year,
-                         
-                         # Параметры фильтрации
-                         period=period,
-                         period_name=period_name,
-                         compare_with_previous=compare_with_previous,
-                         
-                         # Статистика по годам
-                         yearly_pets_stats=yearly_pets_stats,
-                         yearly_appointments_stats=yearly_appointments_stats,
-                         yearly_vaccinations_stats=yearly_vaccinations_stats,
-                         monthly_vaccinations_full=monthly_vaccinations_full,
-                         yearly_revenue_stats=yearly_revenue_stats,
-                         yearly_avg_check=yearly_avg_check,
-                         yearly_total_pets=yearly_total_pets,
-                         years_list=years_list)
+    return dict(
+        # Основные данные
+        vaccination_stats=vaccination_stats,
+        vaccination_types=vaccination_types,
+        vaccination_types_monthly=vaccination_types_monthly,
+        species_stats=species_stats,
+        age_stats=age_stats,
+        appointment_stats=appointment_stats,
+        appointment_costs=appointment_costs,
+        popular_treatments=popular_treatments,
+        treatment_categories=treatment_categories,
+        
+        # Сравнение с предыдущим периодом
+        prev_vaccination_stats=prev_vaccination_stats,
+        prev_appointment_stats=prev_appointment_stats,
+        prev_appointment_costs=prev_appointment_costs,
+        
+        # Общая статистика
+        total_pets=total_pets,
+        total_owners=total_owners,
+        total_vaccinations=total_vaccinations,
+        total_appointments=total_appointments,
+        period_vaccinations=period_vaccinations,
+        period_appointments=period_appointments,
+        avg_check=float(avg_check),
+        total_revenue=float(total_revenue),
+        
+        # Статистика по вакцинам за последний месяц
+        last_month_vaccinations=last_month_vaccinations,
+        last_month_vaccines_detail=last_month_vaccines_detail,
+        last_month_date=last_month_date,
+        last_month_name=last_month_name,
+        vaccine_years=vaccine_years,
+        selected_vaccine_month=selected_vaccine_month,
+        selected_vaccine_year=selected_vaccine_year,
+        
+        # Параметры фильтрации
+        period=period,
+        period_name=period_name,
+        compare_with_previous=compare_with_previous,
+        
+        # Статистика по годам
+        yearly_pets_stats=yearly_pets_stats,
+        yearly_appointments_stats=yearly_appointments_stats,
+        yearly_vaccinations_stats=yearly_vaccinations_stats,
+        monthly_vaccinations_full=monthly_vaccinations_full,
+        yearly_revenue_stats=yearly_revenue_stats,
+        yearly_avg_check=yearly_avg_check,
+        yearly_total_pets=yearly_total_pets,
+        years_list=years_list
+    )
 
 @app.route('/settings')
 def settings():
@@ -1962,11 +2078,12 @@ def search_owners():
     if not search_term:
         return jsonify([])
     
-    # Преобразуем поисковый запрос к верхнему регистру для сравнения, так как в БД имена хранятся в верхнем регистре
-    # Используем func.upper() для надежного регистронезависимого поиска
-    owners = Owner.query.filter(
-        db.func.upper(Owner.name).like('%{}%'.format(search_term.upper()))
-    ).limit(10).all()
+    # Поиск по началу слов ФИО через полнотекстовый индекс (регистр не важен)
+    expression = match_expression(search_term, ['name'])
+    if not expression:
+        return jsonify([])
+    ensure_search_index()
+    owners = ranked(Owner.query, Owner, expression).limit(10).all()
     
     return jsonify([{'id': o.id, 'text': o.name} for o in owners])
 
@@ -1994,14 +2111,13 @@ def add_owner():
 
 @app.route('/owner/<int:owner_id>', methods=['GET', 'POST'])
 def owner_card(owner_id):
-    page = request.args.get('page', 1, type=int)
     card_number = request.args.get('card_number', '').strip()
     highlight_pet = request.args.get('highlight', type=int)
     
     owner = Owner.query.get_or_404(owner_id)
     
     # Базовый запрос для животных владельца
-    pets_query = Pet.query.filter_by(owner_id=owner_id).order_by(Pet.name)
+    pets_query = Pet.query.filter_by(owner_id=owner_id).order_by(Pet.name, Pet.id)
     
     # Если указан номер карточки для поиска
     if card_number:
@@ -2017,7 +2133,8 @@ def owner_card(owner_id):
                 pass
     
     # Пагинация с учетом возможного фильтра
-    pagination = pets_query.paginate(page=page, per_page=10, error_out=False)
+    pagination = keyset_page(pets_query, [(Pet.name, False), (Pet.id, False)],
+                             'owner_pets', per_page=10)
     
     if request.method == 'POST':
         try:
@@ -2052,16 +2169,12 @@ def search_owners_for_transfer():
     if not query:
         return jsonify([])
     
-    # Ищем по имени, телефону или адресу с более подробной информацией
-    # Для имени используем func.upper() так как в БД имена хранятся в верхнем регистре
-    query_upper = query.upper()
-    owners = Owner.query.filter(
-        db.or_(
-            db.func.upper(Owner.name).like('%{}%'.format(query_upper)),
-            Owner.phone.ilike('%{}%'.format(query)),
-            Owner.address.ilike('%{}%'.format(query))
-        )
-    ).limit(20).all()
+    # Ищем по имени, адресу (начала слов) или началу номера телефона
+    expression = any_of(match_expression(query, ['name', 'address']), phone_expression(query))
+    if not expression:
+        return jsonify([])
+    ensure_search_index()
+    owners = ranked(Owner.query, Owner, expression).limit(20).all()
     
     return jsonify([{
         'id': owner.id,
@@ -2091,7 +2204,6 @@ def change_pet_owner(pet_id):
 
 @app.route('/problematic_owners')
 def problematic_owners():
-    page = request.args.get('page', 1, type=int)
     per_page = 10
 
     # Основной запрос
@@ -2122,8 +2234,8 @@ def problematic_owners():
         )
     )
 
-    owners_pagination = query.order_by(Owner.name)\
-                           .paginate(page=page, per_page=per_page, error_out=False)
+    owners_pagination = keyset_page(query, [(Owner.name, False), (Owner.id, False)],
+                                    'problematic_owners', per_page=per_page)
 
     # Передадим в шаблон информацию о дублях и старых животных
     problematic_owner_ids = {
@@ -2144,7 +2256,6 @@ def problematic_owners():
 
 @app.route('/owners')
 def owners_list():
-    page = request.args.get('page', 1, type=int)
     per_page = 10
 
     search_name = request.args.get('search_name', '').strip().upper()
@@ -2153,39 +2264,45 @@ def owners_list():
     search_phone = request.args.get('search_phone', '').strip()
     search_address = request.args.get('search_address', '').strip().upper()
 
-    query = db.session.query(Owner).outerjoin(Pet).distinct()
-    #query = db.session.query(Owner).options(selectinload(Owner.pets))
+    # Условия на животных - подзапросом по owner_id: без JOIN и DISTINCT список
+    # идёт по индексу ix_owner_name, и страницы выбираются по ключу (name, id)
+    query = db.session.query(Owner).options(selectinload(Owner.pets))
+    pet_conditions = []
 
+    if search_name or search_pet or search_address:
+        ensure_search_index()
 
     if search_name:
         # Разбиваем поисковый запрос на части (фамилия, имя)
         search_parts = search_name.split()[:2]  # Берем только первые два слова
         
-        # Создаем условия для поиска по фамилии и имени (без отчества)
-        conditions = []
-        for part in search_parts:
-            # Ищем в начале строки (фамилия) или после пробела (имя)
-            conditions.append(db.or_(
-                Owner.name.ilike('{} %'.format(part)),  # Фамилия в начале
-                Owner.name.ilike('% {} %'.format(part)), # Имя в середине
-                Owner.name.ilike('% {}'.format(part))    # Имя в конце (если нет отчества)
-            ))
-        
-        # Объединяем условия через AND (и фамилия, и имя должны совпадать)
-        query = query.filter(db.and_(*conditions))
+        # Каждое слово ищется как начало слова в ФИО; и фамилия, и имя должны совпадать
+        expression = match_expression(' '.join(search_parts), ['name'])
+        if expression:
+            query = query.filter(Owner.id.in_(matching_ids(Owner, expression)))
     
     if search_pet:
-        query = query.filter(Pet.name.ilike('%{}%'.format(search_pet)))
+        expression = match_expression(search_pet, ['name'])
+        if expression:
+            pet_conditions.append(Pet.id.in_(matching_ids(Pet, expression)))
     if search_card:
-        query = query.filter(Pet.card_number == search_card)
+        pet_conditions.append(Pet.card_number == search_card)
+    if pet_conditions:
+        query = query.filter(Owner.id.in_(db.select(Pet.owner_id).where(*pet_conditions)))
     if search_phone:
-        phone_digits = ''.join(filter(str.isdigit, search_phone))
-        query = query.filter(Owner.phone.ilike('%{}%'.format(phone_digits)))
+        # Поиск по нормализованным номерам (начало номера или последние цифры),
+        # для ненормализуемых номеров и цифр из середины - по подстроке
+        phone_condition = phone_search_condition(search_phone)
+        if phone_condition is not None:
+            query = query.filter(phone_condition)
     if search_address:
-        query = query.filter(Owner.address.ilike('%{}%'.format(search_address)))
+        expression = match_expression(search_address, ['address'])
+        if expression:
+            query = query.filter(Owner.id.in_(matching_ids(Owner, expression)))
 
-    owners_pagination = query.order_by(Owner.name)\
-                           .paginate(page=page, per_page=per_page, error_out=False)
+    filtered = any([search_name, search_pet, search_card, search_phone, search_address])
+    owners_pagination = keyset_page(query, [(Owner.name, False), (Owner.id, False)],
+                                    'owners', per_page=per_page, filtered=filtered)
     
     return render_template(
         'owners.html',
@@ -2339,16 +2456,9 @@ def underscore_filter(value):
         return '_' * 30  # Заполняет 30 символами подчеркивания
     return value
 
-@app.route('/print_pet_card/<int:pet_id>')
-def print_pet_card(pet_id):
-    pet = Pet.query.get_or_404(pet_id)
-    owner = Owner.query.get_or_404(pet.owner_id)
-    
-    # Загружаем ваш шаблон DOCX
-    doc = DocxTemplate("card.docx")
-    
-    # Подготавливаем контекст для заполнения
-    context = {
+def pet_card_context(pet, owner):
+    """Значения полей шаблона карточки card.docx"""
+    return {
         'card_number': pet.card_number,
         'owner_name': owner.name,
         'address': owner.address,
@@ -2357,55 +2467,173 @@ def print_pet_card(pet_id):
         'pet_name': pet.name,
         'breed': pet.breed,
         'color': pet.coloration,
-        'birth_date': pet.birth_date.strftime('%d.%m.%Y'),
+        'birth_date': pet.birth_date.strftime('%d.%m.%Y') if pet.birth_date else '',
         'gender': pet.gender
     }
+
+DOCX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+
+@app.route('/print_pet_card/<int:pet_id>')
+def print_pet_card(pet_id):
+    pet = Pet.query.get_or_404(pet_id)
+    owner = Owner.query.get_or_404(pet.owner_id)
     
-    # Заполняем шаблон
-    doc.render(context)
-    
-    # Создаем response
-    file_stream = io.BytesIO()
-    doc.save(file_stream)
-    file_stream.seek(0)
+    # Шаблон разбирается один раз и берётся из кэша (см. docx_templates.py)
+    document = docx_templates.render_to_bytes(app.config['CARD_TEMPLATE'], pet_card_context(pet, owner))
     
-    response = make_response(file_stream.read())
-    response.headers['Content-Type'] = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+    response = make_response(document)
+    response.headers['Content-Type'] = DOCX_MIMETYPE
     response.headers['Content-Disposition'] = 'attachment; filename=pet_card_{}.docx'.format(pet.id)
     return response
 
+@app.route('/print_pet_cards', methods=['POST'])
+def print_pet_cards():
+    """Пакетная печать карточек: один ZIP (format=zip) или один многостраничный DOCX (format=docx).
+
+    Принимает JSON {"pet_ids": [...], "format": "zip"} (с заголовком X-CSRFToken)
+    или поля формы pet_ids, format и csrf_token.
+    """
+    import zipfile
+    
+    data = request.get_json(silent=True)
+    if data is not None:
+        raw_ids = data.get('pet_ids') or []
+        output_format = data.get('format', 'zip')
+    else:
+        raw_ids = request.form.getlist('pet_ids')
+        output_format = request.form.get('format', 'zip')
+    
+    try:
+        pet_ids = list(dict.fromkeys(int(pet_id) for pet_id in raw_ids))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'pet_ids должны быть числами'}), 400
+    if not pet_ids:
+        return jsonify({'error': 'Не указаны питомцы (pet_ids)'}), 400
+    if len(pet_ids) > app.config['CARD_BULK_LIMIT']:
+        return jsonify({'error': 'Не больше {} карточек за раз'.format(app.config['CARD_BULK_LIMIT'])}), 400
+    if output_format not in ('zip', 'docx'):
+        return jsonify({'error': 'format должен быть zip или docx'}), 400
+    
+    pets = {pet.id: pet for pet in Pet.query.options(selectinload(Pet.owner))
+            .filter(Pet.id.in_(pet_ids)).all()}
+    missing = [pet_id for pet_id in pet_ids if pet_id not in pets]
+    if missing:
+        return jsonify({'error': 'Питомцы не найдены', 'missing': missing}), 404
+    
+    pets = [pets[pet_id] for pet_id in pet_ids]
+    documents = docx_templates.render_many(
+        app.config['CARD_TEMPLATE'],
+        [pet_card_context(pet, pet.owner) for pet in pets],
+        workers=app.config['CARD_RENDER_WORKERS']
+    )
+    
+    if output_format == 'docx':
+        response = make_response(docx_templates.combine_documents(documents))
+        response.headers['Content-Type'] = DOCX_MIMETYPE
+        response.headers['Content-Disposition'] = 'attachment; filename=pet_cards_{}.docx'.format(len(pets))
+        return response
+    
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for pet, document in zip(pets, documents):
+            zip_file.writestr('pet_card_{}.docx'.format(pet.id), document)
+    response = make_response(buffer.getvalue())
+    response.headers['Content-Type'] = 'application/zip'
+    response.headers['Content-Disposition'] = 'attachment; filename=pet_cards_{}.zip'.format(len(pets))
+    return response
+
 # ================================
 # КОМАНДЫ ДЛЯ РАБОТЫ С БАЗОЙ ДАННЫХ
 # ================================
+def _unicode_upper(value):
+    return value.upper() if isinstance(value, str) else value
+
+def register_unicode_upper(connection):
+    """Заменяет встроенную upper() SQLite (только ASCII) на str.upper для этого соединения"""
+    connection.connection.driver_connection.create_function(
+        'upper', 1, _unicode_upper, deterministic=True)
+
+def _uppercase_owner_names_at_once():
+    """Один UPDATE имён владельцев; возвращает количество изменённых строк.
+
+    Выполняется на отдельном соединении, изъятом из пула: после закрытия оно
+    не достанется другим запросам с заменённой upper().
+    """
+    from sqlalchemy import update
+    
+    owners = Owner.__table__
+    with db.engine.connect() as connection:
+        connection.detach()
+        register_unicode_upper(connection)
+        result = connection.execute(
+            update(owners)
+            .where(owners.c.name.isnot(None), owners.c.name != db.func.upper(owners.c.name))
+            .values(name=db.func.upper(owners.c.name))
+        )
+        connection.commit()
+        return result.rowcount
+
+def _uppercase_owner_names_chunked(chunk_size):
+    """Запасной вариант: пакеты по chunk_size владельцев с executemany и прогрессом"""
+    from sqlalchemy import bindparam, update
+    
+    owners = Owner.__table__
+    update_name = update(owners).where(owners.c.id == bindparam('owner_id'))\
+        .values(name=bindparam('new_name'))
+    total = db.session.query(db.func.count(Owner.id)).filter(Owner.name.isnot(None)).scalar()
+    last_id = 0
+    processed = 0
+    updated = 0
+    while True:
+        rows = db.session.query(Owner.id, Owner.name)\
+            .filter(Owner.id > last_id, Owner.name.isnot(None))\
+            .order_by(Owner.id).limit(chunk_size).all()
+        if not rows:
+            break
+        changes = [{'owner_id': owner_id, 'new_name': name.upper()}
+                   for owner_id, name in rows if name != name.upper()]
+        if changes:
+            db.session.execute(update_name, changes)
+        db.session.commit()
+        last_id = rows[-1][0]
+        processed += len(rows)
+        updated += len(changes)
+        print("Обработано {} из {} ({:.0f}%), обновлено {}".format(
+            processed, total, 100.0 * processed / total if total else 100, updated))
+    return updated
+
 @app.cli.command("uppercase")
-def uppercase_all_owner_names():
+@click.option('--chunked', is_flag=True, help="Update in batches with progress instead of one statement")
+@click.option('--chunk-size', default=1000, show_default=True, help="Owners per batch in chunked mode")
+def uppercase_all_owner_names(chunked, chunk_size):
     """Приводит все имена владельцев (Owner.name) к верхнему регистру."""
-    try:
-        # Вариант 1: Массовое обновление через один запрос (самый эффективный)
-        # updated_count = db.session.query(Owner)\
-        #     .filter(Owner.name.isnot(None))\
-        #     .update({"name": db.func.upper(Owner.name)},
-        #              synchronize_session=False)
-        # db.session.commit()
-        # print(f"✅ Успешно обновлено {updated_count} записей.")
-
-        # Вариант 2: Альтернативный способ (если первый не работает)
-        owners = Owner.query.filter(Owner.name.isnot(None)).all()
-        for owner in owners:
-            owner.name = owner.name.upper()
-        db.session.commit()
-        print("Успешно обновлено {} записей.".format(len(owners)))
+    started = time.perf_counter()
+    if not chunked:
+        try:
+            # Один UPDATE по всей таблице на отдельном соединении, где upper() заменена
+            # на Unicode-версию (кириллица тоже переводится в верхний регистр)
+            updated_count = _uppercase_owner_names_at_once()
+            print("Успешно обновлено {} записей ({:.2f} с).".format(
+                updated_count, time.perf_counter() - started))
+            return
+        except Exception as e:
+            print("Ошибка массового обновления: {}. Переход к обновлению пакетами.".format(e))
 
+    try:
+        updated_count = _uppercase_owner_names_chunked(chunk_size)
+        print("Успешно обновлено {} записей ({:.2f} с).".format(
+            updated_count, time.perf_counter() - started))
     except Exception as e:
         db.session.rollback()
         print("Ошибка: {}".format(e))
 
 @app.cli.command("import-csv")
-def import_csv_command():
+@click.option('--batch-size', default=1000, show_default=True, help="Rows per insert transaction")
+def import_csv_command(batch_size):
     """Импорт данных из CSV файла"""
     try:
         from csv_importer import import_csv  # Вынесем импортер в отдельный файл
-        import_csv('data/test_.csv')
+        import_csv('data/test_.csv', batch_size=batch_size)
         print("Импорт успешно завершен!")
     except Exception as e:
         print("Ошибка импорта: {}".format(str(e)))
@@ -2437,11 +2665,14 @@ def import_owner_csv_command():
         traceback.print_exc()
 
 @app.cli.command("import-vac-csv")
-def import_vac_csv_command():
+@click.option('--batch-size', default=1000, show_default=True, help="Rows per insert transaction")
+def import_vac_csv_command(batch_size):
     """Импорт данных о вакцинах из CSV файла"""
     try:
         from csv_importer import import_vaccinations  # Вынесем импортер в отдельный файл
-        import_vaccinations('data/vac_for_test2.csv')
+        import_vaccinations('data/vac_for_test2.csv', batch_size=batch_size)
+        # Пакетная вставка не проходит через события ORM - снимок статистики строим заново
+        refresh_statistics_snapshot(full=True)
         print("Импорт успешно завершен!")
     except Exception as e:
         print("Ошибка импорта: {}".format(str(e)))
@@ -2460,39 +2691,185 @@ def reset_db():
         import traceback
         traceback.print_exc()
 
+def ensure_indexes():
+    """Создаёт недостающие таблицы и индексы, объявленные в models.py.
+
+    Существующие данные не затрагиваются, поэтому функцию можно вызывать
+    на рабочей базе без reset-db. Возвращает список созданных индексов.
+    """
+    db.create_all()
+    created = []
+    inspector = db.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = {ix['name'] for ix in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=db.engine, checkfirst=True)
+                created.append(index.name)
+    # Полнотекстовый индекс поиска (FTS5) с триггерами синхронизации
+    rebuild_search_index()
+    with db.engine.begin() as conn:
+        # Обновляем статистику планировщика запросов SQLite
+        conn.exec_driver_sql('ANALYZE')
+    return created
+
+@app.cli.command("rebuild-statistics")
+def rebuild_statistics_command():
+    """Полная перестройка снимка статистики (после импорта CSV)"""
+    try:
+        refresh_statistics_snapshot(full=True)
+        print("Снимок статистики перестроен: {} строк".format(StatisticsSnapshot.query.count()))
+    except Exception as e:
+        print("Ошибка: {}".format(str(e)))
+        import traceback
+        traceback.print_exc()
+
+@app.cli.command("db-optimize")
+def db_optimize_command():
+    """Создание недостающих индексов без пересоздания базы данных"""
+    try:
+        created = ensure_indexes()
+        if created:
+            print("Созданы индексы:")
+            for name in created:
+                print("  - {}".format(name))
+        else:
+            print("Все индексы уже существуют.")
+        print("Полнотекстовый индекс поиска перестроен.")
+        print("Статистика базы данных обновлена (ANALYZE).")
+    except Exception as e:
+        print("Ошибка: {}".format(str(e)))
+        import traceback
+        traceback.print_exc()
+
+@app.cli.command("dedupe-vaccinations")
+@click.option('--dry-run', is_flag=True, help="Only count duplicates, do not delete them")
+def dedupe_vaccinations_command(dry_run):
+    """Удаление повторяющихся вакцинаций средствами SQL"""
+    from csv_importer import delete_duplicate_vaccinations
+    try:
+        started = time.perf_counter()
+        result = delete_duplicate_vaccinations(dry_run=dry_run)
+        elapsed = time.perf_counter() - started
+    except Exception as e:
+        db.session.rollback()
+        print("Ошибка: {}".format(e))
+        return
+    
+    if dry_run:
+        print("Найдено групп с дубликатами: {}, лишних записей: {} ({:.2f} с). Изменения не сохранены.".format(
+            result['groups'], result['duplicates'], elapsed))
+        return
+    
+    print("Удалено дубликатов: {} в {} группах ({:.2f} с)".format(
+        result['duplicates'], result['groups'], elapsed))
+    if result['duplicates']:
+        # Удаление выполнено одним запросом, без событий ORM
+        refresh_statistics_snapshot(full=True)
+
+@app.cli.command("backfill-owner-phones")
+def backfill_owner_phones_command():
+    """Заполнение индекса нормализованных телефонов владельцев"""
+    try:
+        started = time.perf_counter()
+        written = rebuild_owner_phone_index()
+        print("Записано номеров: {} ({:.2f} с)".format(written, time.perf_counter() - started))
+    except Exception as e:
+        db.session.rollback()
+        print("Ошибка: {}".format(str(e)))
+        import traceback
+        traceback.print_exc()
+
+def _normalize_phones_checkpoint_path():
+    return os.path.join(app.instance_path, 'normalize_phones.checkpoint')
+
+def _read_normalize_phones_checkpoint():
+    """Последний обработанный id владельца из файла контрольной точки (0, если нет)"""
+    try:
+        with open(_normalize_phones_checkpoint_path(), 'r', encoding='utf-8') as f:
+            return int(json.load(f)['last_id'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return 0
+
+def _write_normalize_phones_checkpoint(last_id):
+    path = _normalize_phones_checkpoint_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'last_id': last_id, 'updated_at': datetime.now().isoformat()}, f)
+    os.replace(path + '.tmp', path)
+
 @app.cli.command("normalize-phones")
 @click.option('--dry-run', is_flag=True, help="Run without saving changes")
-def normalize_phones_command(dry_run):
+@click.option('--chunk-size', default=1000, show_default=True, help="Owners per chunk (one transaction each)")
+@click.option('--resume', is_flag=True, help="Continue after the last committed chunk of an interrupted run")
+@click.option('--verbose', is_flag=True, help="Print every changed phone (always on for --dry-run)")
+def normalize_phones_command(dry_run, chunk_size, resume, verbose):
     """Normalize phone numbers for all owners"""
-    from phone_normalizer import normalize_phone_v2
-    owners = Owner.query.all()
-    
-    for owner in owners:
-        original = owner.phone
-        if not original:
-            continue
-            
-        result = normalize_phone_v2(original)
-        new_phone = ', '.join(result['valid']) if result['valid'] else original
+    from sqlalchemy import bindparam, update
+    
+    last_id = _read_normalize_phones_checkpoint() if resume else 0
+    if last_id:
+        print("Resuming after owner ID {}".format(last_id))
+    
+    # executemany: одно подготовленное UPDATE на весь пакет
+    update_phone = update(Owner.__table__)\
+        .where(Owner.__table__.c.id == bindparam('owner_id'))\
+        .values(phone=bindparam('new_phone'))
+    
+    processed = 0
+    changed = 0
+    started = time.perf_counter()
+    
+    while True:
+        # Keyset-пагинация: следующий пакет после последнего обработанного id
+        rows = db.session.query(Owner.id, Owner.phone)\
+            .filter(Owner.id > last_id)\
+            .order_by(Owner.id)\
+            .limit(chunk_size).all()
+        if not rows:
+            break
         
-        if new_phone != original:
-            print("\nOwner ID: {}".format(owner.id))
-            print("Original: {}".format(original))
-            print("Normalized: {}".format(new_phone))
-            print("Invalid: {}".format(', '.join(result['invalid'])))
+        updates = []
+        for (owner_id, original), result in zip(rows, normalize_many(phone for _, phone in rows)):
+            if not original:
+                continue
             
-            if not dry_run:
-                owner.phone = new_phone
+            new_phone = ', '.join(result['valid']) if result['valid'] else original
+            
+            if new_phone != original:
+                updates.append({'owner_id': owner_id, 'new_phone': new_phone})
+                if dry_run or verbose:
+                    print("\nOwner ID: {}".format(owner_id))
+                    print("Original: {}".format(original))
+                    print("Normalized: {}".format(new_phone))
+                    print("Invalid: {}".format(', '.join(result['invalid'])))
+        
+        last_id = rows[-1][0]
+        if not dry_run:
+            try:
+                if updates:
+                    db.session.execute(update_phone, updates)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print("\nError committing changes: {}".format(str(e)))
+                print("Run again with --resume to continue from the last committed chunk.")
+                return
+            _write_normalize_phones_checkpoint(last_id)
+        
+        processed += len(rows)
+        changed += len(updates)
+        elapsed = time.perf_counter() - started
+        print("Processed {} owners (last ID {}), changed {}, {:.0f} rows/sec".format(
+            processed, last_id, changed, processed / elapsed if elapsed else 0))
     
     if not dry_run:
-        try:
-            db.session.commit()
-            print("\nChanges committed to database!")
-        except Exception as e:
-            db.session.rollback()
-            print("\nError committing changes: {}".format(str(e)))
+        # Все пакеты сохранены - контрольная точка больше не нужна
+        if os.path.exists(_normalize_phones_checkpoint_path()):
+            os.remove(_normalize_phones_checkpoint_path())
+        print("\nChanges committed to database! Owners changed: {}".format(changed))
     else:
-        print("\nDry run complete. No changes saved.")
+        print("\nDry run complete. No changes saved. Owners to change: {}".format(changed))
 
 # ================================
 # ЗАПУСК ПРИЛОЖЕНИЯ
@@ -2531,173 +2908,13 @@ def diagnose():
         if not ml_enabled:
             return jsonify({'success': False, 'error': 'ML диагностика выключена. Включите её в настройках.'}), 403
         
-        # Проверяем, загружена ли модель
-        if ml_model is None:
-            # Пытаемся загрузить модель, если она не загружена
-            if not load_ml_model():
-                return jsonify({'success': False, 'error': 'ML модель не найдена или не может быть загружена'}), 500
+        # Проверяем, загружена ли модель (загрузка идёт в фоне и не блокирует запрос)
+        pipeline = ml_pipeline
+        if pipeline is None:
+            return ml_not_ready_response()
         
-        # Получаем предсказания
-        if isinstance(ml_model, dict):
-            # Проверяем, это взвешенная модель или другая
-            if 'animal_type_encoder' in ml_model:
-                # Взвешенная модель
-                model = ml_model['model']
-                scaler = ml_model['scaler']
-                feature_selector = ml_model['feature_selector']
-                label_encoder = ml_model['label_encoder']
-                animal_type_encoder = ml_model['animal_type_encoder']
-                feature_names = ml_model['feature_names']
-                
-                # Создаем вектор признаков на основе feature_names
-                features = np.zeros(len(feature_names))
-                
-                # Устанавливаем симптомы
-                for symptom in symptoms:
-                    if symptom in feature_names:
-                        idx = feature_names.index(symptom)
-                        features[idx] = 1
-                
-                # Устанавливаем лабораторные анализы
-                for lab_name, lab_value in lab_analyses.items():
-                    lab_feature = "lab_{}_{}".format(lab_name, lab_value)
-                    if lab_feature in feature_names:
-                        idx = feature_names.index(lab_feature)
-                        features[idx] = 1
-                
-                # Устанавливаем тип животного
-                if 'animal_type_encoded' in feature_names:
-                    try:
-                        animal_type_encoded = animal_type_encoder.transform([animal_type])[0]
-                        idx = feature_names.index('animal_type_encoded')
-                        features[idx] = animal_type_encoded
-                    except:
-                        pass  # Если тип животного не найден, пропускаем
-                
-                # Масштабирование признаков
-                features_scaled = scaler.transform([features])
-                
-                # Выбор признаков
-                features_selected = feature_selector.transform(features_scaled)
-                
-                # Предсказание
-                if hasattr(model, 'predict_proba'):
-                    probabilities = model.predict_proba(features_selected)[0]
-                    classes = model.classes_
-                else:
-                    # Fallback
-                    prediction = model.predict(features_selected)[0]
-                    probabilities = np.zeros(len(classes))
-                    if prediction in classes:
-                        idx = list(classes).index(prediction)
-                        probabilities[idx] = 1.0
-                
-                # Получение топ-5 предсказаний
-                top_indices = np.argsort(probabilities)[::-1][:5]
-                predictions = []
-                for idx in top_indices:
-                    disease = label_encoder.inverse_transform([classes[idx]])[0]
-                    probability = probabilities[idx]
-                    predictions.append([disease, probability])
-                    
-            elif 'feature_selector' in ml_model:
-                # Улучшенная модель
-                model = ml_model['model']
-                scaler = ml_model['scaler']
-                feature_selector = ml_model['feature_selector']
-                label_encoder = ml_model['label_encoder']
-                feature_names = ml_model['feature_names']
-                
-                # Создаем вектор признаков на основе feature_names
-                features = np.zeros(len(feature_names))
-                
-                # Устанавливаем симптомы
-                for symptom in symptoms:
-                    if symptom in feature_names:
-                        idx = feature_names.index(symptom)
-                        features[idx] = 1
-                
-                # Устанавливаем лабораторные анализы
-                for lab_name, lab_value in lab_analyses.items():
-                    lab_feature = "lab_{}_{}".format(lab_name, lab_value)
-                    if lab_feature in feature_names:
-                        idx = feature_names.index(lab_feature)
-                        features[idx] = 1
-                
-                # Масштабирование признаков
-                features_scaled = scaler.transform([features])
-                
-                # Выбор признаков
-                features_selected = feature_selector.transform(features_scaled)
-                
-                # Предсказание
-                if hasattr(model, 'predict_proba'):
-                    probabilities = model.predict_proba(features_selected)[0]
-                    classes = model.classes_
-                else:
-                    # Fallback
-                    prediction = model.predict(features_selected)[0]
-                    probabilities = np.zeros(len(classes))
-                    if prediction in classes:
-                        idx = list(classes).index(prediction)
-                        probabilities[idx] = 1.0
-                
-                # Получение топ-5 предсказаний
-                top_indices = np.argsort(probabilities)[::-1][:5]
-                predictions = []
-                for idx in top_indices:
-                    disease = classes[idx]
-                    probability = probabilities[idx]
-                    predictions.append([disease, probability])
-                    
-            else:
-                # Стандартная модель
-                model = ml_model['model']
-                scaler = ml_model['scaler']
-                symptoms_list = ml_model['symptoms']
-                diseases_list = ml_model['diseases']
-                feature_names = ml_model['feature_names']
-                
-                # Создаем вектор признаков на основе feature_names
-                features = np.zeros(len(feature_names))
-                
-                # Устанавливаем симптомы
-                for symptom in symptoms:
-                    if symptom in feature_names:
-                        idx = feature_names.index(symptom)
-                        features[idx] = 1
-                
-                # Устанавливаем лабораторные анализы
-                for lab_name, lab_value in lab_analyses.items():
-                    if lab_name in feature_names:
-                        idx = feature_names.index(lab_name)
-                        features[idx] = 1
-                
-                # Масштабирование признаков
-                features_scaled = scaler.transform([features])
-                
-                # Предсказание
-                if hasattr(model, 'predict_proba'):
-                    probabilities = model.predict_proba(features_scaled)[0]
-                    classes = model.classes_
-                else:
-                    # Для моделей без predict_proba
-                    if hasattr(model, 'decision_function'):
-                        scores = model.decision_function(features_scaled)[0]
-                        probabilities = np.exp(scores) / np.sum(np.exp(scores))
-                        classes = model.classes_
-                    else:
-                        # Fallback
-                        probabilities = np.ones(len(diseases_list)) / len(diseases_list)
-                        classes = diseases_list
-                
-                # Сортируем по вероятности
-                disease_probs = list(zip(classes, probabilities))
-                disease_probs.sort(key=lambda x: x[1], reverse=True)
-                predictions = disease_probs[:5]
-        else:
-            # Если модель - объект класса
-            predictions = ml_model.predict_diseases(animal_type, symptoms)
+        # Получаем предсказания через подготовленный конвейер модели
+        predictions = pipeline.predict(animal_type, symptoms, lab_analyses)
         
         return jsonify({
             'success': True,
@@ -2707,7 +2924,70 @@ def diagnose():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
-scheduler = init_scheduler()
+def diagnosis_case_error(case):
+    """Текст ошибки для неправильного случая пакетной диагностики (None - случай корректен)"""
+    animal_type = case.get('animal_type')
+    if animal_type is not None and not isinstance(animal_type, str):
+        return 'вид животного должен быть строкой'
+    symptoms = case.get('symptoms', [])
+    if not isinstance(symptoms, list) or not all(isinstance(symptom, str) for symptom in symptoms):
+        return 'симптомы должны быть списком строк'
+    lab_analyses = case.get('lab_analyses')
+    if lab_analyses is not None and not isinstance(lab_analyses, dict):
+        return 'анализы должны быть объектом'
+    return None
+
+@app.route('/diagnose/batch', methods=['POST'])
+@csrf.exempt
+def diagnose_batch():
+    """API для пакетной диагностики: {"cases": [{"animal_type", "symptoms", "lab_analyses"}, ...], "top_k": 5}"""
+    try:
+        data = request.get_json()
+        
+        if not data:
+            return jsonify({'success': False, 'error': 'Пустые данные'}), 400
+        
+        cases = data.get('cases')
+        top_k = data.get('top_k', 5)
+        
+        if not isinstance(cases, list) or not cases:
+            return jsonify({'success': False, 'error': 'Не переданы случаи для диагностики'}), 400
+        
+        if not all(isinstance(case, dict) for case in cases):
+            return jsonify({'success': False, 'error': 'Каждый случай должен быть объектом'}), 400
+        
+        max_cases = app.config.get('ML_BATCH_MAX_CASES', 10000)
+        if len(cases) > max_cases:
+            return jsonify({'success': False, 'error': 'Слишком много случаев (максимум {})'.format(max_cases)}), 400
+        
+        for number, case in enumerate(cases, 1):
+            error = diagnosis_case_error(case)
+            if error:
+                return jsonify({'success': False, 'error': 'Случай {}: {}'.format(number, error)}), 400
+        
+        if not isinstance(top_k, int) or isinstance(top_k, bool) or top_k < 1:
+            return jsonify({'success': False, 'error': 'top_k должен быть положительным числом'}), 400
+        
+        # Проверяем, включена ли ML диагностика
+        if not ml_enabled:
+            return jsonify({'success': False, 'error': 'ML диагностика выключена. Включите её в настройках.'}), 403
+        
+        # Проверяем, загружена ли модель (загрузка идёт в фоне и не блокирует запрос)
+        pipeline = ml_pipeline
+        if pipeline is None:
+            return ml_not_ready_response()
+        
+        # Все случаи оцениваются одним вызовом модели
+        results = pipeline.predict_batch(cases, top_k=top_k)
+        
+        return jsonify({
+            'success': True,
+            'results': results
+        })
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 # ML модель НЕ загружается по умолчанию - только при включении в настройках
 # load_ml_model()  # Загружаем ML модель при запуске - ОТКЛЮЧЕНО
 
@@ -2715,39 +2995,46 @@ scheduler = init_scheduler()
 @csrf.exempt
 def enable_ml():
     """API для включения/выключения ML модели"""
-    global ml_model, ml_enabled
+    global ml_model, ml_pipeline, ml_enabled, ml_load_generation
     try:
         data = request.json
         enabled = data.get('enabled', False)
         
         if enabled:
-            # Включаем ML - загружаем модель
-            if ml_model is None:
-                success = load_ml_model()
-                if success:
-                    ml_enabled = True
-                    return jsonify({'success': True, 'message': 'ML модель загружена'})
-                else:
-                    return jsonify({'success': False, 'error': 'Не удалось загрузить ML модель'}), 500
-            else:
-                ml_enabled = True
-                return jsonify({'success': True, 'message': 'ML модель уже загружена'})
+            # Включаем ML - модель загружается в фоновом потоке
+            ml_enabled = True
+            status = start_ml_model_loading(retry_failed=True)
+            if status == 'ready':
+                return jsonify({'success': True, 'status': status, 'message': 'ML модель уже загружена'})
+            return jsonify({'success': True, 'status': status,
+                            'message': 'ML модель загружается, статус: /api/ml_status'}), 202
         else:
             # Выключаем ML - освобождаем память
-            ml_model = None
-            ml_enabled = False
-            return jsonify({'success': True, 'message': 'ML модель выгружена'})
+            with ml_state_lock:
+                ml_load_generation += 1
+                ml_model = None
+                ml_pipeline = None
+                ml_enabled = False
+                ml_state.update(status='idle', error=None, load_seconds=None, warmup_seconds=None)
+            return jsonify({'success': True, 'status': 'idle', 'message': 'ML модель выгружена'})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/ml_status', methods=['GET'])
 def ml_status():
     """API для проверки статуса ML модели"""
-    global ml_model, ml_enabled
     return jsonify({
         'enabled': ml_enabled,
-        'loaded': ml_model is not None
+        'loaded': ml_pipeline is not None,
+        'status': ml_state['status'],
+        'error': ml_state['error'],
+        'model_path': ml_state['model_path'],
+        'load_seconds': ml_state['load_seconds'],
+        'warmup_seconds': ml_state['warmup_seconds'],
+        'mmap_mode': app.config.get('ML_MMAP_MODE')
     })
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # Сервер разработки; для работы клиники - wsgi.py (waitress или gunicorn -w 1)
+    create_app().run(host=app.config['SERVER_HOST'], port=app.config['SERVER_PORT'],
+                     debug=app.config.get('DEV_SERVER_DEBUG', True))
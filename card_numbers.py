@@ -0,0 +1,209 @@
+"""
+Индекс свободных номеров карточек.
+
+Свободные числовые номера хранятся интервалами в таблице card_number_gap и
+поддерживаются событиями SQLAlchemy при добавлении, удалении животного и смене
+номера карточки. Поиск свободных номеров читает только нужные интервалы по
+индексу, не перебирая весь диапазон номеров.
+"""
+from sqlalchemy import event, func, insert, or_, select
+
+from models import CardNumberGap, Pet, db
+
+gaps = CardNumberGap.__table__
+
+_table_exists = False
+
+
+def card_number_value(card_number):
+    """Числовое значение номера карточки или None для нечисловых номеров"""
+    if card_number is None:
+        return None
+    card_number = str(card_number).strip()
+    if not card_number.isdigit():
+        return None
+    return int(card_number)
+
+
+def _has_table(connection):
+    global _table_exists
+    if not _table_exists:
+        _table_exists = db.inspect(connection).has_table(gaps.name)
+    return _table_exists
+
+
+def _index_exists(connection):
+    """Индекс построен: таблица есть (база могла быть создана до её появления) и не пуста"""
+    return _has_table(connection) and connection.execute(select(gaps.c.id).limit(1)).first() is not None
+
+
+def _gap_containing(connection, number):
+    return connection.execute(
+        select(gaps).where(
+            gaps.c.first_number <= number,
+            or_(gaps.c.last_number >= number, gaps.c.last_number.is_(None))
+        ).order_by(gaps.c.first_number.desc()).limit(1)
+    ).first()
+
+
+def _occupy(connection, number):
+    """Номер занят: разбиваем содержащий его интервал"""
+    gap = _gap_containing(connection, number)
+    if gap is None:
+        return
+    connection.execute(gaps.delete().where(gaps.c.id == gap.id))
+    pieces = []
+    if gap.first_number <= number - 1:
+        pieces.append({'first_number': gap.first_number, 'last_number': number - 1})
+    if gap.last_number is None or number + 1 <= gap.last_number:
+        pieces.append({'first_number': number + 1, 'last_number': gap.last_number})
+    if pieces:
+        connection.execute(insert(gaps), pieces)
+
+
+def _release(connection, number):
+    """Номер освободился: объединяем его с соседними интервалами"""
+    if number < 1 or _gap_containing(connection, number) is not None:
+        return
+    left = connection.execute(select(gaps).where(gaps.c.last_number == number - 1)).first()
+    right = connection.execute(select(gaps).where(gaps.c.first_number == number + 1)).first()
+    first_number = left.first_number if left else number
+    last_number = right.last_number if right else number
+    removed = [g.id for g in (left, right) if g is not None]
+    if removed:
+        connection.execute(gaps.delete().where(gaps.c.id.in_(removed)))
+    connection.execute(insert(gaps), [{'first_number': first_number, 'last_number': last_number}])
+
+
+def _after_insert(mapper, connection, target):
+    number = card_number_value(target.card_number)
+    if number is not None and _index_exists(connection):
+        _occupy(connection, number)
+
+
+def _after_delete(mapper, connection, target):
+    number = card_number_value(target.card_number)
+    if number is not None and _index_exists(connection):
+        _release(connection, number)
+
+
+def _after_update(mapper, connection, target):
+    history = db.inspect(target).attrs.card_number.history
+    if not history.has_changes() or not _index_exists(connection):
+        return
+    for value in history.added or ():
+        number = card_number_value(value)
+        if number is not None:
+            _occupy(connection, number)
+    for value in history.deleted or ():
+        number = card_number_value(value)
+        if number is not None:
+            _release(connection, number)
+
+
+event.listen(Pet, 'after_insert', _after_insert)
+event.listen(Pet, 'after_delete', _after_delete)
+event.listen(Pet, 'after_update', _after_update)
+
+
+def rebuild_card_number_index():
+    """Полная перестройка индекса по текущим номерам карточек"""
+    global _table_exists
+    gaps.create(bind=db.engine, checkfirst=True)
+    _table_exists = True
+    used = sorted({
+        number for number in (
+            card_number_value(card_number)
+            for (card_number,) in db.session.query(Pet.card_number)
+        ) if number is not None and number >= 1
+    })
+    rows = []
+    expected = 1
+    for number in used:
+        if number > expected:
+            rows.append({'first_number': expected, 'last_number': number - 1})
+        expected = number + 1
+    rows.append({'first_number': expected, 'last_number': None})
+
+    db.session.execute(gaps.delete())
+    db.session.execute(insert(gaps), rows)
+    db.session.commit()
+    return len(used)
+
+
+def ensure_card_number_index():
+    """Строит индекс при первом обращении (новая таблица на существующей базе)"""
+    global _table_exists
+    gaps.create(bind=db.engine, checkfirst=True)
+    _table_exists = True
+    if db.session.query(CardNumberGap.id).first() is None:
+        rebuild_card_number_index()
+
+
+def max_used_number():
+    """Максимальный занятый номер (0, если числовых номеров нет)"""
+    tail_start = db.session.query(CardNumberGap.first_number)\
+        .filter(CardNumberGap.last_number.is_(None)).scalar()
+    return (tail_start or 1) - 1
+
+
+def min_used_number():
+    """Минимальный занятый номер (None, если числовых номеров нет)"""
+    first_gap = db.session.query(CardNumberGap)\
+        .filter(CardNumberGap.first_number == 1).first()
+    if first_gap is None:
+        return 1
+    if first_gap.last_number is None:
+        return None
+    return first_gap.last_number + 1
+
+
+def _clip(gap, range_min, range_max):
+    first_number = max(gap.first_number, range_min)
+    last_number = range_max if gap.last_number is None else min(gap.last_number, range_max)
+    return first_number, last_number
+
+
+def _in_range(query, range_min, range_max):
+    return query.filter(
+        CardNumberGap.first_number <= range_max,
+        or_(CardNumberGap.last_number >= range_min, CardNumberGap.last_number.is_(None))
+    )
+
+
+def free_numbers(range_min, range_max, limit, descending=False):
+    """До limit свободных номеров из диапазона, от начала или с конца"""
+    query = _in_range(db.session.query(CardNumberGap), range_min, range_max)
+    if descending:
+        query = query.order_by(CardNumberGap.first_number.desc())
+    else:
+        query = query.order_by(CardNumberGap.first_number)
+
+    numbers = []
+    for gap in query.yield_per(50):
+        first_number, last_number = _clip(gap, range_min, range_max)
+        if descending:
+            start = max(first_number, last_number - (limit - len(numbers)) + 1)
+            numbers.extend(range(last_number, start - 1, -1))
+        else:
+            stop = min(last_number, first_number + (limit - len(numbers)) - 1)
+            numbers.extend(range(first_number, stop + 1))
+        if len(numbers) >= limit:
+            break
+    return sorted(numbers) if descending else numbers
+
+
+def count_free_numbers(range_min, range_max):
+    """Количество свободных номеров в диапазоне (считается в SQL по интервалам)"""
+    clipped_first = func.max(CardNumberGap.first_number, range_min)
+    clipped_last = func.min(func.coalesce(CardNumberGap.last_number, range_max), range_max)
+    total = _in_range(
+        db.session.query(func.sum(clipped_last - clipped_first + 1)), range_min, range_max
+    ).scalar()
+    return int(total or 0)
+
+
+def suggest_card_number(after=0):
+    """Первый свободный номер больше after"""
+    numbers = free_numbers(after + 1, max(after + 1, max_used_number() + 1), 1)
+    return numbers[0] if numbers else max_used_number() + 1
@@ -1,12 +1,57 @@
 from datetime import datetime
 from collections import defaultdict
 import csv
+from sqlalchemy import func
 from sqlalchemy.exc import IntegrityError
-from models import db, Owner, Pet , Vaccination
+from models import db, Owner, Pet , Vaccination, age_in_years
+from card_numbers import rebuild_card_number_index
+from owner_phones import rebuild_owner_phone_index
 
-def import_csv(filename):
+# Размер пакета для вставки (одна транзакция на пакет) и для запросов IN (...)
+IMPORT_BATCH_SIZE = 1000
+LOOKUP_CHUNK_SIZE = 500  # SQLite ограничивает число параметров в одном запросе
+
+
+def _chunks(items, size):
+    """Разбивает список на части не больше size"""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _existing_values(column, values, chunk_size=LOOKUP_CHUNK_SIZE):
+    """Множество значений column, уже присутствующих в базе (строками)"""
+    existing = set()
+    values = list(values)
+    for chunk in _chunks(values, chunk_size):
+        existing.update(
+            str(value) for (value,) in db.session.query(column).filter(column.in_(chunk))
+        )
+    return existing
+
+
+def _bulk_insert(model, mappings, batch_size, label):
+    """Вставка пакетами через executemany, каждый пакет - отдельная транзакция.
+
+    Возвращает количество вставленных строк; при ошибке откатывает текущий
+    пакет и прекращает вставку (уже сохранённые пакеты остаются).
+    """
+    inserted = 0
+    for batch in _chunks(mappings, batch_size):
+        try:
+            db.session.bulk_insert_mappings(model, batch)
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            print(f"Ошибка {label}: {e}")
+            return inserted, False
+        inserted += len(batch)
+    return inserted, True
+
+
+def import_csv(filename, batch_size=IMPORT_BATCH_SIZE):
     owners_data = defaultdict(lambda: {'phones': [], 'addresses': []})
     pets_temp_data = []
+    seen_cards = set()
     
     species_mapping = {'1': 'Собака', '2': 'Кот', '3': 'Птица', '4': 'Грызун', '5': 'Лиса'}
     sex_mapping = {'1': 'М', '2': 'Ж', '3': 'КМ', '4': 'КЖ'}
@@ -27,7 +72,7 @@ def import_csv(filename):
             
             # Обработка животного с проверкой даты
             card_num = row['actual_card_num']
-            if not any(p['card_number'] == card_num for p in pets_temp_data):
+            if card_num not in seen_cards:
                 birth_date = None
                 try:
                     # Пробуем разные форматы даты
@@ -51,61 +96,51 @@ def import_csv(filename):
                 breed = row['breed_name'].strip().lower()
                 color = row['color'].strip().lower()
 
+                seen_cards.add(card_num)
                 pets_temp_data.append({
                     'card_number': card_num,
                     'owner_id': owner_id,
                     'species': species_mapping.get(row['species'], 'Неизвестно'),
                     'breed': breed,
-                    'color': color,
+                    'coloration': color,
                     'name': pet_name,  # Кличка с заглавной буквы в каждом слове
                     'gender': sex_mapping.get(row['sex'], 'Неизвестно'),
-                    'birth_date': birth_date
+                    'birth_date': birth_date,
+                    'chronic_diseases': '',  # Пустая строка
+                    'allergies': ''          # Пустая строка
                 })
 
-    # Создаем владельцев
-    for owner_id, data in owners_data.items():
-        with db.session.no_autoflush:
-            owner = Owner.query.get(owner_id)
-            if not owner:
-                owner = Owner(
-                    id=owner_id,
-                    name=data['name'],
-                    phone=' '.join(data['phones']),
-                    address=' '.join(data['addresses'])
-                )
-                db.session.add(owner)
-    
-    try:
-        db.session.commit()
-    except IntegrityError as e:
-        db.session.rollback()
-        print(f"Ошибка владельцев: {e}")
+    # Создаем владельцев, которых ещё нет в базе
+    existing_owner_ids = _existing_values(Owner.id, owners_data.keys())
+    new_owners = [
+        {
+            'id': owner_id,
+            'name': data['name'],
+            'phone': ' '.join(data['phones']),
+            'address': ' '.join(data['addresses'])
+        }
+        for owner_id, data in owners_data.items()
+        if str(owner_id) not in existing_owner_ids
+    ]
+    owners_inserted, ok = _bulk_insert(Owner, new_owners, batch_size, 'владельцев')
+    # Пакетная вставка обходит события ORM - индекс телефонов строим заново
+    if owners_inserted:
+        rebuild_owner_phone_index()
+    if not ok:
         return
 
-    # Создаем животных
-    for pet_data in pets_temp_data:
-        with db.session.no_autoflush:
-            if not Pet.query.filter_by(card_number=pet_data['card_number']).first():
-                pet = Pet(
-                    owner_id=pet_data['owner_id'],
-                    name=pet_data['name'],
-                    card_number=pet_data['card_number'],
-                    species=pet_data['species'],
-                    gender=pet_data['gender'],
-                    breed=pet_data['breed'],
-                    coloration=pet_data['color'],
-                    birth_date=pet_data['birth_date'],
-                    chronic_diseases='',  # Пустая строка
-                    allergies=''          # Пустая строка
-                )
-                db.session.add(pet)
+    # Создаем животных с ещё не занятыми номерами карточек
+    existing_cards = _existing_values(Pet.card_number, seen_cards)
+    new_pets = [pet for pet in pets_temp_data if pet['card_number'] not in existing_cards]
+    pets_inserted, ok = _bulk_insert(Pet, new_pets, batch_size, 'животных')
 
-    try:
-        db.session.commit()
-        print(f"Успешно импортировано: {len(owners_data)} владельцев, {len(pets_temp_data)} животных")
-    except IntegrityError as e:
-        db.session.rollback()
-        print(f"Ошибка животных: {e}")
+    # Пакетная вставка обходит события ORM - индекс свободных номеров строим заново
+    if pets_inserted:
+        rebuild_card_number_index()
+
+    if ok:
+        print(f"Успешно импортировано: {len(owners_data)} владельцев, {len(pets_temp_data)} животных "
+              f"(новых: {owners_inserted} владельцев, {pets_inserted} животных)")
 
 def import_only_new_pets(filename):
     # Маппинги для преобразования значений
@@ -179,10 +214,68 @@ def import_only_new_pets(filename):
         db.session.rollback()
         print(f"Ошибка при добавлении животных: {e}")
 
-def import_vaccinations(filename):
-    # Словарь для временного хранения и обработки данных
-    temp_data = defaultdict(list)
-    
+# Поля, совпадение которых означает дубликат вакцинации
+VACCINATION_DUPLICATE_KEY = (
+    Vaccination.vaccine_name,
+    Vaccination.date_administered,
+    Vaccination.vaccination_type,
+    Vaccination.pet_id,
+    Vaccination.dose_ml,
+)
+
+
+def delete_duplicate_vaccinations(dry_run=False):
+    """Удаляет повторяющиеся вакцинации, оставляя в каждой группе запись с наименьшим id.
+
+    Поиск выполняется одним GROUP BY ... HAVING, удаление - одним
+    DELETE ... WHERE id NOT IN (SELECT min(id) ...). Возвращает словарь
+    {'groups': групп с дублями, 'duplicates': лишних записей}; при dry_run
+    только считает.
+    """
+    groups = db.session.query(
+        func.count(Vaccination.id).label('copies')
+    ).group_by(*VACCINATION_DUPLICATE_KEY).having(func.count(Vaccination.id) > 1).subquery()
+    group_count, copies = db.session.query(
+        func.count(), func.coalesce(func.sum(groups.c.copies), 0)
+    ).one()
+    result = {'groups': group_count, 'duplicates': int(copies) - group_count}
+
+    if dry_run or not result['duplicates']:
+        return result
+
+    keep_ids = db.session.query(func.min(Vaccination.id)).group_by(*VACCINATION_DUPLICATE_KEY)
+    deleted = db.session.query(Vaccination).filter(
+        Vaccination.id.not_in(keep_ids.scalar_subquery())
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    result['duplicates'] = deleted
+    return result
+
+
+def _load_pet_map():
+    """Словарь "номер карточки -> данные животного и владельца" одним запросом"""
+    rows = db.session.query(
+        Pet.card_number, Pet.id, Pet.owner_id, Pet.species, Pet.breed, Pet.birth_date,
+        Owner.name, Owner.address
+    ).join(Owner, Pet.owner_id == Owner.id)
+    return {row[0]: row[1:] for row in rows}
+
+
+def _vaccination_key(vaccine_name, date_administered, vaccination_type, pet_id):
+    """Компактный ключ существующей вакцинации (хэш кортежа вместо ORM-объекта)"""
+    return hash((vaccine_name, date_administered, vaccination_type, pet_id))
+
+
+def _load_vaccination_keys():
+    """Ключи всех вакцинаций базы; читается только четыре столбца потоком"""
+    query = db.session.query(
+        Vaccination.vaccine_name, Vaccination.date_administered,
+        Vaccination.vaccination_type, Vaccination.pet_id
+    ).yield_per(5000)
+    return {_vaccination_key(*row) for row in query}
+
+
+def import_vaccinations(filename, batch_size=IMPORT_BATCH_SIZE):
     # Маппинг типов вакцин
     vaccine_type_mapping = {
         '8219': 'Бешенство',
@@ -193,6 +286,43 @@ def import_vaccinations(filename):
     # Исключения для правила 3 (вакцины, которые могут быть разных типов)
     exceptions = ['МУЛЬТИКАН 8', 'БИОФЕЛ PCHR', 'НОБИВАК RL', 'NOBIVAC RL']
     
+    # Удаляем существующие дубли перед импортом
+    print("Поиск и удаление дубликатов вакцинаций...")
+    try:
+        duplicates_found = delete_duplicate_vaccinations()['duplicates']
+        if duplicates_found > 0:
+            print(f"Удалено {duplicates_found} дубликатов вакцинаций")
+    except Exception as e:
+        db.session.rollback()
+        print(f"Ошибка при удалении дубликатов: {e}")
+    
+    # Справочники для импорта: животные по номеру карточки и ключи существующих вакцинаций
+    pet_map = _load_pet_map()
+    existing_keys = _load_vaccination_keys()
+    
+    # Уже принятые вакцины в группах (карточка, дата): по названию и по паре тип+название
+    kept_comments = set()
+    kept_types = set()
+    
+    today = datetime.today().date()
+    batch = []
+    imported_count = 0
+    skipped_count = 0
+    
+    def flush():
+        """Записывает накопленный пакет одной транзакцией"""
+        if not batch:
+            return True
+        try:
+            db.session.bulk_insert_mappings(Vaccination, batch)
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            print(f"Ошибка при сохранении вакцинаций: {e}")
+            return False
+        batch.clear()
+        return True
+    
     with open(filename, 'r', encoding='utf-8') as f:
         reader = csv.DictReader(f, delimiter=',')
         
@@ -200,7 +330,6 @@ def import_vaccinations(filename):
             actual_card_num = row['actual_card_num']
             vac_type = row['vac_type']
             vac_date = row['vac_date']
-            name = row['name'].strip().upper()
             comment = row['comment'].strip().upper()
             
             # Парсим дату (пробуем разные форматы)
@@ -216,131 +345,59 @@ def import_vaccinations(filename):
             # Нормализуем название вакцины
             normalized_comment = ' '.join(comment.split())  # Удаляем лишние пробелы
             
-            # Добавляем во временное хранилище
-            temp_data[(actual_card_num, parsed_date)].append({
-                'actual_card_num': actual_card_num,
-                'vac_date': parsed_date,
-                'type': vac_type,
-                'name': name,
-                'comment': normalized_comment,
-                'type_name': vaccine_type_mapping.get(vac_type, 'Неизвестно')
-            })
-    
-    # Обрабатываем данные для устранения дубликатов
-    processed_data = []
-    
-    for (actual_card_num, vac_date), vaccines in temp_data.items():
-        # Словарь для хранения уникальных комбинаций тип+название
-        unique_vaccines = {}
-        
-        for vaccine in vaccines:
-            key = (vaccine['type'], vaccine['comment'])
+            # Устраняем дубликаты внутри группы (карточка, дата)
+            group = (actual_card_num, parsed_date)
+            type_key = hash(group + (vac_type, normalized_comment))
+            comment_key = hash(group + (normalized_comment,))
+            if any(exc in normalized_comment for exc in exceptions):
+                # Для исключений проверяем полное совпадение (тип и название)
+                if type_key in kept_types:
+                    continue
+            elif comment_key in kept_comments:
+                # Для обычных вакцин проверяем только название
+                continue
+            kept_types.add(type_key)
+            kept_comments.add(comment_key)
             
-            # Проверяем, нужно ли сохранять эту вакцину
-            if key not in unique_vaccines:
-                # Для исключений проверяем полное совпадение
-                if any(exc in vaccine['comment'] for exc in exceptions):
-                    # Ищем полное совпадение (тип и название)
-                    if not any(v['type'] == vaccine['type'] and v['comment'] == vaccine['comment'] 
-                              for v in unique_vaccines.values()):
-                        unique_vaccines[key] = vaccine
-                else:
-                    # Для обычных вакцин проверяем только название
-                    if not any(v['comment'] == vaccine['comment'] 
-                              for v in unique_vaccines.values()):
-                        unique_vaccines[key] = vaccine
-        
-        # Добавляем уникальные вакцины в обработанные данные
-        processed_data.extend(unique_vaccines.values())
-    
-    # Удаляем существующие дубли перед импортом
-    print("Поиск и удаление дубликатов вакцинаций...")
-    duplicates_found = 0
-    
-    # Сначала проверяем и удаляем дубли в базе данных
-    all_vaccinations = Vaccination.query.all()
-    vaccination_keys = set()
-    
-    for vac in all_vaccinations:
-        key = (
-            vac.vaccine_name,
-            vac.date_administered,
-            vac.vaccination_type,
-            vac.pet_id,
-            vac.dose_ml
-        )
-        
-        if key in vaccination_keys:
-            # Нашли дубликат - удаляем
-            db.session.delete(vac)
-            duplicates_found += 1
-        else:
-            vaccination_keys.add(key)
-    
-    if duplicates_found > 0:
-        try:
-            db.session.commit()
-            print(f"Удалено {duplicates_found} дубликатов вакцинаций")
-        except Exception as e:
-            db.session.rollback()
-            print(f"Ошибка при удалении дубликатов: {e}")
-    
-    # Импортируем в базу данных, проверяя существующие записи
-    imported_count = 0
-    skipped_count = 0
-    
-    for vaccine in processed_data:
-        # Находим животное по номеру карточки
-        pet = Pet.query.filter_by(card_number=vaccine['actual_card_num']).first()
-        if not pet:
-            print(f"Животное с картой {vaccine['actual_card_num']} не найдено")
-            skipped_count += 1
-            continue
-        
-        # Проверяем, существует ли уже такая вакцинация
-        existing = Vaccination.query.filter_by(
-            vaccine_name=vaccine['comment'],
-            date_administered=vaccine['vac_date'],
-            vaccination_type=vaccine['type_name'],
-            pet_id=pet.id
-        ).first()
-        
-        if existing:
-            skipped_count += 1
-            continue
-        
-        # Создаем запись о вакцинации
-        try:
-            vaccination = Vaccination(
-                vaccine_name=vaccine['comment'],
-                date_administered=vaccine['vac_date'],
-                vaccination_type=vaccine['type_name'],
-                pet_id=pet.id,
-                owner_id=pet.owner_id,
-                dose_ml=1,  # Можно добавить логику для дозы, если есть данные
-                previous_vaccination_date=None,
-                next_due_date=None,
-                owner_name=pet.owner.name,
-                owner_address=pet.owner.address,
-                pet_species=pet.species,
-                pet_breed=pet.breed,
-                pet_card_number=pet.card_number,
-                pet_age=pet.pet_age()
-            )
+            # Находим животное по номеру карточки
+            pet = pet_map.get(actual_card_num)
+            if not pet:
+                print(f"Животное с картой {actual_card_num} не найдено")
+                skipped_count += 1
+                continue
+            pet_id, owner_id, species, breed, birth_date, owner_name, owner_address = pet
+            
+            # Проверяем, существует ли уже такая вакцинация
+            type_name = vaccine_type_mapping.get(vac_type, 'Неизвестно')
+            key = _vaccination_key(normalized_comment, parsed_date, type_name, pet_id)
+            if key in existing_keys:
+                skipped_count += 1
+                continue
+            existing_keys.add(key)
             
-            db.session.add(vaccination)
+            batch.append({
+                'vaccine_name': normalized_comment,
+                'date_administered': parsed_date,
+                'vaccination_type': type_name,
+                'pet_id': pet_id,
+                'owner_id': owner_id,
+                'dose_ml': 1,  # Можно добавить логику для дозы, если есть данные
+                'previous_vaccination_date': None,
+                'next_due_date': None,
+                'owner_name': owner_name,
+                'owner_address': owner_address,
+                'pet_species': species,
+                'pet_breed': breed,
+                'pet_card_number': actual_card_num,
+                'pet_age': age_in_years(birth_date, today)
+            })
             imported_count += 1
-        except Exception as e:
-            db.session.rollback()
-            print(f"Ошибка при создании вакцинации: {e}")
-            continue
+            
+            if len(batch) >= batch_size and not flush():
+                return
     
-    try:
-        db.session.commit()
+    if flush():
         print(f"Импорт завершен. Добавлено: {imported_count}, пропущено (уже существует): {skipped_count}")
-    except IntegrityError as e:
-        db.session.rollback()
-        print(f"Ошибка при сохранении вакцинаций: {e}")
 
 def import_owners_from_csv(filename):
     """
@@ -0,0 +1,196 @@
+"""
+Резервное копирование базы SQLite через backup API.
+
+Копия снимается постранично (sqlite3.Connection.backup с pages/sleep), так
+что запись в базу не блокируется на всё время копирования, а копия всегда
+согласована. Запись из другого соединения перезапускает постраничную копию
+с начала; после max_restarts перезапусков копия снимается за один шаг
+(pages=-1): в режиме WAL это чтение одного снимка, писателей оно не держит. Если файлы базы и WAL не менялись с прошлой копии, копирование
+пропускается. Сжатие (gzip или zstd, если установлен zstandard) выполняется
+в отдельном потоке; длительность и размер каждой копии пишутся в
+backup_log.jsonl рядом с копиями.
+"""
+import gzip
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+BACKUP_PREFIX = 'vet_clinic_backup_'
+STATE_FILE = 'backup_state.json'
+LOG_FILE = 'backup_log.jsonl'
+
+_backup_lock = threading.Lock()
+
+
+class _TooManyRestarts(Exception):
+    pass
+
+
+def list_backups(backup_dir):
+    """Файлы копий, от новых к старым"""
+    if not os.path.exists(backup_dir):
+        return []
+    return sorted((name for name in os.listdir(backup_dir)
+                   if name.startswith(BACKUP_PREFIX) and not name.endswith('.partial')),
+                  reverse=True)
+
+
+def database_fingerprint(db_file):
+    """Размер и время изменения файла базы и WAL: меняются при любой записи и checkpoint"""
+    fingerprint = []
+    for path in (db_file, db_file + '-wal'):
+        try:
+            stat = os.stat(path)
+            fingerprint.append([stat.st_size, stat.st_mtime_ns])
+        except FileNotFoundError:
+            fingerprint.append(None)
+    return fingerprint
+
+
+def _read_state(backup_dir):
+    try:
+        with open(os.path.join(backup_dir, STATE_FILE), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_state(backup_dir, state):
+    path = os.path.join(backup_dir, STATE_FILE)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+
+def _log_backup(backup_dir, record):
+    logger.info("Backup %s: %s bytes in %.2fs", record['file'], record['bytes'], record['seconds'])
+    with open(os.path.join(backup_dir, LOG_FILE), 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+def _remove_old_backups(backup_dir, keep):
+    for old_backup in list_backups(backup_dir)[keep:]:
+        os.remove(os.path.join(backup_dir, old_backup))
+
+
+def _compress(path, compression):
+    """Сжимает файл копии; возвращает путь к сжатому файлу"""
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            logger.warning("zstandard is not installed, falling back to gzip")
+            compression = 'gzip'
+        else:
+            target = path + '.zst'
+            with open(path, 'rb') as src, open(target, 'wb') as dst:
+                zstandard.ZstdCompressor(level=3).copy_stream(src, dst)
+            os.remove(path)
+            return target
+    target = path + '.gz'
+    with open(path, 'rb') as src, gzip.open(target, 'wb', compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    os.remove(path)
+    return target
+
+
+def _finish_backup(backup_dir, path, record, compression, keep):
+    try:
+        if compression:
+            started = time.perf_counter()
+            path = _compress(path, compression)
+            record['compress_seconds'] = round(time.perf_counter() - started, 3)
+            record['file'] = os.path.basename(path)
+            record['compressed_bytes'] = os.path.getsize(path)
+        _log_backup(backup_dir, record)
+        _remove_old_backups(backup_dir, keep)
+    except Exception as e:
+        logger.error("Backup post-processing failed: %s", e)
+
+
+def _copy_database(source, target, pages_per_step, step_sleep, max_restarts):
+    """Постраничная копия source в target; возвращает (перезапуски, был ли один шаг)"""
+    restarts = 0
+    copied = 0
+
+    def progress(status, remaining, total):
+        nonlocal restarts, copied
+        # Перезапуск копии виден как уменьшение числа уже скопированных страниц
+        if total - remaining < copied:
+            restarts += 1
+            if restarts > max_restarts:
+                raise _TooManyRestarts()
+        copied = total - remaining
+
+    try:
+        source.backup(target, pages=pages_per_step, progress=progress, sleep=step_sleep)
+        return restarts, False
+    except _TooManyRestarts:
+        source.backup(target, pages=-1)
+        return restarts, True
+
+
+def create_backup(db_file, backup_dir, pages_per_step=256, step_sleep=0.05,
+                  compression=None, keep=10, force=False, max_restarts=3):
+    """Онлайн-копия db_file в backup_dir.
+
+    Возвращает словарь со статусом 'success', 'skipped' (данные не менялись)
+    или 'error'. Сжатие выполняется в фоновом потоке после возврата.
+    """
+    if not os.path.exists(db_file):
+        return {'status': 'error', 'message': 'Database file not found'}
+    os.makedirs(backup_dir, exist_ok=True)
+
+    with _backup_lock:
+        state = _read_state(backup_dir)
+        fingerprint = database_fingerprint(db_file)
+        if not force and state.get('fingerprint') == fingerprint and list_backups(backup_dir):
+            return {'status': 'skipped', 'message': 'Database unchanged since {}'.format(state.get('file'))}
+
+        stem = BACKUP_PREFIX + datetime.now().strftime('%Y%m%d_%H%M%S')
+        # Несколько копий в одну секунду (ручная сразу после плановой) получают суффикс
+        suffix = 0
+        while any(name.startswith(stem + ('_{}'.format(suffix) if suffix else '') + '.')
+                  for name in os.listdir(backup_dir)):
+            suffix += 1
+        if suffix:
+            stem = '{}_{}'.format(stem, suffix)
+        backup_file = os.path.join(backup_dir, stem + '.db')
+        partial_file = backup_file + '.partial'
+
+        started = time.perf_counter()
+        source = sqlite3.connect(db_file)
+        target = sqlite3.connect(partial_file)
+        try:
+            # Постраничное копирование: между шагами писатели получают доступ к базе
+            restarts, single_step = _copy_database(source, target, pages_per_step, step_sleep, max_restarts)
+        finally:
+            target.close()
+            source.close()
+        os.replace(partial_file, backup_file)
+
+        record = {
+            'file': os.path.basename(backup_file),
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'seconds': round(time.perf_counter() - started, 3),
+            'bytes': os.path.getsize(backup_file),
+            'restarts': restarts,
+            'single_step': single_step,
+        }
+        _write_state(backup_dir, {'fingerprint': fingerprint, 'file': record['file']})
+
+    if compression:
+        threading.Thread(target=_finish_backup, name='backup-compress', daemon=True,
+                         args=(backup_dir, backup_file, record, compression, keep)).start()
+    else:
+        _finish_backup(backup_dir, backup_file, record, None, keep)
+
+    return {'status': 'success', 'message': 'Backup created: {}'.format(backup_file),
+            'seconds': record['seconds'], 'bytes': record['bytes']}
@@ -0,0 +1,199 @@
+"""
+Подготовленный конвейер ML диагностики.
+
+Строится один раз при загрузке модели: словарь "признак -> столбец",
+цепочка scaler -> feature_selector -> model и расшифровка классов.
+Кодирование одного случая стоит O(k) по числу симптомов, а не O(k·F).
+"""
+import threading
+
+import numpy as np
+
+from ml.ranking import top_k_indices
+
+
+class DiagnosisPipeline:
+    """Обёртка над загруженной моделью (взвешенной, улучшенной или стандартной)"""
+
+    def __init__(self, model_data):
+        self.model_data = model_data
+        self.kind = self._detect_kind(model_data)
+        if self.kind == 'object':
+            return
+
+        self.model = model_data['model']
+        self.scaler = model_data['scaler']
+        self.feature_selector = model_data.get('feature_selector') if self.kind != 'standard' else None
+        self.feature_names = list(model_data['feature_names'])
+        self.feature_index = {name: idx for idx, name in enumerate(self.feature_names)}
+        self.n_features = len(self.feature_names)
+
+        # Код вида животного (только для взвешенной модели)
+        self.animal_type_index = self.feature_index.get('animal_type_encoded')
+        self.animal_type_codes = {}
+        if self.kind == 'weighted' and self.animal_type_index is not None:
+            encoder = model_data['animal_type_encoder']
+            self.animal_type_codes = {
+                name: code for code, name in enumerate(encoder.classes_)
+            }
+
+        self.classes, self.labels = self._prepare_classes(model_data)
+        self._local = threading.local()
+
+    @staticmethod
+    def _detect_kind(model_data):
+        if not isinstance(model_data, dict):
+            return 'object'
+        if 'animal_type_encoder' in model_data:
+            return 'weighted'
+        if 'feature_selector' in model_data:
+            return 'improved'
+        return 'standard'
+
+    def _prepare_classes(self, model_data):
+        """Классы модели и соответствующие им названия заболеваний"""
+        if hasattr(self.model, 'classes_'):
+            classes = np.asarray(self.model.classes_)
+        else:
+            classes = np.asarray(model_data.get('diseases', []))
+
+        if self.kind == 'weighted':
+            labels = model_data['label_encoder'].inverse_transform(classes)
+        else:
+            labels = classes
+        return classes, [label.item() if hasattr(label, 'item') else label for label in labels]
+
+    def _lab_feature(self, lab_name, lab_value):
+        if self.kind == 'standard':
+            return lab_name
+        return "lab_{}_{}".format(lab_name, lab_value)
+
+    def feature_columns(self, animal_type, symptoms, lab_analyses):
+        """Номера столбцов и значения для ненулевых признаков случая"""
+        columns = []
+        values = []
+        index = self.feature_index
+        for symptom in symptoms:
+            idx = index.get(symptom)
+            if idx is not None:
+                columns.append(idx)
+                values.append(1.0)
+        for lab_name, lab_value in (lab_analyses or {}).items():
+            idx = index.get(self._lab_feature(lab_name, lab_value))
+            if idx is not None:
+                columns.append(idx)
+                values.append(1.0)
+        if self.animal_type_index is not None and animal_type in self.animal_type_codes:
+            columns.append(self.animal_type_index)
+            values.append(float(self.animal_type_codes[animal_type]))
+        return columns, values
+
+    def _buffer(self):
+        """Предвыделенный вектор признаков для текущего потока"""
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None:
+            buffer = np.zeros((1, self.n_features))
+            self._local.buffer = buffer
+        return buffer
+
+    def encode(self, animal_type, symptoms, lab_analyses=None):
+        columns, values = self.feature_columns(animal_type, symptoms, lab_analyses)
+        buffer = self._buffer()
+        buffer[0, columns] = values
+        return buffer, columns
+
+    def transform(self, features):
+        """scaler -> feature_selector"""
+        features = self.scaler.transform(features)
+        if self.feature_selector is not None:
+            features = self.feature_selector.transform(features)
+        return features
+
+    def predict_proba(self, features):
+        """Вероятности классов для матрицы признаков"""
+        transformed = self.transform(features)
+        if hasattr(self.model, 'predict_proba'):
+            return self.model.predict_proba(transformed)
+
+        if self.kind == 'standard' and hasattr(self.model, 'decision_function'):
+            scores = np.atleast_2d(self.model.decision_function(transformed))
+            exp_scores = np.exp(scores)
+            return exp_scores / exp_scores.sum(axis=1, keepdims=True)
+
+        # Модель без вероятностей: единица у предсказанного класса
+        probabilities = np.zeros((transformed.shape[0], len(self.classes)))
+        if self.kind == 'standard':
+            probabilities[:] = 1.0 / max(len(self.classes), 1)
+            return probabilities
+        predictions = self.model.predict(transformed)
+        class_index = {cls: idx for idx, cls in enumerate(self.classes.tolist())}
+        for row, prediction in enumerate(predictions):
+            idx = class_index.get(prediction)
+            if idx is not None:
+                probabilities[row, idx] = 1.0
+        return probabilities
+
+    def encode_batch(self, cases):
+        """Матрица признаков (n_cases x F) для списка случаев.
+
+        Ненулевые элементы собираются в координатном виде, как для
+        разреженной матрицы. Если scaler не центрирует данные (with_mean=False),
+        матрица остаётся разреженной CSR, иначе заполняется плотный массив.
+        """
+        rows, columns, values = [], [], []
+        for row, case in enumerate(cases):
+            case_columns, case_values = self.feature_columns(
+                case.get('animal_type'), case.get('symptoms', []), case.get('lab_analyses', {})
+            )
+            rows.extend([row] * len(case_columns))
+            columns.extend(case_columns)
+            values.extend(case_values)
+
+        shape = (len(cases), self.n_features)
+        if getattr(self.scaler, 'with_mean', True) is False:
+            try:
+                from scipy.sparse import csr_matrix
+                return csr_matrix((values, (rows, columns)), shape=shape)
+            except ImportError:
+                pass
+        features = np.zeros(shape)
+        features[rows, columns] = values
+        return features
+
+    def top_predictions_batch(self, probabilities, top_k=5):
+        """Топ-k по каждой строке матрицы вероятностей"""
+        labels = self.labels
+        return [
+            [[labels[idx], float(row_probs[idx])] for idx in row_indices]
+            for row_indices, row_probs in zip(top_k_indices(probabilities, top_k).tolist(), probabilities)
+        ]
+
+    def predict_batch(self, cases, top_k=5):
+        """Топ-k заболеваний для списка случаев одним вызовом модели"""
+        if self.kind == 'object':
+            predictor = getattr(self.model_data, 'predict_batch', None)
+            if predictor is not None:
+                return predictor(cases, top_k=top_k)
+            return [self.predict(case.get('animal_type'), case.get('symptoms', []),
+                                 case.get('lab_analyses', {}), top_k) for case in cases]
+        if not cases:
+            return []
+        probabilities = self.predict_proba(self.encode_batch(cases))
+        return self.top_predictions_batch(probabilities, top_k)
+
+    def top_predictions(self, probabilities, top_k=5):
+        return [[self.labels[idx], float(probabilities[idx])] for idx in top_k_indices(probabilities, top_k)[0]]
+
+    def predict(self, animal_type, symptoms, lab_analyses=None, top_k=5):
+        """Топ-k заболеваний для одного случая: [[название, вероятность], ...]"""
+        if self.kind == 'object':
+            predictor = getattr(self.model_data, 'predict_diseases', None) or self.model_data.predict
+            return predictor(animal_type, symptoms)
+
+        features, columns = self.encode(animal_type, symptoms, lab_analyses)
+        try:
+            probabilities = self.predict_proba(features)[0]
+        finally:
+            # Возвращаем буфер в нулевое состояние за O(k)
+            features[0, columns] = 0.0
+        return self.top_predictions(probabilities, top_k)
@@ -0,0 +1,143 @@
+"""
+Шаблоны DOCX (docxtpl) с отложенным импортом и кэшем разобранных шаблонов.
+
+docxtpl тянет python-docx, lxml и docxcompose, а карточки печатаются
+редко, поэтому библиотека импортируется при первой печати. Шаблон
+разбирается один раз: в памяти хранится нетронутый документ, результат
+patch_xml и скомпилированные шаблоны Jinja. Для каждого заполнения
+берётся копия документа. Если файл шаблона изменился (mtime), он
+перечитывается при следующем обращении.
+
+render_many() заполняет шаблон для многих контекстов в пуле потоков (пул
+процессов внутри веб-сервера при spawn заново импортировал бы приложение в
+каждом процессе), combine_documents() склеивает готовые документы в один
+многостраничный.
+"""
+import copy
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+# Меньше документов заполняется в текущем потоке: запуск пула дороже
+MIN_POOL_BATCH = 8
+
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+class CompiledTemplate:
+    """Разобранный шаблон DOCX и кэши его подготовки"""
+
+    def __init__(self, path):
+        from docx import Document
+        from jinja2 import Environment
+
+        class CachingEnvironment(Environment):
+            """Компилирует каждый исходный текст шаблона один раз"""
+
+            def __init__(self):
+                super().__init__()
+                self.compiled = {}
+
+            def from_string(self, source, globals=None, template_class=None):
+                if globals is not None or template_class is not None:
+                    return super().from_string(source, globals, template_class)
+                template = self.compiled.get(source)
+                if template is None:
+                    template = self.compiled[source] = super().from_string(source)
+                return template
+
+        self.path = path
+        self.mtime = os.stat(path).st_mtime_ns
+        with open(path, 'rb') as f:
+            self.document = Document(io.BytesIO(f.read()))
+        self.jinja_env = CachingEnvironment()
+        self.patched = {}
+
+    def new_document(self):
+        """Копия нетронутого документа для одного заполнения"""
+        return copy.deepcopy(self.document)
+
+
+def get_template(path):
+    """Кэшированный CompiledTemplate для path; перечитывается при изменении файла"""
+    mtime = os.stat(path).st_mtime_ns
+    compiled = _templates.get(path)
+    if compiled is None or compiled.mtime != mtime:
+        with _templates_lock:
+            compiled = _templates.get(path)
+            if compiled is None or compiled.mtime != mtime:
+                compiled = _templates[path] = CompiledTemplate(path)
+    return compiled
+
+
+def load_template(path):
+    """Шаблон DOCX для заполнения: копия разобранного документа из кэша"""
+    from docxtpl import DocxTemplate
+
+    class CachedDocxTemplate(DocxTemplate):
+        def __init__(self, compiled):
+            super().__init__(compiled.path)
+            self.compiled = compiled
+            self.docx = compiled.new_document()
+
+        def patch_xml(self, src_xml):
+            patched = self.compiled.patched.get(src_xml)
+            if patched is None:
+                patched = self.compiled.patched[src_xml] = super().patch_xml(src_xml)
+            return patched
+
+        def render(self, context, jinja_env=None, autoescape=False):
+            if jinja_env is None and not autoescape:
+                jinja_env = self.compiled.jinja_env
+            super().render(context, jinja_env, autoescape)
+
+    return CachedDocxTemplate(get_template(path))
+
+
+def render_to_bytes(path, context):
+    """Заполняет шаблон path значениями context и возвращает DOCX в байтах"""
+    doc = load_template(path)
+    doc.render(context)
+    stream = io.BytesIO()
+    doc.save(stream)
+    return stream.getvalue()
+
+
+def render_many(path, contexts, workers=1):
+    """DOCX в байтах для каждого контекста, в том же порядке.
+
+    При workers > 1 документы заполняются в пуле потоков: шаблон уже
+    разобран один раз, а на каждый документ приходятся в основном копирование
+    XML и сжатие ZIP.
+    """
+    contexts = list(contexts)
+    if workers <= 1 or len(contexts) < MIN_POOL_BATCH:
+        return [render_to_bytes(path, context) for context in contexts]
+    get_template(path)  # Разбор шаблона - один раз до запуска потоков
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='docx-render') as executor:
+        return list(executor.map(partial(render_to_bytes, path), contexts))
+
+
+def combine_documents(documents):
+    """Склеивает DOCX (байты) в один документ; каждый начинается с новой страницы"""
+    from docx import Document
+    from docx.oxml.ns import qn
+    from docx.text.paragraph import Paragraph
+    from docxcompose.composer import Composer
+
+    master = Document(io.BytesIO(documents[0]))
+    composer = Composer(master)
+    for document in documents[1:]:
+        doc = Document(io.BytesIO(document))
+        first = doc.element.body[0] if len(doc.element.body) else None
+        if first is not None and first.tag == qn('w:p'):
+            Paragraph(first, doc).paragraph_format.page_break_before = True
+        else:
+            master.add_page_break()
+        composer.append(doc)
+    stream = io.BytesIO()
+    composer.save(stream)
+    return stream.getvalue()
@@ -0,0 +1,199 @@
+"""
+Постраничный вывод по ключу сортировки (keyset / seek).
+
+Следующая страница выбирается условием "строки после ключа последней
+показанной строки" по индексу сортировки, а не через OFFSET, поэтому
+дальние страницы открываются так же быстро, как первые. Ключ передаётся
+в ссылках непрозрачным подписанным курсором. Первые NUMBERED_PAGES
+страниц по-прежнему доступны по номеру: OFFSET на них дешёвый.
+
+Общее количество строк можно посчитать точно (COUNT по запросу) или
+оценить (estimate_rows: max(id) таблицы, без просмотра строк).
+Интерфейс совпадает с Pagination из Flask-SQLAlchemy в той части, которую
+используют шаблоны (items, page, pages, total, has_prev, has_next,
+iter_pages), плюс prev_args/next_args/page_args для ссылок.
+"""
+import math
+from datetime import date, datetime
+
+from itsdangerous import BadSignature, URLSafeSerializer
+from sqlalchemy import and_, func, or_
+
+NUMBERED_PAGES = 10
+
+
+def estimate_rows(session, model):
+    """Приблизительное число строк таблицы: max(id) по первичному ключу, O(log n)"""
+    return session.query(func.max(model.id)).scalar() or 0
+
+
+def _dump_value(value):
+    if isinstance(value, datetime):
+        return {'dt': value.isoformat()}
+    if isinstance(value, date):
+        return {'d': value.isoformat()}
+    return value
+
+
+def _load_value(value):
+    if isinstance(value, dict):
+        if 'dt' in value:
+            return datetime.fromisoformat(value['dt'])
+        return date.fromisoformat(value['d'])
+    return value
+
+
+class KeysetPagination:
+    """Страница запроса query, упорядоченного по order.
+
+    order - список пар (столбец, по убыванию); последний столбец должен
+    быть уникальным (обычно id). total: 'exact' - точный COUNT, число -
+    готовая оценка, None - не считать.
+    """
+
+    def __init__(self, query, order, secret_key, scope, page=1, cursor=None, per_page=10,
+                 total='exact', numbered_pages=NUMBERED_PAGES):
+        self.order = order
+        self.per_page = per_page
+        self.numbered_pages = numbered_pages
+        self._serializer = URLSafeSerializer(secret_key, salt='keyset:{}'.format(scope))
+
+        if total == 'exact':
+            self.total = query.order_by(None).count()
+            self.total_is_estimate = False
+        else:
+            self.total = total
+            self.total_is_estimate = total is not None
+        self.pages = max(1, math.ceil(self.total / per_page)) if self.total is not None else None
+
+        position = self._load_cursor(cursor) if cursor else None
+        if position is None:
+            self.page = max(page or 1, 1)
+            rows = self._ordered(query).offset((self.page - 1) * per_page).limit(per_page + 1).all()
+            self.items = rows[:per_page]
+            self.has_next = len(rows) > per_page
+            self.has_prev = self.page > 1
+        else:
+            keys, self.page, direction = position
+            if direction in ('next', 'at'):
+                seek = self._seek(keys, after=True, inclusive=direction == 'at')
+                rows = self._ordered(query.filter(seek)).limit(per_page + 1).all()
+                self.items = rows[:per_page]
+                self.has_next = len(rows) > per_page
+                self.has_prev = self.page > 1
+            elif direction == 'prev':
+                rows = self._ordered(query.filter(self._seek(keys, after=False)), reverse=True)\
+                    .limit(per_page + 1).all()
+                self.items = rows[:per_page][::-1]
+                self.has_prev = len(rows) > per_page
+                self.has_next = True
+            else:  # last
+                last_count = (self.total - 1) % per_page + 1 if self.total else per_page
+                self.items = self._ordered(query, reverse=True).limit(last_count).all()[::-1]
+                self.has_next = False
+                self.has_prev = self.page > 1
+            if not self.has_prev:
+                self.page = 1
+        if self.pages is not None and self.page > self.pages and self.items:
+            self.pages = self.page
+
+    # --- запросы ---
+
+    def _ordered(self, query, reverse=False):
+        clauses = []
+        for column, descending in self.order:
+            clauses.append(column.desc() if descending != reverse else column.asc())
+        return query.order_by(None).order_by(*clauses)
+
+    def _seek(self, keys, after, inclusive=False):
+        """Строки после (after) или до ключа keys в порядке вывода"""
+        conditions = [and_(*[column == key for (column, _), key in zip(self.order, keys)])] if inclusive else []
+        for i, (column, descending) in enumerate(self.order):
+            # После ключа по возрастанию - больше, по убыванию - меньше
+            step = column > keys[i] if descending != after else column < keys[i]
+            conditions.append(and_(*[self.order[j][0] == keys[j] for j in range(i)], step))
+        return or_(*conditions)
+
+    # --- курсоры ---
+
+    def _item_keys(self, item):
+        return [_dump_value(getattr(item, column.key)) for column, _ in self.order]
+
+    def _make_cursor(self, keys, page, direction):
+        return self._serializer.dumps({'k': keys, 'p': page, 'd': direction})
+
+    def _load_cursor(self, cursor):
+        try:
+            data = self._serializer.loads(cursor)
+            keys = [_load_value(value) for value in data['k']] if data['k'] is not None else None
+            page, direction = int(data['p']), data['d']
+        except (BadSignature, KeyError, TypeError, ValueError):
+            return None
+        if direction not in ('next', 'prev', 'at', 'last') or (direction != 'last' and len(keys) != len(self.order)):
+            return None
+        return keys, page, direction
+
+    # --- навигация для шаблонов ---
+
+    @property
+    def prev_num(self):
+        return self.page - 1 if self.has_prev else None
+
+    @property
+    def next_num(self):
+        return self.page + 1 if self.has_next else None
+
+    @property
+    def prev_args(self):
+        """Параметры ссылки на предыдущую страницу: номер для первых страниц, иначе курсор"""
+        if self.page - 1 <= self.numbered_pages or not self.items:
+            return {'page': self.page - 1}
+        return {'cursor': self._make_cursor(self._item_keys(self.items[0]), self.page - 1, 'prev')}
+
+    @property
+    def next_args(self):
+        if self.page + 1 <= self.numbered_pages or not self.items:
+            return {'page': self.page + 1}
+        return {'cursor': self._make_cursor(self._item_keys(self.items[-1]), self.page + 1, 'next')}
+
+    def page_args(self, page):
+        """Параметры ссылки на страницу page из iter_pages()"""
+        if page == self.page - 1:
+            return self.prev_args
+        if page == self.page + 1:
+            return self.next_args
+        if page <= self.numbered_pages:
+            return {'page': page}
+        if page == self.page and self.items:
+            return {'cursor': self._make_cursor(self._item_keys(self.items[0]), page, 'at')}
+        if page == self.pages and not self.total_is_estimate:
+            return {'cursor': self._make_cursor(None, page, 'last')}
+        return {'page': page}
+
+    def _linkable(self, page):
+        if page == self.page + 1:
+            return self.has_next
+        if page == self.page - 1:
+            return self.has_prev
+        return (page <= self.numbered_pages or page == self.page
+                or (page == self.pages and not self.total_is_estimate))
+
+    def iter_pages(self, left_edge=2, left_current=2, right_current=4, right_edge=2):
+        """Номера страниц для навигации (None - пропуск), как в Flask-SQLAlchemy.
+
+        Дальние страницы без курсора недоступны и тоже заменяются пропуском.
+        """
+        last = max(self.pages or self.page, self.page)
+        previous = 0
+        for page in range(1, last + 1):
+            in_window = (page <= left_edge
+                         or self.page - left_current - 1 < page < self.page + right_current
+                         or page > last - right_edge)
+            if not in_window or not self._linkable(page):
+                continue
+            if page != previous + 1:
+                yield None
+            yield page
+            previous = page
+        if previous < last:
+            yield None
@@ -14,6 +14,7 @@ from sklearn.linear_model import LogisticRegression
 from sklearn.svm import SVC
 from sklearn.metrics import accuracy_score, classification_report
 import joblib
+from ranking import top_k_indices
 
 class AnimalDiseaseClassifier:
     """
@@ -655,7 +656,7 @@ class AnimalDiseaseClassifier:
         probabilities = self.model.predict_proba(symptom_vector_scaled)[0]
         
         # Получение топ-5 предсказаний
-        top_indices = np.argsort(probabilities)[::-1][:5]
+        top_indices = top_k_indices(probabilities, 5)[0]
         
         predictions = []
         for idx in top_indices:
@@ -665,6 +666,51 @@ class AnimalDiseaseClassifier:
         
         return predictions
 
+    def predict_batch(self, cases, top_k=5):
+        """
+        Предсказание для списка случаев одним вызовом модели.
+        
+        cases - список словарей {'animal_type': ..., 'symptoms': [...]}.
+        Возвращает для каждого случая топ-k пар [заболевание, вероятность].
+        """
+        if self.model is None:
+            print("Модель не обучена или не загружена")
+            return None
+        
+        if not cases:
+            return []
+        
+        # Индекс признаков строим один раз на весь пакет
+        feature_index = {name: idx for idx, name in enumerate(self.feature_names)}
+        
+        # Координаты ненулевых элементов матрицы симптомов
+        rows = []
+        columns = []
+        for row, case in enumerate(cases):
+            for symptom in case.get('symptoms', []):
+                idx = feature_index.get(symptom)
+                if idx is not None:
+                    rows.append(row)
+                    columns.append(idx)
+        
+        symptom_matrix = np.zeros((len(cases), len(self.feature_names)))
+        symptom_matrix[rows, columns] = 1
+        
+        # Масштабирование и предсказание для всей матрицы сразу
+        probabilities = self.model.predict_proba(self.scaler.transform(symptom_matrix))
+        classes = self.model.classes_
+        
+        # Топ-k тем же способом, что и для одного случая
+        top_indices = top_k_indices(probabilities, top_k)
+        
+        results = []
+        for row in range(len(cases)):
+            results.append([
+                [classes[idx], probabilities[row, idx]] for idx in top_indices[row]
+            ])
+        
+        return results
+
 def main():
     """
     Основная функция для обучения модели
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Выбор k самых вероятных диагнозов.
+
+Общий для модели (ml_model.py, импорт из каталога ml) и конвейера
+диагностики приложения (diagnosis_pipeline.py, импорт как ml.ranking),
+чтобы одиночные и пакетные предсказания упорядочивали равные вероятности
+одинаково.
+"""
+
+import numpy as np
+
+
+def top_k_indices(probabilities, top_k=5):
+    """Номера k самых вероятных классов для каждой строки матрицы вероятностей.
+
+    Порядок - по убыванию вероятности, при равенстве - по номеру класса.
+    Используется и для одного случая, и для пакета, чтобы порядок совпадал.
+    """
+    probabilities = np.atleast_2d(probabilities)
+    n_classes = probabilities.shape[1]
+    k = min(top_k, n_classes)
+    if k <= 0:
+        return np.empty((probabilities.shape[0], 0), dtype=int)
+    if k < n_classes:
+        # Порог k-й вероятности через np.partition вместо полной сортировки; из классов,
+        # равных порогу, берутся первые по номеру, чтобы выбор не зависел от разбиения
+        kth = -np.partition(-probabilities, k - 1, axis=1)[:, k - 1:k]
+        above = probabilities > kth
+        at_kth = probabilities == kth
+        needed = k - above.sum(axis=1, keepdims=True)
+        selected = above | (at_kth & (np.cumsum(at_kth, axis=1) <= needed))
+        candidates = np.nonzero(selected)[1].reshape(-1, k)
+    else:
+        candidates = np.tile(np.arange(n_classes), (probabilities.shape[0], 1))
+    candidate_probs = np.take_along_axis(probabilities, candidates, axis=1)
+    order = np.lexsort((candidates, -candidate_probs), axis=-1)
+    return np.take_along_axis(candidates, order, axis=1)
@@ -0,0 +1,18 @@
+"""
+Ленивая загрузка ML-стека (joblib, numpy, scikit-learn).
+
+ML по умолчанию выключена, поэтому библиотеки модели импортируются при
+первой загрузке модели, а не при старте приложения.
+"""
+
+
+def load_model(model_path, mmap_mode=None):
+    """Читает сохранённую модель через joblib"""
+    import joblib
+    return joblib.load(model_path, mmap_mode=mmap_mode)
+
+
+def build_pipeline(model_data):
+    """Подготовленный конвейер диагностики для загруженной модели"""
+    from diagnosis_pipeline import DiagnosisPipeline
+    return DiagnosisPipeline(model_data)
@@ -4,7 +4,15 @@ from flask_sqlalchemy import SQLAlchemy
 
 db = SQLAlchemy()
 
+def age_in_years(birth_date, on_date=None):
+    """Полных лет от birth_date до on_date (по умолчанию - сегодня)"""
+    on_date = on_date or datetime.today().date()
+    return on_date.year - birth_date.year - ((on_date.month, on_date.day) < (birth_date.month, birth_date.day))
+
 class Owner(db.Model):
+    __table_args__ = (
+        db.Index('ix_owner_name', 'name'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(150), nullable=False)
     address = db.Column(db.String(250), nullable=False)
@@ -13,6 +21,9 @@ class Owner(db.Model):
     appointments = db.relationship('Appointment', backref='owner', lazy=True ,  cascade='all, delete-orphan')
 
 class Pet(db.Model):
+    __table_args__ = (
+        db.Index('ix_pet_owner_id', 'owner_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     owner_id = db.Column(db.Integer, db.ForeignKey('owner.id'), nullable=False)
     name = db.Column(db.String(100), nullable=False)
@@ -27,8 +38,7 @@ class Pet(db.Model):
     appointments = db.relationship('Appointment', backref='pet', lazy=True,  cascade='all, delete-orphan')
     vaccinations = db.relationship('Vaccination', backref='pet', lazy=True,  cascade='all, delete-orphan')
     def pet_age(self):
-        today = datetime.today().date()
-        return today.year - self.birth_date.year - ((today.month, today.day) < (self.birth_date.month, self.birth_date.day))
+        return age_in_years(self.birth_date)
     def vaccination_age(self, vaccination_date):
         """Возраст на момент вакцинации в формате 'X г Y м Z д' с пропуском нулевых значений"""
         delta = relativedelta(vaccination_date, self.birth_date)
@@ -52,6 +62,10 @@ class Pet(db.Model):
         return " ".join(age_parts) if age_parts else "0 д"
 
 class Appointment(db.Model):
+    __table_args__ = (
+        db.Index('ix_appointment_appointment_date', 'appointment_date'),
+        db.Index('ix_appointment_pet_id', 'pet_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     appointment_date = db.Column(db.String(10), nullable=False)
     time = db.Column(db.String(5), nullable=False)
@@ -73,6 +87,14 @@ class Note(db.Model):
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
 class Vaccination(db.Model):
+    __table_args__ = (
+        # Последняя вакцинация животного по типу, отчёт по бешенству
+        db.Index('ix_vaccination_pet_type_date', 'pet_id', 'vaccination_type', 'date_administered'),
+        # Выборки за период (статистика, отчёты)
+        db.Index('ix_vaccination_date_administered', 'date_administered'),
+        db.Index('ix_vaccination_type_date', 'vaccination_type', 'date_administered'),
+        db.Index('ix_vaccination_owner_id', 'owner_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     vaccine_name = db.Column(db.String(100), nullable=False)
     date_administered = db.Column(db.Date, nullable=False)
@@ -104,10 +126,58 @@ class Treatment(db.Model):
         return f'<Treatment {self.name} ({self.price} руб./{self.unit})>'
     
 class AppointmentTreatment(db.Model):
+    __table_args__ = (
+        db.Index('ix_appointment_treatment_appointment_id', 'appointment_id'),
+        db.Index('ix_appointment_treatment_treatment_id', 'treatment_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     appointment_id = db.Column(db.Integer, db.ForeignKey('appointment.id'), nullable=False)
     treatment_id = db.Column(db.Integer, db.ForeignKey('treatment.id'), nullable=False)
     quantity = db.Column(db.Float, nullable=False)
     total_price = db.Column(db.Float, nullable=False)
     notes = db.Column(db.Text, default='')
-    treatment = db.relationship('Treatment', lazy='joined')
\ No newline at end of file
+    treatment = db.relationship('Treatment', lazy='joined')
+
+class StatisticsSnapshot(db.Model):
+    """Дневные агрегаты для страницы статистики.
+
+    metric: 'vaccination' (dimension - тип вакцинации, detail - название вакцины),
+    'appointment', 'treatment' (dimension - id назначения), 'new_pet' и
+    'first_seen_pet' (количество животных, впервые появившихся в этот день).
+    """
+    __tablename__ = 'statistics_snapshot'
+    __table_args__ = (
+        db.Index('ix_statistics_snapshot_metric_day', 'metric', 'day'),
+        db.Index('ix_statistics_snapshot_metric_year_month', 'metric', 'year', 'month'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    metric = db.Column(db.String(20), nullable=False)
+    day = db.Column(db.Date, nullable=False)
+    year = db.Column(db.Integer, nullable=False)
+    month = db.Column(db.Integer, nullable=False)
+    dimension = db.Column(db.String(150), nullable=False, default='')
+    detail = db.Column(db.String(150), nullable=False, default='')
+    count = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Float, nullable=False, default=0)
+
+
+class CardNumberGap(db.Model):
+    """Интервал свободных числовых номеров карточек [first_number, last_number].
+
+    Интервал с last_number = NULL - "хвост" после максимального занятого номера.
+    """
+    __tablename__ = 'card_number_gap'
+    id = db.Column(db.Integer, primary_key=True)
+    first_number = db.Column(db.Integer, nullable=False, index=True)
+    last_number = db.Column(db.Integer, nullable=True, index=True)
+
+class OwnerPhone(db.Model):
+    """Нормализованный номер телефона владельца (375XXXXXXXXX), по строке на номер.
+
+    number_reversed - номер задом наперёд для поиска по последним цифрам.
+    """
+    __tablename__ = 'owner_phone'
+    id = db.Column(db.Integer, primary_key=True)
+    owner_id = db.Column(db.Integer, db.ForeignKey('owner.id'), nullable=False, index=True)
+    number = db.Column(db.String(12), nullable=False, index=True)
+    number_reversed = db.Column(db.String(12), nullable=False, index=True)
@@ -0,0 +1,161 @@
+"""
+Индекс нормализованных телефонов владельцев.
+
+Каждый валидный номер из Owner.phone хранится отдельной строкой таблицы
+owner_phone (через phone_normalizer.normalize_phone) вместе с перевёрнутой
+копией. Поиск по номеру целиком, по началу и по последним цифрам идёт по
+индексам, без просмотра всей таблицы владельцев. Таблица обновляется
+событиями SQLAlchemy при сохранении владельца; после пакетного импорта её
+перестраивает rebuild_owner_phone_index() (`flask backfill-owner-phones`).
+"""
+from sqlalchemy import and_, event, func, insert, or_, select
+
+from models import Owner, OwnerPhone, db
+from phone_normalizer import normalize_many, normalize_phone
+
+phones = OwnerPhone.__table__
+
+# Минимум цифр для поиска по началу или концу номера
+MIN_PARTIAL_DIGITS = 3
+
+_table_exists = False
+_index_checked = False
+
+
+def phone_rows(owner_id, phone, result=None):
+    """Строки owner_phone для одного владельца (result - готовый результат нормализации)"""
+    result = result or normalize_phone(phone or '')
+    return [
+        {'owner_id': owner_id, 'number': number, 'number_reversed': number[::-1]}
+        for number in result['valid']
+    ]
+
+
+def _has_table(connection):
+    global _table_exists
+    if not _table_exists:
+        _table_exists = db.inspect(connection).has_table(phones.name)
+    return _table_exists
+
+
+def _replace_phones(connection, owner_id, phone):
+    connection.execute(phones.delete().where(phones.c.owner_id == owner_id))
+    rows = phone_rows(owner_id, phone)
+    if rows:
+        connection.execute(insert(phones), rows)
+
+
+def _after_insert(mapper, connection, target):
+    if _has_table(connection):
+        _replace_phones(connection, target.id, target.phone)
+
+
+def _after_update(mapper, connection, target):
+    if db.inspect(target).attrs.phone.history.has_changes() and _has_table(connection):
+        _replace_phones(connection, target.id, target.phone)
+
+
+def _after_delete(mapper, connection, target):
+    if _has_table(connection):
+        connection.execute(phones.delete().where(phones.c.owner_id == target.id))
+
+
+event.listen(Owner, 'after_insert', _after_insert)
+event.listen(Owner, 'after_update', _after_update)
+event.listen(Owner, 'after_delete', _after_delete)
+
+
+def rebuild_owner_phone_index(batch_size=1000):
+    """Полное заполнение owner_phone по текущим телефонам владельцев.
+
+    Возвращает количество записанных номеров.
+    """
+    global _table_exists
+    phones.create(bind=db.engine, checkfirst=True)
+    _table_exists = True
+    db.session.execute(phones.delete())
+
+    written = 0
+    batch = []
+    owners = db.session.execute(
+        select(Owner.id, Owner.phone).execution_options(yield_per=batch_size))
+    for rows in owners.partitions():
+        results = normalize_many(phone or '' for _, phone in rows)
+        for (owner_id, phone), result in zip(rows, results):
+            batch.extend(phone_rows(owner_id, phone, result))
+        if len(batch) >= batch_size:
+            db.session.execute(insert(phones), batch)
+            written += len(batch)
+            batch = []
+    if batch:
+        db.session.execute(insert(phones), batch)
+        written += len(batch)
+    db.session.commit()
+    return written
+
+
+def ensure_owner_phone_index():
+    """Строит индекс при первом обращении (новая таблица на существующей базе)"""
+    global _index_checked
+    if _index_checked:
+        return
+    phones.create(bind=db.engine, checkfirst=True)
+    if db.session.query(OwnerPhone.id).first() is None \
+            and db.session.query(Owner.id).first() is not None:
+        rebuild_owner_phone_index()
+    _index_checked = True
+
+
+def _starts_with(column, digits):
+    """column LIKE 'digits%' в виде диапазона, который всегда использует индекс"""
+    return (column >= digits) & (column < digits + ':')  # ':' - следующий символ после '9'
+
+
+def owner_ids_by_phone(search):
+    """Подзапрос id владельцев, чей телефон начинается или заканчивается цифрами search.
+
+    Полный номер в формате 375... или 80... совпадает по началу с
+    нормализованным номером, короткий местный - по последним цифрам.
+    Возвращает None, если цифр слишком мало для поиска по индексу.
+    """
+    digits = ''.join(ch for ch in search if ch.isdigit())
+    if len(digits) < MIN_PARTIAL_DIGITS:
+        return None
+
+    prefixes = {digits}
+    if digits.startswith('80'):
+        prefixes.add('375' + digits[2:])
+    return select(phones.c.owner_id).where(or_(
+        _starts_with(phones.c.number_reversed, digits[::-1]),
+        *[_starts_with(phones.c.number, prefix) for prefix in sorted(prefixes)]
+    ))
+
+
+def _phone_digits_sql(column):
+    """Строка телефона без пробелов, дефисов, скобок, плюсов и точек"""
+    for character in ' -()+.':
+        column = func.replace(column, character, '')
+    return column
+
+
+def phone_search_condition(search):
+    """Условие поиска владельцев по цифрам телефона для запроса по Owner.
+
+    По индексу ищется начало или конец нормализованного номера; к найденному
+    добавляются владельцы без нормализованных номеров (иностранные и короткие
+    номера), у которых цифры встречаются в исходной строке. Если по индексу
+    ничего не найдено (например, цифры из середины номера) или цифр мало,
+    ищется подстрока во всех телефонах. None - в search нет цифр.
+    """
+    digits = ''.join(ch for ch in search if ch.isdigit())
+    if not digits:
+        return None
+    substring = _phone_digits_sql(Owner.phone).like('%{}%'.format(digits))
+    owner_ids = owner_ids_by_phone(digits)
+    if owner_ids is None:
+        return substring
+    ensure_owner_phone_index()
+    if not db.session.query(owner_ids.exists()).scalar():
+        return substring
+    not_indexed = ~Owner.id.in_(select(phones.c.owner_id))
+    return or_(Owner.id.in_(owner_ids), and_(not_indexed, substring))
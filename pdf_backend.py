@@ -0,0 +1,65 @@
+"""
+Генерация PDF через pdfkit/wkhtmltopdf с отложенной инициализацией.
+
+pdfkit импортируется, а wkhtmltopdf ищется при первом обращении, а не при
+старте приложения: PDF-отчёты нужны редко.
+"""
+import os
+import shutil
+import threading
+
+DEFAULT_WKHTMLTOPDF_PATH = r'C:\Program Files\wkhtmltopdf\bin\wkhtmltopdf.exe'
+
+_wkhtmltopdf_path = DEFAULT_WKHTMLTOPDF_PATH
+_configuration = None
+_probed = False
+_probe_lock = threading.Lock()
+
+
+def set_wkhtmltopdf_path(path):
+    """Задаёт путь к wkhtmltopdf; поиск повторится при следующем обращении"""
+    global _wkhtmltopdf_path, _configuration, _probed
+    with _probe_lock:
+        _wkhtmltopdf_path = path or DEFAULT_WKHTMLTOPDF_PATH
+        _configuration = None
+        _probed = False
+
+
+def _probe():
+    path = _wkhtmltopdf_path
+    if not os.path.exists(path):
+        path = shutil.which('wkhtmltopdf')
+    if not path:
+        print("[ВНИМАНИЕ] wkhtmltopdf не найден - генерация PDF отчетов недоступна")
+        print("           Скачайте с: https://wkhtmltopdf.org/downloads.html")
+        return None
+    try:
+        import pdfkit
+        configuration = pdfkit.configuration(wkhtmltopdf=path)
+    except Exception as e:
+        print("[ВНИМАНИЕ] Ошибка инициализации wkhtmltopdf: {}".format(e))
+        print("           Генерация PDF отчетов будет недоступна")
+        return None
+    print("[OK] wkhtmltopdf найден - генерация PDF отчётов доступна")
+    return configuration
+
+
+def configuration():
+    """Конфигурация pdfkit или None, если wkhtmltopdf недоступен (проверяется один раз)"""
+    global _configuration, _probed
+    if not _probed:
+        with _probe_lock:
+            if not _probed:
+                _configuration = _probe()
+                _probed = True
+    return _configuration
+
+
+def is_available():
+    return configuration() is not None
+
+
+def write_pdf(html, target, options=None):
+    """PDF из HTML-строки в файл target"""
+    import pdfkit
+    pdfkit.from_string(html, target, configuration=configuration(), options=options)
@@ -0,0 +1,90 @@
+"""
+Выгрузка телефонов владельцев, вакцинированных за период.
+
+Запрос выбирает только различные значения Owner.phone владельцев с
+прививками в периоде (диапазон по индексу даты), телефоны нормализуются
+пакетом через collect_phones(). Результат не запоминается: выборка за год
+занимает миллисекунды, а данные прошлых периодов меняют и команды CLI
+(импорт, normalize-phones), которые не видны событиям этого процесса.
+ZIP-архив отдаётся потоком.
+"""
+import zipfile
+from datetime import date, timedelta
+
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import select
+
+from models import Owner, Vaccination, db
+from phone_normalizer import collect_phones
+
+# Строк в одном фрагменте файла архива
+ZIP_CHUNK_LINES = 5000
+
+
+def month_range(day):
+    """Первый и последний день месяца, в который попадает day"""
+    first = day.replace(day=1)
+    return first, first + relativedelta(months=1) - timedelta(days=1)
+
+
+def default_period(today=None):
+    """Период по умолчанию: месяц 11 месяцев назад (прививки, срок которых подходит)"""
+    today = today or date.today()
+    return month_range(today - relativedelta(months=11))
+
+
+def export_file_name(start_date, end_date):
+    if (start_date, end_date) == month_range(start_date):
+        return 'vaccination_phones_{}.zip'.format(start_date.strftime('%m_%Y'))
+    return 'vaccination_phones_{}_{}.zip'.format(start_date.isoformat(), end_date.isoformat())
+
+
+def period_phones(start_date, end_date):
+    """Отсортированные уникальные правильные и неправильные номера владельцев,
+    вакцинированных с start_date по end_date включительно"""
+    owner_ids = select(Vaccination.owner_id).where(
+        Vaccination.date_administered >= start_date,
+        Vaccination.date_administered <= end_date
+    )
+    phones = db.session.execute(
+        select(Owner.phone).where(Owner.id.in_(owner_ids), Owner.phone.isnot(None)).distinct()
+    ).scalars().all()
+    return collect_phones(phones)
+
+
+class _StreamBuffer:
+    """Приёмник zipfile без seek: хранит записанные байты до отправки клиенту"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_zip(files):
+    """Генератор байтов ZIP-архива; files - пары (имя файла, список строк).
+
+    Файлы без строк в архив не попадают. Строки разделяются '\\n'.
+    """
+    buffer = _StreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for name, lines in files:
+            if not lines:
+                continue
+            with zip_file.open(name, 'w') as entry:
+                for start in range(0, len(lines), ZIP_CHUNK_LINES):
+                    chunk = '\n'.join(lines[start:start + ZIP_CHUNK_LINES])
+                    entry.write(('\n' + chunk if start else chunk).encode('utf-8'))
+                    yield buffer.take()
+            yield buffer.take()
+    yield buffer.take()
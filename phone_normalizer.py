@@ -1,20 +1,43 @@
+"""
+Нормализация телефонных номеров владельцев к формату 375XXXXXXXXX.
+
+Единственная реализация для веб-приложения, CLI, отчёта с телефонами и
+импорта. Шаблоны компилируются один раз, результаты для повторяющихся
+исходных строк берутся из LRU-кэша, normalize_many() обрабатывает
+последовательность строк, считая каждую уникальную строку один раз.
+"""
 import re
-from typing import List, Dict, Tuple
+from functools import lru_cache
+from typing import Dict, Iterable, List, Tuple
+
+# Разделители между разными номерами в одном поле
+_NUMBERS_SPLIT_RE = re.compile(r'[,;/|\\]+')
+# Пробелы и дефисы: внутри одного номера или между номерами
+_PARTS_SPLIT_RE = re.compile(r'[\s\-]+')
+_NON_DIGIT_RE = re.compile(r'\D')
+_LETTERS_RE = re.compile(r'[^\W\d_]')
+
+CITY_PREFIX = '375162'   # Брест: 6-значные городские номера
+MOBILE_PREFIX = '37529'  # 7-значные номера без кода оператора
+
+CACHE_SIZE = 65536
+
 
 def extract_digits(phone_str: str) -> str:
     """Извлекает только цифры из строки"""
-    return re.sub(r'\D', '', phone_str)
+    return _NON_DIGIT_RE.sub('', phone_str)
+
 
 def process_single_number(digits: str) -> Tuple[str, bool]:
     """Обрабатывает один номер, возвращает нормализованный номер и валидность"""
     length = len(digits)
-    
+
     # Обработка коротких номеров (городских)
     if length == 6:
-        return '375162' + digits, True  # Минск
+        return CITY_PREFIX + digits, True
     elif length == 7:
-        return '37529' + digits, True  # Минск (7-значные)
-    
+        return MOBILE_PREFIX + digits, True
+
     # Обработка мобильных номеров
     if digits.startswith('80') and length == 11:
         return '375' + digits[2:], True
@@ -22,41 +45,95 @@ def process_single_number(digits: str) -> Tuple[str, bool]:
         return digits, True
     elif length == 9:
         return '375' + digits, True
-    
+
     return digits, False
 
-def normalize_phone_v3(phone_str: str) -> Dict[str, List[str]]:
-    if not phone_str:
-        return {'valid': [], 'invalid': []}
-    
-    raw_numbers = re.split(r'[\s,;/|\\-]+', phone_str.strip())
-    
+
+def _split_numbers(phone_str: str) -> List[str]:
+    """Отдельные номера из поля телефона.
+
+    Части, разделённые запятой, точкой с запятой и т.п., - разные номера.
+    Внутри части пробелы и дефисы считаются разделителями номеров, только
+    если все цифры части вместе не образуют один правильный номер
+    ("722 98 91", "+375 (29) 123-45-67" - один номер) или в части есть
+    пометки буквами ("6088104 КОД33").
+    """
+    numbers = []
+    for part in _NUMBERS_SPLIT_RE.split(phone_str):
+        part = part.strip()
+        if not part:
+            continue
+        if not _LETTERS_RE.search(part) and process_single_number(extract_digits(part))[1]:
+            numbers.append(part)
+        else:
+            numbers.extend(p for p in _PARTS_SPLIT_RE.split(part) if p)
+    return numbers
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _normalize_cached(phone_str: str) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
     valid_numbers = []
     invalid_numbers = []
     seen_numbers = set()
-    
-    for raw_num in raw_numbers:
-        if not raw_num:
-            continue
-            
+
+    for raw_num in _split_numbers(phone_str):
         digits = extract_digits(raw_num)
         if not digits:
             continue
-            
-        # Обрабатываем номер
+
         normalized, is_valid = process_single_number(digits)
-        
-        # Проверяем длину нормализованного номера
-        if is_valid and len(normalized) == 12 and normalized.startswith('375'):
+        if is_valid:
             if normalized not in seen_numbers:
                 valid_numbers.append(normalized)
                 seen_numbers.add(normalized)
-        else:
-            if digits not in seen_numbers:
-                invalid_numbers.append(digits)
-                seen_numbers.add(digits)
-    
+        elif raw_num not in seen_numbers:
+            invalid_numbers.append(raw_num)
+            seen_numbers.add(raw_num)
+
+    return tuple(valid_numbers), tuple(invalid_numbers)
+
+
+def normalize_phone(phone_str: str) -> Dict[str, List[str]]:
+    """Разбирает поле телефона: {'valid': [375...], 'invalid': [исходные фрагменты]}"""
+    if not phone_str:
+        return {'valid': [], 'invalid': []}
+    valid_numbers, invalid_numbers = _normalize_cached(phone_str.strip())
     return {
-        'valid': valid_numbers,
-        'invalid': invalid_numbers
-    }
\ No newline at end of file
+        'valid': list(valid_numbers),
+        'invalid': list(invalid_numbers)
+    }
+
+
+# Прежние имена, под которыми нормализатор импортировался
+normalize_phone_v2 = normalize_phone
+normalize_phone_v3 = normalize_phone
+
+
+def normalize_many(phone_strings: Iterable[str]) -> List[Dict[str, List[str]]]:
+    """normalize_phone для последовательности строк; одинаковые строки разбираются один раз"""
+    results = {}
+    output = []
+    for phone_str in phone_strings:
+        result = results.get(phone_str)
+        if result is None:
+            result = results[phone_str] = normalize_phone(phone_str)
+        output.append(result)
+    return output
+
+
+def collect_phones(phone_strings: Iterable[str]) -> Tuple[List[str], List[str]]:
+    """Отсортированные уникальные правильные и неправильные номера из всех строк"""
+    valid_numbers = set()
+    invalid_numbers = set()
+    for phone_str in set(phone_strings):
+        if not phone_str:
+            continue
+        valid, invalid = _normalize_cached(phone_str.strip())
+        valid_numbers.update(valid)
+        invalid_numbers.update(invalid)
+    return sorted(valid_numbers), sorted(invalid_numbers)
+
+
+def cache_info():
+    """Статистика LRU-кэша нормализатора"""
+    return _normalize_cached.cache_info()
@@ -0,0 +1,177 @@
+"""
+Фоновая генерация PDF-отчётов.
+
+Задание ставится по готовому HTML отчёта; преобразование в PDF через
+wkhtmltopdf выполняется в ограниченном пуле потоков, а не в потоке
+запроса: сама работа идёт в дочернем процессе wkhtmltopdf, а отдельные
+процессы Python при spawn заново импортировали бы приложение. Готовый PDF хранится на диске под ключом из параметров отчёта и
+хэша HTML: повторный запрос с теми же параметрами при неизменных данных
+сразу получает готовый файл. Состояние задания определяется по файлам в
+каталоге отчётов (.pdf - готово, .pending - выполняется, .error - ошибка),
+поэтому его видит любой процесс сервера.
+"""
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import pdf_backend
+
+logger = logging.getLogger(__name__)
+
+# Задание без живого процесса дольше этого времени считается прерванным, с
+PENDING_TIMEOUT = 600
+
+_KEY_RE = re.compile(r'^[\w.-]+$')
+
+_executor = None
+_executor_workers = 0
+_lock = threading.Lock()
+_running = {}  # ключ -> Future заданий этого процесса
+
+
+def job_key(kind, values, html):
+    """Ключ задания (он же имя файла): вид отчёта, параметры и хэш HTML"""
+    digest = hashlib.sha256(html.encode('utf-8')).hexdigest()[:16]
+    return '_'.join([kind] + [str(value) for value in values] + [digest])
+
+
+def is_valid_key(key):
+    return bool(_KEY_RE.match(key))
+
+
+def download_name(key):
+    """Имя файла для скачивания: ключ без хэша"""
+    return key.rsplit('_', 1)[0] + '.pdf'
+
+
+def result_path(report_dir, key):
+    return os.path.join(report_dir, key + '.pdf')
+
+
+def _marker_path(report_dir, key, kind):
+    return os.path.join(report_dir, '{}.{}'.format(key, kind))
+
+
+def _get_executor(workers):
+    global _executor, _executor_workers
+    if _executor is None or _executor_workers != workers:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+        _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='report-job')
+        _executor_workers = workers
+    return _executor
+
+
+def _convert(html, options, target):
+    """Выполняется в потоке пула: HTML -> PDF во временный файл, затем переименование"""
+    partial_file = target + '.partial'
+    try:
+        pdf_backend.write_pdf(html, partial_file, options=options)
+        os.replace(partial_file, target)
+    finally:
+        if os.path.exists(partial_file):
+            os.remove(partial_file)
+
+
+def _job_done(report_dir, key, future):
+    error = future.exception()
+    if error is not None:
+        logger.error("Report job %s failed: %s", key, error)
+        with open(_marker_path(report_dir, key, 'error'), 'w', encoding='utf-8') as f:
+            f.write(str(error) or error.__class__.__name__)
+    try:
+        os.remove(_marker_path(report_dir, key, 'pending'))
+    except FileNotFoundError:
+        pass
+    with _lock:
+        _running.pop(key, None)
+
+
+def status(report_dir, key):
+    """Состояние задания: {'job_id', 'status': done|pending|failed|unknown, ...}"""
+    result = {'job_id': key}
+    pdf_file = result_path(report_dir, key)
+    if os.path.exists(pdf_file):
+        result.update(status='done', bytes=os.path.getsize(pdf_file))
+        return result
+    if key in _running:
+        result['status'] = 'pending'
+        return result
+
+    pending_file = _marker_path(report_dir, key, 'pending')
+    try:
+        pending_age = time.time() - os.path.getmtime(pending_file)
+    except FileNotFoundError:
+        pending_age = None
+    if pending_age is not None and pending_age < PENDING_TIMEOUT:
+        result['status'] = 'pending'
+        return result
+
+    try:
+        with open(_marker_path(report_dir, key, 'error'), 'r', encoding='utf-8') as f:
+            result.update(status='failed', error=f.read())
+        return result
+    except FileNotFoundError:
+        pass
+    if pending_age is not None:
+        result.update(status='failed', error='Задание прервано')
+        return result
+    result['status'] = 'unknown'
+    return result
+
+
+def _remove_old_reports(report_dir, keep):
+    reports = sorted((os.path.join(report_dir, name) for name in os.listdir(report_dir)
+                      if name.endswith('.pdf')), key=os.path.getmtime, reverse=True)
+    for old_report in reports[keep:]:
+        os.remove(old_report)
+
+
+def submit(report_dir, key, html, options=None, workers=2, keep=50):
+    """Ставит задание в очередь, если готового PDF нет и задание ещё не выполняется.
+
+    Возвращает состояние задания, как status().
+    """
+    os.makedirs(report_dir, exist_ok=True)
+    with _lock:
+        current = status(report_dir, key)
+        if current['status'] in ('done', 'pending'):
+            return current
+
+        if not pdf_backend.is_available():
+            return {'job_id': key, 'status': 'failed', 'error': 'wkhtmltopdf не найден'}
+
+        for kind in ('error', 'pending'):
+            try:
+                os.remove(_marker_path(report_dir, key, kind))
+            except FileNotFoundError:
+                pass
+        _remove_old_reports(report_dir, keep)
+        with open(_marker_path(report_dir, key, 'pending'), 'w', encoding='utf-8') as f:
+            f.write(str(os.getpid()))
+
+        future = _get_executor(workers).submit(
+            _convert, html, options, result_path(report_dir, key))
+        _running[key] = future
+    future.add_done_callback(partial(_job_done, report_dir, key))
+    return {'job_id': key, 'status': 'pending'}
+
+
+def wait(report_dir, key, timeout=None):
+    """Ожидает завершения задания этого процесса; возвращает его состояние"""
+    future = _running.get(key)
+    if future is not None:
+        try:
+            future.result(timeout=timeout)
+        except Exception:
+            pass
+        # Обработчик завершения вызывается в потоке пула сразу после результата
+        deadline = time.time() + 1
+        while key in _running and time.time() < deadline:
+            time.sleep(0.01)
+    return status(report_dir, key)
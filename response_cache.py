@@ -0,0 +1,101 @@
+"""
+Небольшой LRU/TTL кэш готовых ответов внутри процесса.
+
+Записи сбрасываются по событиям SQLAlchemy при фиксации изменений связанных моделей,
+а TTL ограничивает устаревание, если данные меняет другой процесс
+(импорт CSV, второй воркер сервера).
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+
+class ResponseCache:
+    """Потокобезопасный LRU-кэш с временем жизни записей и счётчиками попаданий"""
+
+    def __init__(self, maxsize=32, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires_at = item
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            if self._data:
+                self._data.clear()
+                self.invalidations += 1
+
+    def invalidate_on(self, *models):
+        """Сбрасывает кэш при фиксации транзакции, изменившей строки моделей.
+
+        Учитываются вставка, изменение и удаление объектов, а также массовые
+        query.update()/delete() через сессию; после отката кэш не трогается.
+        """
+        models = tuple(models)
+        pending_key = ('response_cache_pending', id(self))
+
+        def _mark(mapper, connection, target):
+            session = object_session(target)
+            if session is None:
+                self.clear()
+            else:
+                session.info[pending_key] = True
+
+        def _mark_bulk(orm_execute_state):
+            if (orm_execute_state.is_update or orm_execute_state.is_delete) \
+                    and orm_execute_state.bind_mapper is not None \
+                    and orm_execute_state.bind_mapper.class_ in models:
+                orm_execute_state.session.info[pending_key] = True
+
+        def _commit(session):
+            if session.info.pop(pending_key, False):
+                self.clear()
+
+        def _rollback(session):
+            session.info.pop(pending_key, None)
+
+        for model in models:
+            for event_name in ('after_insert', 'after_update', 'after_delete'):
+                event.listen(model, event_name, _mark)
+        event.listen(Session, 'do_orm_execute', _mark_bulk)
+        event.listen(Session, 'after_commit', _commit)
+        event.listen(Session, 'after_rollback', _rollback)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'hit_rate': round(self.hits / total, 3) if total else 0.0
+            }
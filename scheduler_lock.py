@@ -0,0 +1,54 @@
+"""
+Межпроцессная блокировка фонового планировщика.
+
+Если на одной базе случайно запущено несколько экземпляров сервера, копии
+базы, обновление статистики и PRAGMA optimize должен выполнять только один
+процесс. Планировщик запускает процесс, которому удалось захватить файл
+блокировки; остальные работают без него и предупреждают об этом в журнале.
+Блокировку снимает ОС при завершении процесса, поэтому после перезапуска
+сервера она не остаётся висеть.
+"""
+import os
+import sys
+
+_lock_file = None
+
+
+def _try_lock(lock_file):
+    if sys.platform == 'win32':
+        import msvcrt
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+def acquire(path):
+    """Захватывает блокировку path без ожидания; True, если она принадлежит этому процессу"""
+    global _lock_file
+    if _lock_file is not None:
+        return True
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    lock_file = open(path, 'a+')
+    try:
+        _try_lock(lock_file)
+    except OSError:
+        lock_file.close()
+        return False
+
+    # PID владельца - для диагностики, на саму блокировку не влияет
+    try:
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(str(os.getpid()))
+        lock_file.flush()
+    except OSError:
+        pass
+    _lock_file = lock_file
+    return True
+
+
+def is_held():
+    """Держит ли этот процесс блокировку планировщика"""
+    return _lock_file is not None
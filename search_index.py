@@ -0,0 +1,174 @@
+"""
+Полнотекстовый индекс SQLite FTS5 для поиска владельцев, животных и услуг.
+
+Таблицы owner_fts, pet_fts и treatment_fts хранят копию полей для поиска
+(rowid совпадает с id исходной записи) и поддерживаются триггерами SQLite,
+поэтому остаются согласованными и при пакетной вставке из импорта CSV.
+Поиск идёт по префиксам слов, результаты упорядочиваются по bm25 (rank).
+"""
+import re
+import weakref
+
+from sqlalchemy import column, table, text
+
+from models import Owner, Pet, Treatment, db
+
+
+def _strip_sql(expression, characters):
+    """SQL-выражение expression без указанных символов"""
+    for character in characters:
+        expression = "replace({}, '{}', '')".format(expression, character)
+    return expression
+
+
+# Телефон в индексе: каждый номер отдельным токеном (пробел между номерами сохраняется,
+# дефисы, скобки и точки внутри номера удаляются) и, для номеров, записанных группами
+# через пробел ("525 21 92"), вся строка цифр без пробелов одним токеном
+_PHONE_NUMBERS_SQL = _strip_sql("coalesce({0}, '')", '-()+.')
+PHONE_DIGITS_SQL = "{} || ' ' || {}".format(_strip_sql(_PHONE_NUMBERS_SQL, ' '), _PHONE_NUMBERS_SQL)
+
+# Индексируемые таблицы: модель -> (FTS-таблица, исходная таблица, {столбец: выражение})
+SEARCH_TABLES = {
+    Owner: ('owner_fts', 'owner', {
+        'name': 'new.name',
+        'address': 'new.address',
+        'phone': PHONE_DIGITS_SQL.format('new.phone'),
+    }),
+    Pet: ('pet_fts', 'pet', {
+        'name': 'new.name',
+        'card_number': 'new.card_number',
+        'breed': 'new.breed',
+    }),
+    Treatment: ('treatment_fts', 'treatment', {
+        'name': 'new.name',
+    }),
+}
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+# Движок -> PRAGMA schema_version, при которой индекс проверен: после reset-db или
+# пересоздания таблиц версия схемы меняется, и проверка выполняется заново
+_checked_schema = weakref.WeakKeyDictionary()
+
+
+def _fts_table(model):
+    name = SEARCH_TABLES[model][0]
+    return table(name, column('rowid'), column('rank'), column(name))
+
+
+def _trigger_names(source):
+    return ['{}_fts_{}'.format(source, action) for action in ('ai', 'au', 'ad')]
+
+
+def _create_statements(fts_name, source, columns):
+    """DDL виртуальной таблицы и триггеров синхронизации"""
+    names = ', '.join(columns)
+    values = ', '.join(columns.values())
+    insert_row = "INSERT INTO {0}(rowid, {1}) VALUES (new.id, {2});".format(fts_name, names, values)
+    delete_row = "DELETE FROM {0} WHERE rowid = old.id;".format(fts_name)
+    ai, au, ad = _trigger_names(source)
+    return [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS {0} USING fts5({1}, prefix='2 3', "
+        "tokenize='unicode61 remove_diacritics 2')".format(fts_name, names),
+        "CREATE TRIGGER IF NOT EXISTS {0} AFTER INSERT ON {1} BEGIN {2} END".format(ai, source, insert_row),
+        "CREATE TRIGGER IF NOT EXISTS {0} AFTER UPDATE ON {1} BEGIN {2} {3} END".format(
+            au, source, delete_row, insert_row),
+        "CREATE TRIGGER IF NOT EXISTS {0} AFTER DELETE ON {1} BEGIN {2} END".format(ad, source, delete_row),
+    ]
+
+
+def _fill_statements(fts_name, source, columns):
+    """Полное заполнение FTS-таблицы из исходной"""
+    names = ', '.join(columns)
+    values = ', '.join(value.replace('new.', '') for value in columns.values())
+    return [
+        "DELETE FROM {0}".format(fts_name),
+        "INSERT INTO {0}(rowid, {1}) SELECT id, {2} FROM {3}".format(fts_name, names, values, source),
+        "INSERT INTO {0}({0}) VALUES ('optimize')".format(fts_name),
+    ]
+
+
+def _schema_version(connection):
+    return connection.exec_driver_sql('PRAGMA schema_version').scalar()
+
+
+def rebuild_search_index():
+    """Создаёт FTS-таблицы и триггеры (заменяя устаревшие) и заново заполняет индекс"""
+    with db.engine.begin() as conn:
+        for fts_name, source, columns in SEARCH_TABLES.values():
+            for trigger in _trigger_names(source):
+                conn.exec_driver_sql("DROP TRIGGER IF EXISTS {}".format(trigger))
+            for statement in _create_statements(fts_name, source, columns):
+                conn.exec_driver_sql(statement)
+            for statement in _fill_statements(fts_name, source, columns):
+                conn.exec_driver_sql(statement)
+        _checked_schema[db.engine] = _schema_version(conn)
+
+
+def _expected_triggers():
+    """Имя триггера -> его текст в sqlite_master (SQLite хранит его без IF NOT EXISTS)"""
+    expected = {}
+    for fts_name, source, columns in SEARCH_TABLES.values():
+        statements = _create_statements(fts_name, source, columns)[1:]
+        for name, statement in zip(_trigger_names(source), statements):
+            expected[name] = statement.replace(' IF NOT EXISTS', '', 1)
+    return expected
+
+
+def ensure_search_index():
+    """Строит индекс, если триггеров нет (после reset-db) или они от старой версии"""
+    version = _schema_version(db.session.connection())
+    if _checked_schema.get(db.engine) == version:
+        return
+    existing = dict(db.session.execute(
+        text("SELECT name, sql FROM sqlite_master WHERE type = 'trigger'")).all())
+    expected = _expected_triggers()
+    if any(existing.get(name) != sql for name, sql in expected.items()):
+        rebuild_search_index()
+    else:
+        _checked_schema[db.engine] = version
+
+
+def match_expression(term, columns=None):
+    """Запрос FTS5: каждое слово term ищется как префикс, все слова обязательны.
+
+    columns ограничивает поиск столбцами FTS-таблицы. Возвращает None, если
+    в term нет ни одного слова.
+    """
+    tokens = _TOKEN_RE.findall(term or '')
+    if not tokens:
+        return None
+    expression = ' AND '.join('"{}"*'.format(token) for token in tokens)
+    if columns:
+        return '{{{}}} : ({})'.format(' '.join(columns), expression)
+    return expression
+
+
+def phone_expression(term):
+    """Запрос FTS5 по началу номера телефона (цифры term; None, если в term есть буквы)"""
+    term = term or ''
+    if any(ch.isalpha() for ch in term):
+        return None
+    digits = ''.join(ch for ch in term if ch.isdigit())
+    if not digits:
+        return None
+    return 'phone : "{}"*'.format(digits)
+
+
+def any_of(*expressions):
+    """Объединение нескольких запросов FTS5 через OR (пустые пропускаются)"""
+    expressions = ['({})'.format(e) for e in expressions if e]
+    return ' OR '.join(expressions) if expressions else None
+
+
+def ranked(query, model, expression):
+    """Ограничивает запрос модели совпадениями FTS и сортирует по релевантности"""
+    fts = _fts_table(model)
+    return query.join(fts, fts.c.rowid == model.id)\
+        .filter(fts.c[fts.name].op('MATCH')(expression))\
+        .order_by(fts.c.rank)
+
+
+def matching_ids(model, expression):
+    """Подзапрос id записей модели, совпадающих с запросом FTS"""
+    fts = _fts_table(model)
+    return db.select(fts.c.rowid).where(fts.c[fts.name].op('MATCH')(expression))
@@ -0,0 +1,65 @@
+"""
+Настройки соединений SQLite.
+
+При каждом новом соединении пула выполняются PRAGMA: журнал WAL (читатели
+не блокируются писателем), synchronous=NORMAL, размер кэша страниц,
+mmap, временные таблицы в памяти и ожидание блокировки вместо немедленной
+ошибки "database is locked". Значения берутся из app.config (SQLITE_*).
+"""
+import sqlite3
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DEFAULTS = {
+    'SQLITE_JOURNAL_MODE': 'WAL',
+    'SQLITE_SYNCHRONOUS': 'NORMAL',
+    'SQLITE_CACHE_SIZE_KB': 64 * 1024,        # 64 МБ кэша страниц на соединение
+    'SQLITE_MMAP_SIZE': 256 * 1024 * 1024,    # 256 МБ отображения файла в память
+    'SQLITE_TEMP_STORE': 'MEMORY',
+    'SQLITE_BUSY_TIMEOUT_MS': 10000,
+}
+
+_settings = dict(DEFAULTS)
+_listener_installed = False
+
+
+def connection_pragmas(settings=None):
+    """Список PRAGMA, выполняемых для нового соединения"""
+    settings = settings or _settings
+    return [
+        'PRAGMA journal_mode={}'.format(settings['SQLITE_JOURNAL_MODE']),
+        'PRAGMA synchronous={}'.format(settings['SQLITE_SYNCHRONOUS']),
+        # Отрицательное значение cache_size - размер в КБ, а не в страницах
+        'PRAGMA cache_size=-{}'.format(int(settings['SQLITE_CACHE_SIZE_KB'])),
+        'PRAGMA mmap_size={}'.format(int(settings['SQLITE_MMAP_SIZE'])),
+        'PRAGMA temp_store={}'.format(settings['SQLITE_TEMP_STORE']),
+        'PRAGMA busy_timeout={}'.format(int(settings['SQLITE_BUSY_TIMEOUT_MS'])),
+    ]
+
+
+def _on_connect(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    try:
+        for pragma in connection_pragmas():
+            cursor.execute(pragma)
+    finally:
+        cursor.close()
+
+
+def init_sqlite_tuning(app):
+    """Заполняет app.config значениями по умолчанию и подключает обработчик соединений"""
+    global _listener_installed
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+        _settings[key] = app.config[key]
+    if not _listener_installed:
+        event.listen(Engine, 'connect', _on_connect)
+        _listener_installed = True
+
+
+def optimize_database(connection):
+    """PRAGMA optimize: обновляет статистику планировщика для таблиц, где она устарела"""
+    connection.exec_driver_sql('PRAGMA optimize')
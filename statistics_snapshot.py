@@ -0,0 +1,351 @@
+"""
+Предрасчитанные дневные агрегаты для страницы статистики.
+
+Изменения вакцинаций, приёмов и назначений отмечают затронутые дни как
+"грязные" через события SQLAlchemy; отметки применяются при фиксации транзакции
+(после отката они отбрасываются). refresh_statistics_snapshot() пересчитывает
+только эти дни (а для метрик новых животных - ещё и дни событий затронутых
+животных), а полная перестройка выполняется ночью планировщиком и
+командой `flask rebuild-statistics`.
+"""
+import threading
+from datetime import date, datetime
+
+from sqlalchemy import event, func, insert
+from sqlalchemy.orm import Session, object_session
+
+from models import (Appointment, AppointmentTreatment,
+                    StatisticsSnapshot, Vaccination, db)
+
+DAY_METRICS = ('vaccination', 'appointment', 'treatment')
+PET_METRICS = ('new_pet', 'first_seen_pet')
+_TRACKED_MODELS = (Vaccination, Appointment, AppointmentTreatment)
+_PENDING_KEY = 'statistics_snapshot_pending'
+
+_lock = threading.Lock()
+_refresh_lock = threading.Lock()
+_dirty_days = set()
+_dirty_appointment_ids = set()
+_dirty_pet_ids = set()
+_full_refresh_needed = False
+_snapshot_checked = False
+
+
+def _to_date(value):
+    """Дата из значения колонки (date или строка 'YYYY-MM-DD')"""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    try:
+        return datetime.strptime(str(value)[:10], '%Y-%m-%d').date()
+    except ValueError:
+        return None
+
+
+def _pending(session):
+    """Отметки ещё не зафиксированной транзакции сессии"""
+    return session.info.setdefault(_PENDING_KEY, {
+        'days': set(), 'appointment_ids': set(), 'pet_ids': set(), 'full': False
+    })
+
+
+def _apply_pending(pending):
+    global _full_refresh_needed
+    with _lock:
+        _dirty_days.update(pending['days'])
+        _dirty_appointment_ids.update(pending['appointment_ids'])
+        _dirty_pet_ids.update(pending['pet_ids'])
+        _full_refresh_needed = _full_refresh_needed or pending['full']
+
+
+def _record(target, days=(), appointment_ids=(), pet_ids=(), full=False):
+    """Запоминает изменение до фиксации транзакции (объект вне сессии - сразу)"""
+    session = object_session(target)
+    pending = _pending(session) if session is not None else {
+        'days': set(), 'appointment_ids': set(), 'pet_ids': set(), 'full': False
+    }
+    pending['days'].update(days)
+    pending['appointment_ids'].update(appointment_ids)
+    pending['pet_ids'].update(pet_ids)
+    pending['full'] = pending['full'] or full
+    if session is None:
+        _apply_pending(pending)
+
+
+def _history_values(target, attr_name):
+    history = db.inspect(target).attrs[attr_name].history
+    return list(history.added or ()) + list(history.deleted or ()) + list(history.unchanged or ())
+
+
+def _mark_dated(target, date_attr):
+    """Отмечает текущую и предыдущую дату изменённого объекта и его животное
+    (и прежнее, если запись перенесена на другое)"""
+    days = {d for d in (_to_date(v) for v in _history_values(target, date_attr)) if d}
+    pet_ids = {v for v in _history_values(target, 'pet_id') if v is not None}
+    # Дата не загружена в объект (например, удаление после expire) - пересчитываем всё
+    _record(target, days=days, pet_ids=pet_ids, full=not days)
+
+
+def _mark_vaccination(mapper, connection, target):
+    _mark_dated(target, 'date_administered')
+
+
+def _mark_appointment(mapper, connection, target):
+    _mark_dated(target, 'appointment_date')
+
+
+def _mark_appointment_treatment(mapper, connection, target):
+    if target.appointment_id is not None:
+        _record(target, appointment_ids={target.appointment_id})
+
+
+for _event_name in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Vaccination, _event_name, _mark_vaccination)
+    event.listen(Appointment, _event_name, _mark_appointment)
+    event.listen(AppointmentTreatment, _event_name, _mark_appointment_treatment)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _mark_bulk_statement(orm_execute_state):
+    """query.update()/delete() и update()/delete() через сессию не вызывают событий
+    объектов: затронутые дни неизвестны, поэтому нужна полная перестройка"""
+    if (orm_execute_state.is_update or orm_execute_state.is_delete) \
+            and orm_execute_state.bind_mapper is not None \
+            and orm_execute_state.bind_mapper.class_ in _TRACKED_MODELS:
+        _pending(orm_execute_state.session)['full'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _commit_marks(session):
+    # Отметки становятся видны обновлению только вместе с зафиксированными данными
+    pending = session.info.pop(_PENDING_KEY, None)
+    if pending:
+        _apply_pending(pending)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_marks(session):
+    session.info.pop(_PENDING_KEY, None)
+
+
+def has_pending_changes():
+    with _lock:
+        return bool(_dirty_days or _dirty_appointment_ids or _dirty_pet_ids or _full_refresh_needed)
+
+
+def _snapshot_row(metric, day, dimension='', detail='', count=0, total=0.0):
+    return {
+        'metric': metric,
+        'day': day,
+        'year': day.year,
+        'month': day.month,
+        'dimension': dimension or '',
+        'detail': detail or '',
+        'count': int(count or 0),
+        'total': float(total or 0),
+    }
+
+
+def _day_metric_rows(days=None):
+    """Агрегаты по вакцинациям, приёмам и назначениям за указанные дни (None - за все)"""
+    rows = []
+    day_strings = sorted(d.strftime('%Y-%m-%d') for d in days) if days is not None else None
+
+    vaccinations = db.session.query(
+        Vaccination.date_administered,
+        Vaccination.vaccination_type,
+        Vaccination.vaccine_name,
+        func.count(Vaccination.id)
+    )
+    if days is not None:
+        vaccinations = vaccinations.filter(Vaccination.date_administered.in_(sorted(days)))
+    vaccinations = vaccinations.group_by(
+        Vaccination.date_administered, Vaccination.vaccination_type, Vaccination.vaccine_name
+    )
+    for day, vaccination_type, vaccine_name, count in vaccinations:
+        day = _to_date(day)
+        if day:
+            rows.append(_snapshot_row('vaccination', day, vaccination_type or 'Не указано',
+                                      vaccine_name or 'Не указано', count))
+
+    appointments = db.session.query(Appointment.appointment_date, func.count(Appointment.id))
+    if day_strings is not None:
+        appointments = appointments.filter(Appointment.appointment_date.in_(day_strings))
+    for day, count in appointments.group_by(Appointment.appointment_date):
+        day = _to_date(day)
+        if day:
+            rows.append(_snapshot_row('appointment', day, count=count))
+
+    treatments = db.session.query(
+        Appointment.appointment_date,
+        AppointmentTreatment.treatment_id,
+        func.count(AppointmentTreatment.id),
+        func.sum(AppointmentTreatment.total_price)
+    ).join(Appointment, AppointmentTreatment.appointment_id == Appointment.id)
+    if day_strings is not None:
+        treatments = treatments.filter(Appointment.appointment_date.in_(day_strings))
+    treatments = treatments.group_by(Appointment.appointment_date, AppointmentTreatment.treatment_id)
+    for day, treatment_id, count, total in treatments:
+        day = _to_date(day)
+        if day:
+            rows.append(_snapshot_row('treatment', day, str(treatment_id), count=count, total=total))
+
+    return _merge_rows(rows)
+
+
+def _pets_on_days(days):
+    """Подзапрос id животных, у которых есть приём или вакцинация в один из дней"""
+    return db.union(
+        db.select(Appointment.pet_id).where(
+            Appointment.appointment_date.in_(sorted(d.strftime('%Y-%m-%d') for d in days))),
+        db.select(Vaccination.pet_id).where(Vaccination.date_administered.in_(sorted(days)))
+    )
+
+
+def _pet_event_days(pet_ids):
+    """Все дни приёмов и вакцинаций указанных животных"""
+    days = set()
+    for query in (db.session.query(Appointment.appointment_date).filter(Appointment.pet_id.in_(pet_ids)),
+                  db.session.query(Vaccination.date_administered).filter(Vaccination.pet_id.in_(pet_ids))):
+        days.update(d for d in (_to_date(value) for (value,) in query.distinct()) if d)
+    return days
+
+
+def _pet_metric_rows(days=None):
+    """Количество новых животных по дням (None - за все дни).
+
+    new_pet - по дате первого приёма, а для животных без приёмов - по первой
+    вакцинации; first_seen_pet - по самой ранней из этих дат (для накопленного итога).
+    Для набора дней рассматриваются только животные с событиями в эти дни:
+    первая дата любого другого животного в них не попадает.
+    """
+    rows = []
+    pet_ids = _pets_on_days(days) if days is not None else None
+
+    def only_pets(query, column):
+        return query.filter(column.in_(pet_ids)) if pet_ids is not None else query
+
+    def add_rows(metric, first_date):
+        for day, count in db.session.query(first_date.c.first_date, func.count()).group_by(first_date.c.first_date):
+            day = _to_date(day)
+            if day and (days is None or day in days):
+                rows.append(_snapshot_row(metric, day, count=count))
+
+    first_appointment = only_pets(db.session.query(
+        func.min(Appointment.appointment_date).label('first_date')
+    ), Appointment.pet_id).group_by(Appointment.pet_id).subquery()
+    add_rows('new_pet', first_appointment)
+
+    pets_with_appointments = db.session.query(Appointment.pet_id).distinct()
+    first_vaccination = only_pets(db.session.query(
+        func.min(Vaccination.date_administered).label('first_date')
+    ).filter(
+        ~Vaccination.pet_id.in_(pets_with_appointments)
+    ), Vaccination.pet_id).group_by(Vaccination.pet_id).subquery()
+    add_rows('new_pet', first_vaccination)
+
+    events = db.union_all(
+        only_pets(db.select(Appointment.pet_id.label('pet_id'), Appointment.appointment_date.label('event_date')),
+                  Appointment.pet_id),
+        only_pets(db.select(Vaccination.pet_id.label('pet_id'), Vaccination.date_administered.label('event_date')),
+                  Vaccination.pet_id)
+    ).subquery()
+    first_seen = db.session.query(
+        func.min(events.c.event_date).label('first_date')
+    ).group_by(events.c.pet_id).subquery()
+    add_rows('first_seen_pet', first_seen)
+
+    return _merge_rows(rows)
+
+
+def _merge_rows(rows):
+    """Складывает строки с одинаковым ключом, пришедшие из разных запросов"""
+    merged = {}
+    for row in rows:
+        key = (row['metric'], row['day'], row['dimension'], row['detail'])
+        if key in merged:
+            merged[key]['count'] += row['count']
+            merged[key]['total'] += row['total']
+        else:
+            merged[key] = row
+    return list(merged.values())
+
+
+def _ensure_table():
+    global _snapshot_checked
+    if _snapshot_checked:
+        return False
+    StatisticsSnapshot.__table__.create(bind=db.engine, checkfirst=True)
+    _snapshot_checked = True
+    # Пустая таблица при непустой базе - снимок ещё ни разу не строился
+    return db.session.query(StatisticsSnapshot.id).first() is None
+
+
+def refresh_statistics_snapshot(full=False):
+    """Пересчитывает агрегаты.
+
+    Без full пересчитываются только дни, изменённые с прошлого обновления.
+    Возвращает количество пересчитанных дней (None при полной перестройке).
+    """
+    global _full_refresh_needed
+    with _refresh_lock:
+        full = _ensure_table() or full
+
+        with _lock:
+            full = full or _full_refresh_needed
+            days = set(_dirty_days)
+            appointment_ids = set(_dirty_appointment_ids)
+            pet_ids = set(_dirty_pet_ids)
+            _dirty_days.clear()
+            _dirty_appointment_ids.clear()
+            _dirty_pet_ids.clear()
+            _full_refresh_needed = False
+
+        if not full and not days and not appointment_ids and not pet_ids:
+            return 0
+
+        try:
+            if appointment_ids and not full:
+                for (appointment_date,) in db.session.query(Appointment.appointment_date).filter(
+                        Appointment.id.in_(appointment_ids)):
+                    day = _to_date(appointment_date)
+                    if day:
+                        days.add(day)
+
+            snapshot = StatisticsSnapshot.__table__
+            if full:
+                db.session.execute(snapshot.delete())
+                rows = _day_metric_rows() + _pet_metric_rows()
+            else:
+                db.session.execute(snapshot.delete().where(
+                    snapshot.c.metric.in_(DAY_METRICS),
+                    snapshot.c.day.in_(sorted(days))
+                ))
+                rows = _day_metric_rows(days) if days else []
+                # Первая дата затронутого животного могла уйти с любого дня его событий
+                # (или с удалённого дня - он уже среди грязных)
+                pet_days = days | (_pet_event_days(pet_ids) if pet_ids else set())
+                if pet_days:
+                    db.session.execute(snapshot.delete().where(
+                        snapshot.c.metric.in_(PET_METRICS),
+                        snapshot.c.day.in_(sorted(pet_days))
+                    ))
+                    rows.extend(_pet_metric_rows(pet_days))
+
+            if rows:
+                db.session.execute(insert(StatisticsSnapshot), rows)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            # Возвращаем изменения в очередь, чтобы не потерять их
+            with _lock:
+                _dirty_days.update(days)
+                _dirty_appointment_ids.update(appointment_ids)
+                _dirty_pet_ids.update(pet_ids)
+                _full_refresh_needed = _full_refresh_needed or full
+            raise
+
+        return None if full else len(days)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Индекс свободных номеров карточек на базе, созданной до появления таблицы
+card_number_gap: добавление, изменение и удаление животного не должны падать,
+а после построения индекса события поддерживают его.
+Запуск: python tests/test_card_number_index.py
+"""
+
+import os
+import sys
+import tempfile
+from datetime import date
+
+# Добавляем корень проекта в путь
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+
+import card_numbers
+from models import CardNumberGap, Owner, Pet, db
+
+
+def make_pet(owner, card_number):
+    return Pet(owner_id=owner.id, name='Шарик', card_number=card_number, species='Собака',
+               gender='М', breed='дворняга', birth_date=date(2020, 1, 1))
+
+
+def test_pet_changes_without_gap_table():
+    with tempfile.TemporaryDirectory() as directory:
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(directory, 'old.db')
+        db.init_app(app)
+        with app.app_context():
+            db.create_all()
+            # База "до обновления": таблицы индекса нет
+            CardNumberGap.__table__.drop(bind=db.engine)
+            card_numbers._table_exists = False
+
+            owner = Owner(name='ИВАНОВ ИВАН', address='ул. Ленина, 1', phone='80291234567')
+            db.session.add(owner)
+            db.session.commit()
+
+            pet = make_pet(owner, '5')
+            db.session.add(pet)
+            db.session.commit()
+            pet.card_number = '6'
+            db.session.commit()
+            db.session.delete(pet)
+            db.session.commit()
+
+            # После построения индекса события снова его обновляют
+            db.session.add(make_pet(owner, '2'))
+            db.session.commit()
+            card_numbers.ensure_card_number_index()
+            assert card_numbers.free_numbers(1, 10, 3) == [1, 3, 4], card_numbers.free_numbers(1, 10, 3)
+            db.session.add(make_pet(owner, '3'))
+            db.session.commit()
+            assert card_numbers.free_numbers(1, 10, 3) == [1, 4, 5], card_numbers.free_numbers(1, 10, 3)
+            db.session.remove()
+            db.engine.dispose()
+
+
+if __name__ == "__main__":
+    test_pet_changes_without_gap_table()
+    print("OK Животные сохраняются и без таблицы card_number_gap")
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Проверка и бенчмарк нормализатора телефонов на синтетических строках.
+Запуск: python tests/test_phone_normalizer_benchmark.py [количество строк]
+"""
+
+import os
+import random
+import sys
+import time
+
+# Добавляем корень проекта в путь
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from phone_normalizer import cache_info, collect_phones, normalize_many, normalize_phone
+
+EXAMPLES = {
+    '80291234567': ['375291234567'],
+    '+375 (29) 123-45-67': ['375291234567'],
+    '722 98 91': ['375297229891'],
+    '8033 6581887': ['375336581887'],
+    '540750': ['375162540750'],
+    '80291234567, 80331234567': ['375291234567', '375331234567'],
+    '80291234567 80331234567': ['375291234567', '375331234567'],
+    '6728702мтс': ['375296728702'],
+    '6088104 КОД33': ['375296088104'],
+    '12345': [],
+    '': [],
+}
+
+FORMATS = [
+    '80{op}{number}',
+    '+375 ({op}) {a}-{b}-{c}',
+    '8-0{op}-{number}',
+    '{number}',
+    '{a} {b} {c}',
+    '8{op} {number}, 80{op}{number}',
+    '{a}-{b}',
+]
+
+
+def synthetic_phones(count, unique=200000, seed=42):
+    """count строк, среди которых около unique различных (как в реальной базе)"""
+    rng = random.Random(seed)
+    pool = []
+    for _ in range(min(count, unique)):
+        number = '{:07d}'.format(rng.randrange(10 ** 7))
+        pool.append(rng.choice(FORMATS).format(
+            op=rng.choice(['29', '33', '44', '25']), number=number,
+            a=number[:3], b=number[3:5], c=number[5:]))
+    return [rng.choice(pool) for _ in range(count)]
+
+
+def test_examples():
+    for raw, expected in EXAMPLES.items():
+        assert normalize_phone(raw)['valid'] == expected, (raw, normalize_phone(raw))
+
+
+def run_benchmark(count):
+    phones = synthetic_phones(count)
+    print("Строк: {}, уникальных: {}".format(len(phones), len(set(phones))))
+
+    started = time.perf_counter()
+    results = normalize_many(phones)
+    elapsed = time.perf_counter() - started
+    print("normalize_many (холодный кэш): {:.2f} с, {:,.0f} строк/с".format(elapsed, count / elapsed))
+
+    started = time.perf_counter()
+    single = [normalize_phone(phone) for phone in phones]
+    elapsed = time.perf_counter() - started
+    print("normalize_phone (LRU-кэш):     {:.2f} с, {:,.0f} строк/с".format(elapsed, count / elapsed))
+
+    started = time.perf_counter()
+    valid, invalid = collect_phones(phones)
+    elapsed = time.perf_counter() - started
+    print("collect_phones:                {:.2f} с, правильных {}, неправильных {}".format(
+        elapsed, len(valid), len(invalid)))
+    print("Кэш: {}".format(cache_info()))
+
+    assert results == single
+    return results
+
+
+def test_benchmark_small():
+    results = run_benchmark(50000)
+    assert all(len(number) == 12 for result in results for number in result['valid'])
+
+
+if __name__ == "__main__":
+    print("Бенчмарк нормализатора телефонов")
+    print("=" * 60)
+    test_examples()
+    print("OK Примеры разобраны правильно")
+    run_benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Регрессионный бенчмарк отчёта по бешенству: количество SQL-запросов
+не должно расти вместе с количеством строк отчёта
+"""
+
+import os
+import sys
+import time
+from datetime import date, datetime
+
+# Добавляем корень проекта в путь
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from sqlalchemy import event
+
+from app import build_rabies_report_data
+from models import Owner, Pet, Vaccination, db
+
+
+def create_test_app():
+    """Отдельное приложение с базой в памяти, рабочая база не затрагивается"""
+    test_app = Flask(__name__)
+    test_app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+    test_app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(test_app)
+    return test_app
+
+
+def fill_database(n_pets):
+    """Каждое животное получает три прививки от бешенства, две из них в отчётном периоде"""
+    for i in range(n_pets):
+        owner = Owner(name='ВЛАДЕЛЕЦ {}'.format(i), address='АДРЕС {}'.format(i), phone='80291234567')
+        db.session.add(owner)
+        db.session.flush()
+        pet = Pet(owner_id=owner.id, name='Животное {}'.format(i), card_number=str(i + 1),
+                  species='Собака', gender='М', breed='дворняга', birth_date=date(2015, 1, 1))
+        db.session.add(pet)
+        db.session.flush()
+        for vac_date in (date(2023, 5, 1), date(2024, 2, 1), date(2024, 3, 1)):
+            db.session.add(Vaccination(vaccine_name='НОБИВАК R', date_administered=vac_date,
+                                       vaccination_type='Бешенство', pet_id=pet.id,
+                                       owner_id=owner.id, dose_ml=1))
+    db.session.commit()
+
+
+def count_report_queries(n_pets):
+    """Строит отчёт и возвращает (количество строк, количество запросов, время)"""
+    test_app = create_test_app()
+    with test_app.app_context():
+        db.create_all()
+        fill_database(n_pets)
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            started = time.perf_counter()
+            report_data = build_rabies_report_data(datetime(2024, 1, 1), datetime(2024, 12, 31))
+            elapsed = time.perf_counter() - started
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+        # Предыдущая прививка для мартовской строки - февральская
+        march_rows = [row for row in report_data if row['date'] == '01.03.2024']
+        assert march_rows and all(row['prev_vaccination'] == '01.02.2024' for row in march_rows)
+
+        db.drop_all()
+        return len(report_data), len(statements), elapsed
+
+
+def test_rabies_report_query_count():
+    """Количество запросов одинаково для маленького и большого отчёта"""
+    results = []
+    for n_pets in (10, 100, 1000):
+        rows, queries, elapsed = count_report_queries(n_pets)
+        print("Животных: {:5d}  строк: {:5d}  запросов: {}  время: {:.3f} с".format(
+            n_pets, rows, queries, elapsed))
+        results.append(queries)
+
+    assert len(set(results)) == 1, "Количество запросов растёт с размером отчёта: {}".format(results)
+
+
+if __name__ == "__main__":
+    print("Бенчмарк отчёта по бешенству")
+    print("=" * 60)
+    test_rabies_report_query_count()
+    print("OK Количество запросов не зависит от размера отчёта")
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Фоновые PDF-отчёты с заглушкой wkhtmltopdf: задание выполняется в пуле
+потоков, результат кэшируется на диске по параметрам и содержимому.
+Запуск: python tests/test_report_jobs.py
+"""
+
+import os
+import stat
+import sys
+import tempfile
+
+# Добавляем корень проекта в путь
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pdf_backend
+import report_jobs
+
+# Заглушка: читает HTML из stdin и пишет минимальный PDF в последний аргумент
+STUB = """#!{python}
+import sys
+html = sys.stdin.buffer.read()
+if b'FAIL' in html:
+    sys.stderr.write('stub failure')
+    sys.exit(1)
+with open(sys.argv[-1], 'wb') as f:
+    f.write(b'%PDF-1.4\\n% stub\\n' + str(len(html)).encode() + b'\\n%%EOF\\n')
+"""
+
+
+def make_stub(directory):
+    path = os.path.join(directory, 'wkhtmltopdf')
+    with open(path, 'w') as f:
+        f.write(STUB.format(python=sys.executable))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+
+def test_report_jobs():
+    if sys.platform == 'win32':
+        print("Пропуск: заглушка wkhtmltopdf - скрипт POSIX")
+        return
+    with tempfile.TemporaryDirectory() as directory:
+        pdf_backend.set_wkhtmltopdf_path(make_stub(directory))
+        report_dir = os.path.join(directory, 'reports')
+        html = '<html><body>Отчёт</body></html>'
+        key = report_jobs.job_key('rabies_report', ['2024-01-01', '2024-12-31'], html)
+        assert report_jobs.download_name(key) == 'rabies_report_2024-01-01_2024-12-31.pdf'
+
+        job = report_jobs.submit(report_dir, key, html)
+        assert job['status'] == 'pending'
+        job = report_jobs.wait(report_dir, key, timeout=60)
+        assert job['status'] == 'done', job
+        with open(report_jobs.result_path(report_dir, key), 'rb') as f:
+            assert f.read(4) == b'%PDF'
+
+        # Повторный запрос с теми же параметрами и данными - готовый файл без нового задания
+        assert report_jobs.submit(report_dir, key, html)['status'] == 'done'
+        # Изменившиеся данные дают другой ключ
+        assert report_jobs.job_key('rabies_report', ['2024-01-01', '2024-12-31'], html + ' ') != key
+
+        failing = report_jobs.job_key('rabies_report', ['2025-01-01', '2025-01-31'], 'FAIL')
+        report_jobs.submit(report_dir, failing, 'FAIL')
+        job = report_jobs.wait(report_dir, failing, timeout=60)
+        assert job['status'] == 'failed' and job['error'], job
+        assert not report_jobs.is_valid_key('../secret')
+        pdf_backend.set_wkhtmltopdf_path(None)
+
+
+if __name__ == "__main__":
+    test_report_jobs()
+    print("OK Фоновые PDF-отчёты работают")
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк времени запуска: импорт app.py под `python -X importtime`.
+Проверяет, что тяжёлые библиотеки (ML, PDF, DOCX) не загружаются при старте.
+Запуск: python tests/test_startup_importtime.py [количество запусков]
+"""
+
+import os
+import subprocess
+import sys
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Загружаются только при первом использовании (ml_backend, pdf_backend, docx_templates)
+LAZY_MODULES = ['numpy', 'pandas', 'sklearn', 'scipy', 'joblib', 'pdfkit', 'docxtpl', 'docx']
+
+
+def import_times(module='app'):
+    """Словарь {модуль: (собственное время, суммарное время) в мкс} для импорта module"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+        cwd=PROJECT_ROOT, capture_output=True, text=True, timeout=120
+    )
+    assert result.returncode == 0, result.stderr[-2000:]
+
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def test_heavy_modules_are_lazy():
+    times = import_times()
+    loaded = [name for name in LAZY_MODULES if name in times]
+    assert not loaded, "При старте импортируются: {}".format(', '.join(loaded))
+
+
+def run_benchmark(runs):
+    totals = []
+    for _ in range(runs):
+        times = import_times()
+        totals.append(times['app'][1])
+
+    print("Импорт app: мин {:.0f} мс, медиана {:.0f} мс ({} запусков)".format(
+        min(totals) / 1000, sorted(totals)[len(totals) // 2] / 1000, runs))
+    print("Самые долгие пакеты верхнего уровня:")
+    top_level = [(cumulative, name) for name, (_, cumulative) in times.items() if '.' not in name]
+    for cumulative, name in sorted(top_level, reverse=True)[:10]:
+        print("  {:>8.1f} мс  {}".format(cumulative / 1000, name))
+
+
+if __name__ == "__main__":
+    print("Бенчмарк запуска приложения")
+    print("=" * 60)
+    test_heavy_modules_are_lazy()
+    print("OK Тяжёлые библиотеки не загружаются при старте")
+    run_benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -0,0 +1,39 @@
+#coding=utf-8
+"""
+Точка входа WSGI для работы клиники.
+
+Windows и Linux (waitress, один процесс, несколько потоков):
+    python wsgi.py
+Linux (gunicorn, тоже один процесс):
+    gunicorn -w 1 --threads 8 -b 0.0.0.0:5000 wsgi:app
+
+Поддерживается только один процесс сервера: включение ML, кэши и отметки
+изменений для статистики живут в памяти процесса, и другие процессы их не видят.
+
+Настройки берутся из переменных окружения AIBOLIT_* (см. app.py):
+AIBOLIT_SECRET_KEY, AIBOLIT_SERVER_PORT, AIBOLIT_SERVER_THREADS и т.д.
+Фоновый планировщик (копии базы, статистика) запускается только в
+процессе, который первым захватил instance/scheduler.lock.
+"""
+from app import create_app
+
+app = create_app()
+
+
+def serve():
+    """Запуск под waitress с app.config['SERVER_THREADS'] потоками"""
+    host = app.config['SERVER_HOST']
+    port = app.config['SERVER_PORT']
+    threads = app.config['SERVER_THREADS']
+    try:
+        from waitress import serve as waitress_serve
+    except ImportError:
+        print("[ВНИМАНИЕ] waitress не установлен (pip install waitress) - запускаю встроенный сервер")
+        app.run(host=host, port=port, debug=False, threaded=True, use_reloader=False)
+        return
+    print("[OK] Сервер запущен: http://{}:{} ({} потоков)".format(host, port, threads))
+    waitress_serve(app, host=host, port=port, threads=threads)
+
+
+if __name__ == '__main__':
+    serve()